@@ -1,9 +1,12 @@
 import json
 from typing import Dict, Any
 
-from flask import request, Flask
+from flask import request, Flask, stream_with_context
 
 from convertors.document_image_convertor import DocumentImageConvertor
+from convertors.ocr_engine import ocr_stats
+from kb.hybrid_search import lookup_stats
+from kb.retrieval_cache import retrieval_cache_stats
 from knowledge_base_service import KnowledgeBaseService
 from logger import logger
 
@@ -180,7 +183,10 @@ class KBModule:
 
         @app.route('/api/kb/<path:name>/status')
         def kb_status(name):
-            status = self.kb_service.kb_status(name)
+            # Without paging arguments the response keeps the processed/not processed lists
+            offset = request.args.get("offset", type=int)
+            limit = request.args.get("limit", type=int)
+            status = self.kb_service.kb_status(name, offset=offset, limit=limit, status=request.args.get("status"))
             if status is None:
                 return app.response_class(
                     response=json.dumps({"status": "error", "text": "Knowledge base not found!"}, indent=2),
@@ -191,6 +197,25 @@ class KBModule:
                 mimetype='application/json'
             )
 
+        @app.route('/api/kb/<path:name>/status/stream')
+        def kb_status_stream(name):
+            statuses = self.kb_service.iter_kb_status(name)
+            if statuses is None:
+                return app.response_class(
+                    response=json.dumps({"status": "error", "text": "Knowledge base not found!"}, indent=2),
+                    mimetype='application/json'
+                )
+
+            def generate():
+                # One JSON document per line, the last line has the counts
+                counts = {x: 0 for x in KnowledgeBaseService.DOCUMENT_STATUSES}
+                for document_status in statuses:
+                    counts[document_status["status"]] += 1
+                    yield json.dumps(document_status) + "\n"
+                yield json.dumps({"counts": counts, "total": sum(counts.values())}) + "\n"
+
+            return app.response_class(response=stream_with_context(generate()), mimetype='application/x-ndjson')
+
         @app.route('/api/kb/tesseract_languages')
         def kb_languages():
             langs = DocumentImageConvertor.get_tesseract_langs()
@@ -205,23 +230,54 @@ class KBModule:
                     mimetype='application/json'
                 )
 
-        # Documents
-        @app.route('/api/doc/')
-        def docs_all():
+        @app.route('/api/kb/ocr_stats')
+        def kb_ocr_stats():
             return app.response_class(
-                response=json.dumps(sorted(self.kb_service.doc_source.list_items('*'), key=lambda x: x["path"]),
-                                    indent=2),
+                response=json.dumps(ocr_stats(), indent=2),
                 mimetype='application/json'
             )
 
-        @app.route('/api/doc/<path:path>')
-        def doc_path(path):
+        @app.route('/api/kb/lookup_stats')
+        def kb_lookup_stats():
+            return app.response_class(
+                response=json.dumps(lookup_stats(), indent=2),
+                mimetype='application/json'
+            )
+
+        @app.route('/api/kb/retrieval_cache_stats')
+        def kb_retrieval_cache_stats():
+            return app.response_class(
+                response=json.dumps(retrieval_cache_stats(), indent=2),
+                mimetype='application/json'
+            )
+
+        # Documents
+        def doc_listing(pattern: str):
+            # Without paging arguments the response keeps the plain list
+            items = sorted(self.kb_service.doc_source.list_items(pattern), key=lambda x: x["path"])
+            offset = request.args.get("offset", type=int)
+            limit = request.args.get("limit", type=int)
+            if offset is not None or limit is not None:
+                offset = 0 if offset is None else max(0, offset)
+                items = {
+                    "total": len(items),
+                    "offset": offset,
+                    "limit": limit,
+                    "items": items[offset:] if limit is None else items[offset:offset + max(0, limit)],
+                }
             return app.response_class(
-                response=json.dumps(sorted(self.kb_service.doc_source.list_items(path), key=lambda x: x["path"]),
-                                    indent=2),
+                response=json.dumps(items, indent=2),
                 mimetype='application/json'
             )
 
+        @app.route('/api/doc/')
+        def docs_all():
+            return doc_listing('*')
+
+        @app.route('/api/doc/<path:path>')
+        def doc_path(path):
+            return doc_listing(path)
+
         @app.route('/api/doc_sources')
         def doc_sources():
             return app.response_class(
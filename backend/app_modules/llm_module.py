@@ -22,6 +22,48 @@ class LLMModule:
                     mimetype='application/json'
                 )
 
+        @app.route('/api/llm_runners/http_stats', methods=['GET'])
+        def http_stats():
+            try:
+                return app.response_class(
+                    response=json.dumps({"http_stats": self.llm_runners.http_stats()}, indent=2),
+                    mimetype='application/json'
+                )
+            except Exception as e:
+                logger.error(f"Failed to get http stats from llm runners. Error: {e}")
+                return app.response_class(
+                    response=json.dumps({"status": "failed", "text": f"{e}"}, indent=2),
+                    mimetype='application/json'
+                )
+
+        @app.route('/api/llm_runners/residency', methods=['GET'])
+        def residency_stats():
+            try:
+                return app.response_class(
+                    response=json.dumps({"residency": self.llm_runners.residency_stats()}, indent=2),
+                    mimetype='application/json'
+                )
+            except Exception as e:
+                logger.error(f"Failed to get model residency from llm runners. Error: {e}")
+                return app.response_class(
+                    response=json.dumps({"status": "failed", "text": f"{e}"}, indent=2),
+                    mimetype='application/json'
+                )
+
+        @app.route('/api/llm_runners/generation_stats', methods=['GET'])
+        def generation_stats():
+            try:
+                return app.response_class(
+                    response=json.dumps({"generation_stats": self.llm_runners.generation_stats()}, indent=2),
+                    mimetype='application/json'
+                )
+            except Exception as e:
+                logger.error(f"Failed to get generation stats from llm runners. Error: {e}")
+                return app.response_class(
+                    response=json.dumps({"status": "failed", "text": f"{e}"}, indent=2),
+                    mimetype='application/json'
+                )
+
         @app.route('/api/llm_runners/models/pull', methods=['POST'])
         def pull_llm():
             data = request.get_json()
@@ -0,0 +1,139 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from logger import logger
+
+
+class CacheIndex:
+    """
+    Small key -> JSON value store in SQLite, replaces the JSON cache files that were rewritten after every document.
+    Writes are committed in batches of commit_every or after commit_interval_s, call flush() to commit the rest.
+    Uncommitted writes are visible to reads through the same index.
+    """
+    def __init__(self, db_file: str, commit_every: int = 256, commit_interval_s: float = 5.0):
+        self.db_file = db_file
+        self.commit_every = max(1, commit_every)
+        self.commit_interval_s = commit_interval_s
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (namespace, key))"
+        )
+        self.connection.commit()
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM entries WHERE namespace = ? AND key = ?", [namespace, key]
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, namespace: str, key: str, value: dict):
+        self.put_many(namespace, {key: value})
+
+    def put_many(self, namespace: str, values: Dict[str, dict]):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO entries (namespace, key, value) VALUES (?, ?, ?)",
+                [(namespace, key, json.dumps(value)) for key, value in values.items()]
+            )
+            self.pending += len(values)
+            if self.pending >= self.commit_every or time.monotonic() - self.last_commit >= self.commit_interval_s:
+                self._commit()
+
+    def delete_namespace(self, namespace: str):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries WHERE namespace = ?", [namespace])
+            self._commit()
+
+    def count(self, namespace: str) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM entries WHERE namespace = ?",
+                                           [namespace]).fetchone()[0]
+
+    def _commit(self):
+        # Caller holds self.lock
+        self.connection.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            if self.pending > 0:
+                self._commit()
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.connection.close()
+
+    def import_json(self, namespace: str, json_file: str) -> int:
+        # One time migration of a legacy JSON cache, the file is kept as <json_file>.migrated
+        if not os.path.exists(json_file):
+            return 0
+        try:
+            with open(json_file, "r") as fh:
+                values = json.load(fh)
+        except Exception as e:
+            logger.error(f"Could not migrate cache {json_file}. Error: {e}")
+            return 0
+        self.put_many(namespace, values)
+        self.flush()
+        os.replace(json_file, json_file + ".migrated")
+        logger.info(f"Migrated {len(values)} cache entries from {json_file} to {self.db_file}")
+        return len(values)
+
+
+_indexes: Dict[str, CacheIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_cache_index(db_file: str, legacy_json: Optional[Dict[str, str]] = None) -> CacheIndex:
+    # legacy_json: namespace -> JSON cache file, imported once when the index is opened
+    key = os.path.abspath(db_file)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        # Cache folders may be deleted to start over, then the index goes with them
+        if index is not None and not os.path.exists(db_file):
+            index.close()
+            index = None
+        if index is None:
+            index = CacheIndex(db_file)
+            for namespace, json_file in (legacy_json or {}).items():
+                index.import_json(namespace, json_file)
+            _indexes[key] = index
+        return index
+
+
+def drop_cache_index(db_file: str):
+    # Closes the index and removes its files
+    with _indexes_lock:
+        index = _indexes.pop(os.path.abspath(db_file), None)
+    if index is not None:
+        index.close()
+    for path in [db_file, db_file + "-wal", db_file + "-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def flush_cache_indexes():
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        try:
+            index.flush()
+        except Exception as e:
+            logger.error(f"Could not flush cache index {index.db_file}. Error: {e}")
+
+
+atexit.register(flush_cache_indexes)
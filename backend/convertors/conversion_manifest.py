@@ -0,0 +1,189 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+from logger import logger
+from hashing import hash_files
+
+DEFAULT_MANIFEST_FILE = os.path.join("processed", "manifest.sqlite3")
+
+
+def page_records(folder_path: str) -> Optional[Dict[str, dict]]:
+    # Page file name -> hash and the stat fingerprint used to notice later changes. None if there are no pages.
+    if not os.path.isdir(folder_path):
+        return None
+    entries = [x for x in os.scandir(folder_path) if x.is_file()]
+    hashes = hash_files([x.path for x in entries])
+    records = {}
+    for entry in entries:
+        if hashes[entry.path] is None:
+            return None
+        stat = entry.stat()
+        records[entry.name] = {
+            "hash": hashes[entry.path],
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+    return records if len(records) > 0 else None
+
+
+def pages_unchanged(folder_path: str, pages: Dict[str, dict]) -> bool:
+    # Compares names, sizes and modification times only, page contents are not read
+    if len(pages) == 0 or not os.path.isdir(folder_path):
+        return False
+    seen = 0
+    for entry in os.scandir(folder_path):
+        if not entry.is_file():
+            continue
+        page = pages.get(entry.name)
+        if page is None:
+            return False
+        stat = entry.stat()
+        if page["size"] != stat.st_size or page["mtime_ns"] != stat.st_mtime_ns:
+            return False
+        seen += 1
+    return seen == len(pages)
+
+
+class ConversionManifest:
+    """
+    Metadata of every processed/ document in one SQLite file: document -> conversions -> page hashes -> folder hash.
+    Documents are keyed by their processed/ path, several paths can share a file hash.
+    """
+    def __init__(self, db_file: str = DEFAULT_MANIFEST_FILE):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        # Process pool workers write to the same file
+        self.connection = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "processed_path TEXT PRIMARY KEY, file_hash TEXT NOT NULL, metadata TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS documents_file_hash ON documents (file_hash);"
+            "CREATE TABLE IF NOT EXISTS conversions ("
+            "processed_path TEXT NOT NULL, conversion TEXT NOT NULL, model TEXT NOT NULL, position INTEGER NOT NULL, "
+            "folder_hash TEXT, metadata TEXT NOT NULL, PRIMARY KEY (processed_path, conversion, model));"
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "processed_path TEXT NOT NULL, conversion TEXT NOT NULL, model TEXT NOT NULL, page TEXT NOT NULL, "
+            "hash TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+            "PRIMARY KEY (processed_path, conversion, model, page));"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def _model_key(model: Optional[str]) -> str:
+        # NULLs never collide in a primary key, so conversions without a model are stored under ""
+        return "" if model is None else model
+
+    def get_metadata(self, processed_path: str) -> Optional[dict]:
+        with self.lock:
+            row = self.connection.execute("SELECT metadata FROM documents WHERE processed_path = ?",
+                                          [processed_path]).fetchone()
+            if row is None:
+                return None
+            conversions = self.connection.execute(
+                "SELECT metadata FROM conversions WHERE processed_path = ? ORDER BY position", [processed_path]
+            ).fetchall()
+        metadata = json.loads(row[0])
+        metadata["conversions"] = [json.loads(x[0]) for x in conversions]
+        return metadata
+
+    def put_metadata(self, processed_path: str, metadata: dict):
+        document = {key: value for key, value in metadata.items() if key != "conversions"}
+        conversions = metadata.get("conversions", [])
+        keys = {(x["conversion"], self._model_key(x["model"])) for x in conversions}
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO documents (processed_path, file_hash, metadata) VALUES (?, ?, ?)",
+                [processed_path, metadata["hash"], json.dumps(document)]
+            )
+            existing = self.connection.execute(
+                "SELECT conversion, model FROM conversions WHERE processed_path = ?", [processed_path]
+            ).fetchall()
+            for conversion, model in existing:
+                if (conversion, model) not in keys:
+                    self._delete_conversion(processed_path, conversion, model)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO conversions (processed_path, conversion, model, position, folder_hash, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(processed_path, x["conversion"], self._model_key(x["model"]), position, x["hash"], json.dumps(x))
+                 for position, x in enumerate(conversions)]
+            )
+
+    def _delete_conversion(self, processed_path: str, conversion: str, model: str):
+        # Caller holds self.lock and a transaction
+        for table in ["conversions", "pages"]:
+            self.connection.execute(f"DELETE FROM {table} WHERE processed_path = ? AND conversion = ? AND model = ?",
+                                    [processed_path, conversion, model])
+
+    def get_pages(self, processed_path: str, conversion: str, model: Optional[str]) -> Dict[str, dict]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT page, hash, size, mtime_ns FROM pages WHERE processed_path = ? AND conversion = ? AND model = ?",
+                [processed_path, conversion, self._model_key(model)]
+            ).fetchall()
+        return {page: {"hash": page_hash, "size": size, "mtime_ns": mtime_ns}
+                for page, page_hash, size, mtime_ns in rows}
+
+    def put_pages(self, processed_path: str, conversion: str, model: Optional[str], pages: Dict[str, dict]):
+        model_key = self._model_key(model)
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM pages WHERE processed_path = ? AND conversion = ? AND model = ?",
+                                    [processed_path, conversion, model_key])
+            self.connection.executemany(
+                "INSERT INTO pages (processed_path, conversion, model, page, hash, size, mtime_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(processed_path, conversion, model_key, page, x["hash"], x["size"], x["mtime_ns"])
+                 for page, x in pages.items()]
+            )
+
+    def get_folder_hash(self, processed_path: str, conversion: str, model: Optional[str]) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT folder_hash FROM conversions WHERE processed_path = ? AND conversion = ? AND model = ?",
+                [processed_path, conversion, self._model_key(model)]
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def is_unchanged(self, output_path: str, conversion: str, model: Optional[str], folder_hash: str) -> bool:
+        # output_path is <processed_path>/<output folder>
+        processed_path = os.path.dirname(os.path.normpath(output_path))
+        return self.get_folder_hash(processed_path, conversion, model) == folder_hash and \
+            pages_unchanged(output_path, self.get_pages(processed_path, conversion, model))
+
+    def find_by_hash(self, file_hash: str) -> List[str]:
+        with self.lock:
+            rows = self.connection.execute("SELECT processed_path FROM documents WHERE file_hash = ?",
+                                           [file_hash]).fetchall()
+        return [x[0] for x in rows]
+
+    def remove_document(self, processed_path: str):
+        with self.lock, self.connection:
+            for table in ["documents", "conversions", "pages"]:
+                self.connection.execute(f"DELETE FROM {table} WHERE processed_path = ?", [processed_path])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_manifests: Dict[str, ConversionManifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def get_conversion_manifest(db_file: str = DEFAULT_MANIFEST_FILE) -> ConversionManifest:
+    key = os.path.abspath(db_file)
+    with _manifests_lock:
+        manifest = _manifests.get(key)
+        # processed/ may be deleted to start over, then the manifest goes with it
+        if manifest is not None and not os.path.exists(db_file):
+            logger.info(f"Conversion manifest {db_file} was removed, creating a new one")
+            manifest.close()
+            manifest = None
+        if manifest is None:
+            manifest = ConversionManifest(db_file)
+            _manifests[key] = manifest
+        return manifest
@@ -1,11 +1,12 @@
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import List, Optional
 import os
+from convertors.conversion_manifest import get_conversion_manifest, page_records, pages_unchanged
 from convertors.document_file import DocumentFile
 from convertors.llm_contexts import DocumentContext
 from llm_runners.llm_runner import LLMRunner
 from logger import logger
-from utils import compute_folder_hash, clean_name
+from utils import combine_hashes, clean_name
 from convertors.convertor_result import ConvertorResult
 
 class Convertor(ABC):
@@ -34,46 +35,71 @@ class Convertor(ABC):
     def convert(self, doc: DocumentFile, context: DocumentContext) -> Optional[ConvertorResult]:
         pass
 
-    def get_or_init_conversion(self, document: DocumentFile) -> ConvertorResult:
-        document_metadata = document.get_or_init_metadata()
-        # Process document
-        extra_string_list = []
-        if self.model is not None:
-            extra_string_list = [self.model]
-        output_path = self.get_output_path(document)
-        folder_hash = compute_folder_hash(output_path,
-                                          extra_string_list=extra_string_list)
-        for conversion_metadata in document_metadata["conversions"]:
-            # Check if conversion is relevant to current convertor
-            if self.conversion_type == conversion_metadata["conversion"] and self.model == conversion_metadata["model"]:
-                if conversion_metadata["hash"] == folder_hash:
-                    result_hash = conversion_metadata["hash"]
-                    logger.info(
-                        f"[{self.conversion_type}]Document {document.file_path} already complete. Getting cache...")
-                    return ConvertorResult(
-                        pages=[x.path for x in os.scandir(os.path.abspath(output_path))],
-                        document_metadata=document_metadata,
-                        conversion_type=self.conversion_type,
-                        model=self.model,
-                        output_folder_name=self.output_folder_name,
-                        output_path=output_path,
-                        result_hash=result_hash,
-                        document_path=document.get_document_path(),
-                    )
+    def _extra_strings(self) -> List[str]:
+        return [] if self.model is None else [self.model]
+
+    def _conversion_result(self, document: DocumentFile, document_metadata: dict, pages: List[str],
+                           result_hash: Optional[str]) -> ConvertorResult:
         return ConvertorResult(
-            pages=[],
+            pages=pages,
             document_metadata=document_metadata,
             conversion_type=self.conversion_type,
             model=self.model,
             output_folder_name=self.output_folder_name,
-            output_path=output_path,
-            result_hash=None,
+            output_path=self.get_output_path(document),
+            result_hash=result_hash,
             document_path=document.get_document_path(),
         )
 
+    def get_or_init_conversion(self, document: DocumentFile) -> ConvertorResult:
+        manifest = get_conversion_manifest()
+        document_metadata = document.get_or_init_metadata()
+        output_path = self.get_output_path(document)
+        result_hash = manifest.get_folder_hash(document.processed_path, self.conversion_type, self.model)
+        pages = manifest.get_pages(document.processed_path, self.conversion_type, self.model)
+        # Page hashes are trusted while names, sizes and modification times are the same, nothing is read
+        if result_hash is not None and pages_unchanged(output_path, pages):
+            logger.info(f"[{self.conversion_type}]Document {document.file_path} already complete. Getting cache...")
+            return self._conversion_result(document, document_metadata,
+                                           [os.path.join(os.path.abspath(output_path), x) for x in sorted(pages)],
+                                           result_hash)
+        if result_hash is not None:
+            # Pages changed since they were recorded or the conversion came from a metadata.json
+            records = page_records(output_path)
+            # Empty or missing output folders have no hash and are never complete
+            if records is not None and combine_hashes([records[x]["hash"] for x in sorted(records)],
+                                                      extra_string_list=self._extra_strings()) == result_hash:
+                manifest.put_pages(document.processed_path, self.conversion_type, self.model, records)
+                logger.info(
+                    f"[{self.conversion_type}]Document {document.file_path} already complete. Getting cache...")
+                return self._conversion_result(document, document_metadata,
+                                               [os.path.join(os.path.abspath(output_path), x) for x in sorted(records)],
+                                               result_hash)
+        return self._conversion_result(document, document_metadata, [], None)
+
+    def record_conversion(self, document: DocumentFile, metadata: dict) -> Optional[str]:
+        # Hashes the finished output folder once and stores it with its pages in metadata and the manifest
+        output_path = self.get_output_path(document)
+        records = page_records(output_path)
+        result_hash = None
+        if records is not None:
+            result_hash = combine_hashes([records[x]["hash"] for x in sorted(records)],
+                                         extra_string_list=self._extra_strings())
+        self.set_conversion_metadata(metadata, result_hash)
+        document.write_metadata(metadata)
+        if records is not None:
+            get_conversion_manifest().put_pages(document.processed_path, self.conversion_type, self.model, records)
+        return result_hash
+
     def get_output_path(self, document) -> str:
         return str(os.path.join(document.processed_path, self.output_folder_name))
 
+    def set_conversion_metadata(self, metadata: dict, result_hash):
+        # Replaces the entry of an earlier, unfinished or changed conversion of this convertor
+        metadata["conversions"] = [x for x in metadata["conversions"]
+                                   if not (x["conversion"] == self.conversion_type and x["model"] == self.model)]
+        metadata["conversions"].append(self.conversion_metadata(result_hash))
+
     def conversion_metadata(self, result_hash) -> dict:
         return {
             "conversion": self.conversion_type,
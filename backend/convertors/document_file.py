@@ -1,13 +1,17 @@
 import json
 import shutil
 import traceback
+import uuid
 from abc import ABC, abstractmethod
 from datetime import datetime
 from pathlib import Path
 import os
 from pypdf import PdfReader
-from pdf_to_png import convert_pdf
-from typing import List, Optional
+from pdf_to_png import convert_pdf, iter_pdf_pages, get_page_count
+from settings import PDFRenderSettings
+from typing import Dict, Iterator, List, Optional
+from convertors.conversion_manifest import get_conversion_manifest
+from convertors.text_layer import is_usable_text_layer
 from utils import compute_file_hash
 from logger import logger
 
@@ -33,7 +37,8 @@ class DocumentFile(ABC):
             )
         )
         self.image_based = image_based
-        self.temp_image_path = os.path.join(os.getcwd(), "temp_images")
+        # Unique per document, so parallel ingestion workers do not clean up each other's images
+        self.temp_image_path = os.path.join(os.getcwd(), "temp_images", uuid.uuid4().hex)
         self.has_changed = False
         self.last_modified = last_modified
         self.file_size = file_size
@@ -58,15 +63,22 @@ class DocumentFile(ABC):
     def cleanup_output(self):
         if os.path.exists(self.processed_path):
             shutil.rmtree(self.processed_path)
+        get_conversion_manifest().remove_document(self.processed_path)
 
     def _ensure_output_exists(self):
         os.makedirs(self.processed_path, exist_ok=True)
 
     def get_or_init_metadata(self) -> dict:
+        manifest = get_conversion_manifest()
+        metadata = manifest.get_metadata(self.processed_path)
+        if metadata is not None:
+            return metadata
+        # Processed before the manifest existed
         if os.path.exists(os.path.join(self.processed_path, "metadata.json")):
             with open(os.path.join(self.processed_path, "metadata.json"), "r") as fh:
                 loaded_metadata = json.load(fh)
-                return loaded_metadata
+            manifest.put_metadata(self.processed_path, loaded_metadata)
+            return loaded_metadata
         metadata = {
                     "type": self.document_type,
                     "filename": self.file_name,
@@ -75,18 +87,11 @@ class DocumentFile(ABC):
                     "conversions": []
                 }
         self._ensure_output_exists()
-        metadata_path = os.path.join(self.processed_path, "metadata.json")
-        temp_metadata_path = os.path.join(self.processed_path, "metadata.json.tmp")
-        with open(temp_metadata_path, "w") as fh:
-            json.dump(
-                metadata,
-                fh,
-                indent=2
-            )
-        shutil.move(temp_metadata_path, metadata_path)
+        self.write_metadata(metadata)
         return metadata
 
     def write_metadata(self, metadata):
+        # metadata.json stays as a readable copy next to the pages, lookups go through the manifest
         metadata_path = os.path.join(self.processed_path, "metadata.json")
         temp_metadata_path = os.path.join(self.processed_path, "metadata.json.tmp")
         with open(temp_metadata_path, "w") as fh:
@@ -96,6 +101,7 @@ class DocumentFile(ABC):
                 indent=2
             )
         shutil.move(temp_metadata_path, metadata_path)
+        get_conversion_manifest().put_metadata(self.processed_path, metadata)
 
     @abstractmethod
     def raw_dump(self):
@@ -105,6 +111,23 @@ class DocumentFile(ABC):
         # Override this for relevant DocumentFile's, by default does nothing.
         pass
 
+    def cleanup_temp_image(self, image_path: str):
+        # Called once a page image is converted. Override for DocumentFile's that create temp images.
+        pass
+
+    def extract_text_layer(self, min_chars: int, min_quality: float) -> Dict[int, Optional[str]]:
+        # Page number -> usable embedded text or None for pages that need image conversion.
+        # Empty when the document type has no text layer, then every page is converted from images.
+        return {}
+
+    def page_count(self) -> Optional[int]:
+        # None when the document has no numbered pages
+        return None
+
+    @staticmethod
+    def is_supported(file_path: str) -> bool:
+        return Path(file_path).suffix.lower() in DocumentFile.PDF_EXT + DocumentFile.TEXT_EXT + DocumentFile.IMAGE_EXT
+
     @staticmethod
     def create(doc_source_name: str, doc_source_root: str, file_path: str, precalc_file_hash: Optional[str] = None, last_modified: Optional[datetime] = None, file_size: int = -1):
         extension = Path(file_path).suffix.lower()
@@ -125,9 +148,13 @@ class ImageDocumentFile(DocumentFile):
         super().__init__(doc_source_name, doc_source_root, file_path, document_type = "image", image_based = True,
                          precalc_file_hash = precalc_file_hash, last_modified =last_modified, file_size = file_size)
 
-    def convert_document_to_images(self) -> List[str]:
+    def convert_document_to_images(self, render_settings: Optional[PDFRenderSettings] = None) -> List[str]:
         return [self.file_path]
 
+    def iter_document_images(self, render_settings: Optional[PDFRenderSettings] = None,
+                             pages: Optional[List[int]] = None) -> Iterator[str]:
+        yield self.file_path
+
 class PDFDocumentFile(DocumentFile):
     POPPLER_PATH = "/usr/bin"
     def __init__(self, doc_source_name: str, doc_source_root: str, file_path: str,
@@ -147,7 +174,9 @@ class PDFDocumentFile(DocumentFile):
                 text = page.extract_text()
                 fh.write(text)
 
-    def convert_document_to_images(self) -> List[str]:
+    def convert_document_to_images(self, render_settings: Optional[PDFRenderSettings] = None) -> List[str]:
+        if render_settings is None:
+            render_settings = PDFRenderSettings()
         self.cleanup_temp_files()
         os.makedirs(self.temp_image_path, exist_ok=True)
         images = []
@@ -156,6 +185,9 @@ class PDFDocumentFile(DocumentFile):
             images = convert_pdf(
                 pdf_path=self.file_path,
                 output_folder=self.temp_image_path,
+                dpi=render_settings.dpi,
+                workers=render_settings.workers,
+                pages_per_range=render_settings.pages_per_range,
             )
         except Exception as e:
             logger.error(f"Error processing document: {self.file_name}")
@@ -163,10 +195,50 @@ class PDFDocumentFile(DocumentFile):
 
         return images
 
+    def iter_document_images(self, render_settings: Optional[PDFRenderSettings] = None,
+                             pages: Optional[List[int]] = None) -> Iterator[str]:
+        if render_settings is None:
+            render_settings = PDFRenderSettings()
+        self.cleanup_temp_files()
+        os.makedirs(self.temp_image_path, exist_ok=True)
+        logger.info(f"Rendering pages of {self.file_path}...")
+        yield from iter_pdf_pages(
+            pdf_path=self.file_path,
+            output_folder=self.temp_image_path,
+            dpi=render_settings.dpi,
+            workers=render_settings.workers,
+            pages_per_range=render_settings.pages_per_range,
+            pages=pages,
+        )
+
+    def page_count(self) -> Optional[int]:
+        return get_page_count(self.file_path)
+
+    def extract_text_layer(self, min_chars: int, min_quality: float) -> Dict[int, Optional[str]]:
+        try:
+            reader = PdfReader(self.file_path)
+            pages = reader.pages
+        except Exception as e:
+            logger.error(f"Could not read text layer of {self.file_name}. Error: {e}")
+            return {}
+        text_layer = {}
+        for page_number, page in enumerate(pages, 1):
+            try:
+                text = page.extract_text()
+            except Exception as e:
+                logger.warning(f"Could not extract text of page {page_number} in {self.file_name}. Error: {e}")
+                text = None
+            text_layer[page_number] = text if is_usable_text_layer(text, min_chars, min_quality) else None
+        return text_layer
+
     def cleanup_temp_files(self):
         if os.path.exists(self.temp_image_path):
             shutil.rmtree(self.temp_image_path)
 
+    def cleanup_temp_image(self, image_path: str):
+        if Path(image_path).parent == Path(self.temp_image_path) and os.path.exists(image_path):
+            os.remove(image_path)
+
 class TextDocumentFile(DocumentFile):
     def __init__(self, doc_source_name: str, doc_source_root: str, file_path: str,
                  precalc_file_hash: Optional[str] = None, last_modified: Optional[datetime] = None, file_size: int = -1):
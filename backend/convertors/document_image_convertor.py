@@ -1,14 +1,20 @@
+import itertools
+import json
 import pathlib
+import shutil
 import subprocess
 
 from convertors.convertor_result import ConvertorResult
 from convertors.convertor import Convertor
 from abc import abstractmethod
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Iterable, Dict, Tuple
 
 from convertors.llm_contexts import DocumentContext
+from convertors.ocr_engine import get_tesseract_engine, TesseractEngine
 from logger import logger
-from utils import compute_folder_hash
+from pdf_to_png import page_image_name
+from settings import PDFRenderSettings
+from hashing import fast_algorithm, hash_file, is_available
 from convertors.document_file import PDFDocumentFile, ImageDocumentFile
 import os
 
@@ -16,12 +22,32 @@ import os
 class DocumentImageConvertor(Convertor):
     def __init__(self, conversion_type, model):
         super().__init__(conversion_type, model)
-        self.images = None
 
     @abstractmethod
     def image_to_text(self, input_data, context: DocumentContext):
         pass
 
+    def images_to_text(self, image_paths: List[str], context: DocumentContext) -> List[Optional[str]]:
+        # Override when several pages can be converted at a lower cost than one at a time
+        return [self.image_to_text(x, context) for x in image_paths]
+
+    def batch_size(self, context: DocumentContext) -> int:
+        return 1
+
+    def has_ocr_step(self) -> bool:
+        # Convertors that OCR the pages before transcribing the text, the ingestion pipeline runs the OCR as its own stage
+        return False
+
+    def ocr_images(self, image_paths: List[str], context: DocumentContext) -> List[Optional[str]]:
+        return [None for _ in image_paths]
+
+    def ocr_batch_size(self, context: DocumentContext) -> int:
+        return 1
+
+    def texts_to_text(self, input_texts: List[str], context: DocumentContext) -> List[Optional[str]]:
+        # Second step of convertors with an OCR step, from the OCR text of every page
+        return list(input_texts)
+
     def convert(self, doc: Union[PDFDocumentFile, ImageDocumentFile], context: DocumentContext) -> Optional[ConvertorResult]:
         # TODO: add check if zero pages is intended as in complete
         conversion_result = self.get_or_init_conversion(doc)
@@ -30,36 +56,159 @@ class DocumentImageConvertor(Convertor):
         else:
             return conversion_result
 
-    def convert_image_document(self, document: Union[PDFDocumentFile, ImageDocumentFile], metadata: dict, context: DocumentContext) -> Optional[ConvertorResult]:
+    def select_pages(self, document: Union[PDFDocumentFile, ImageDocumentFile],
+                     context: DocumentContext) -> Tuple[Dict[int, str], Optional[List[int]]]:
+        """
+        Returns text of pages with a usable text layer and page numbers that still need image conversion.
+        None instead of page numbers means all pages.
+        """
+        render_settings = context.pdf_render_settings
+        if render_settings is None:
+            render_settings = PDFRenderSettings()
+        if not render_settings.text_layer_enabled:
+            return {}, None
+        text_layer = document.extract_text_layer(render_settings.text_layer_min_chars,
+                                                 render_settings.text_layer_min_quality)
+        if len(text_layer) == 0:
+            return {}, None
+        text_pages = {page: text for page, text in text_layer.items() if text is not None}
+        image_pages = [page for page, text in text_layer.items() if text is None]
+        logger.info(f"[{self.conversion_type}]{len(text_pages)} of {len(text_layer)} pages of {document.file_name} "
+                    f"use the text layer")
+        return text_pages, image_pages
+
+    def progress_path(self, document: Union[PDFDocumentFile, ImageDocumentFile]) -> str:
+        # Next to the output folder, so it is not part of the folder hash
+        return os.path.join(document.processed_path, self.output_folder_name + ".progress.json")
+
+    def load_progress(self, document: Union[PDFDocumentFile, ImageDocumentFile]) -> Dict[str, str]:
+        """
+        Output file name -> content hash of pages converted by earlier runs.
+        Pages whose output file is missing or was changed since are left out and get converted again.
+        """
+        progress_path = self.progress_path(document)
+        if not os.path.exists(progress_path):
+            return {}
+        try:
+            with open(progress_path, "r") as fh:
+                progress = json.load(fh)
+        except Exception as e:
+            logger.warning(f"[{self.conversion_type}]Could not read {progress_path}, converting all pages. Error: {e}")
+            return {}
+        if progress.get("model") != self.model:
+            return {}
+        # Progress files from before the fast hash was used hold SHA-256 page hashes
+        hash_algorithm = progress.get("hash_algorithm", "sha256")
+        if not is_available(hash_algorithm):
+            logger.warning(f"[{self.conversion_type}]Hash {hash_algorithm} of {progress_path} is not available, "
+                           f"converting all pages.")
+            return {}
+        output_path = self.get_output_path(document)
+        valid_pages = {}
+        for page_file, page_hash in progress.get("pages", {}).items():
+            page_path = os.path.join(output_path, page_file)
+            if os.path.exists(page_path) and hash_file(page_path, hash_algorithm) == page_hash:
+                # Saved again with the current algorithm
+                valid_pages[page_file] = page_hash if hash_algorithm == fast_algorithm() else self.page_hash(page_path)
+        return valid_pages
+
+    def save_progress(self, document: Union[PDFDocumentFile, ImageDocumentFile], pages: Dict[str, str]):
+        progress_path = self.progress_path(document)
+        temp_progress_path = progress_path + ".tmp"
+        with open(temp_progress_path, "w") as fh:
+            json.dump({"conversion": self.conversion_type, "model": self.model, "hash_algorithm": fast_algorithm(),
+                       "pages": pages}, fh, indent=2)
+        shutil.move(temp_progress_path, progress_path)
+
+    @staticmethod
+    def page_hash(page_path: str) -> str:
+        # Only detects pages changed after an interrupted run, the fast hash is enough
+        return hash_file(page_path, fast_algorithm())
+
+    @staticmethod
+    def page_output_name(page_number: int) -> str:
+        # Named like rendered pages, so page numbers and ordering match
+        return pathlib.Path(page_image_name(page_number)).stem + ".txt"
+
+    def plan_pages(self, document: Union[PDFDocumentFile, ImageDocumentFile],
+                   context: DocumentContext) -> Tuple[Dict[int, str], Optional[List[int]]]:
+        """
+        Like select_pages, but leaves out pages already converted by an earlier, interrupted run.
+        """
+        text_pages, image_pages = self.select_pages(document, context)
+        done_pages = self.load_progress(document)
+        if len(done_pages) == 0:
+            return text_pages, image_pages
+        if image_pages is None:
+            page_count = document.page_count()
+            if page_count is None:
+                return text_pages, image_pages
+            image_pages = list(range(1, page_count + 1))
+        image_pages = [x for x in image_pages if self.page_output_name(x) not in done_pages]
+        text_pages = {k: v for k, v in text_pages.items() if self.page_output_name(k) not in done_pages}
+        logger.info(f"[{self.conversion_type}]Resuming {document.file_name}, {len(done_pages)} pages already converted")
+        return text_pages, image_pages
+
+    def convert_image_document(self, document: Union[PDFDocumentFile, ImageDocumentFile], metadata: dict,
+                               context: DocumentContext, images: Optional[Iterable[str]] = None,
+                               text_pages: Optional[Dict[int, str]] = None,
+                               ocr_texts: Optional[Dict[str, Optional[str]]] = None) -> Optional[ConvertorResult]:
         try:
             if document.image_based:
-                # Check if you need to generate temp images for image conversion
+                # Check if you need to generate temp images for image conversion, the ingestion pipeline renders ahead
                 try:
-                    self.images = document.convert_document_to_images()
-                    if self.images is None:
+                    # Kept local, convertor instances are shared between workers.
+                    # Pages are converted while later pages are still rendering.
+                    if images is None:
+                        text_pages, image_pages = self.plan_pages(document, context)
+                        images = document.iter_document_images(context.pdf_render_settings, image_pages)
+                    if images is None:
                         logger.error(f"Image conversion failed. File: {document.file_name}")
                         return None
                     logger.info(f"Doing {self.conversion_type}")
                     output_path = self.get_output_path(document)
                     os.makedirs(output_path, exist_ok=True)
 
-                    for image_path in self.images:
-                        logger.info(f"{self.conversion_type} - {image_path}")
-                        image_filename = pathlib.Path(image_path).stem
-                        with open(os.path.join(output_path, image_filename + ".txt"),
-                                  "w") as fh:
-                            converted_text = self.image_to_text(image_path, context)
+                    # Every written page is recorded, an interrupted run continues from the missing pages
+                    done_pages = self.load_progress(document)
+                    for page_number, text in (text_pages or {}).items():
+                        page_path = os.path.join(output_path, self.page_output_name(page_number))
+                        with open(page_path, "w") as fh:
+                            fh.write(text)
+                        done_pages[self.page_output_name(page_number)] = self.page_hash(page_path)
+                    if text_pages:
+                        self.save_progress(document, done_pages)
+
+                    batch_size = self.batch_size(context)
+                    batch = []
+                    for image_path in itertools.chain(images, [None]):
+                        if image_path is not None:
+                            batch.append(image_path)
+                            if len(batch) < batch_size:
+                                continue
+                        if len(batch) == 0:
+                            continue
+                        logger.info(f"{self.conversion_type} - {", ".join(batch)}")
+                        if ocr_texts is not None:
+                            # The ingestion pipeline's OCR stage already read these pages
+                            input_texts = [ocr_texts.pop(x, None) for x in batch]
+                            converted_texts = [None for _ in batch] if any(x is None for x in input_texts) \
+                                else self.texts_to_text(input_texts, context)
+                        else:
+                            converted_texts = self.images_to_text(batch, context)
+                        for batch_image_path, converted_text in zip(batch, converted_texts):
                             if converted_text is None:
+                                self.save_progress(document, done_pages)
                                 return None
-                            fh.write(converted_text)
-                    extra_string_list = []
-                    if self.conversion_type in ["ocr_llm", "llm"]:
-                        extra_string_list = [self.model]
-                    result_hash = compute_folder_hash(
-                        os.path.join(document.processed_path, self.output_folder_name),
-                        extra_string_list=extra_string_list)
-                    metadata["conversions"].append(self.conversion_metadata(result_hash))
-                    document.write_metadata(metadata)
+                            page_file = pathlib.Path(batch_image_path).stem + ".txt"
+                            with open(os.path.join(output_path, page_file),
+                                      "w") as fh:
+                                fh.write(converted_text)
+                            done_pages[page_file] = self.page_hash(os.path.join(output_path, page_file))
+                            document.cleanup_temp_image(batch_image_path)
+                        self.save_progress(document, done_pages)
+                        batch = []
+                    result_hash = self.record_conversion(document, metadata)
                 finally:
                     document.cleanup_temp_files()
                 return ConvertorResult(
@@ -83,19 +232,11 @@ class DocumentImageConvertor(Convertor):
 
     @staticmethod
     def tesseract_convert(tesseract_path: str, image_path: str, character_sets: List[str] = None) -> Optional[str]:
-        if character_sets is None or len(character_sets) == 0:
-            character_sets = ["eng"]
+        return get_tesseract_engine(character_sets, tesseract_path).image_to_text(image_path)
 
-        args = ["-l", "+".join(character_sets)]
-        process = subprocess.run(
-            [tesseract_path] + args + [image_path, "stdout"],
-            text=True,
-            capture_output=True,
-        )
-        if process.returncode != 0:
-            logger.error(f"Error converting {image_path} with tesseract ocr. Error: {process.stderr}")
-            return None
-        return process.stdout
+    @staticmethod
+    def tesseract_engine(context: DocumentContext) -> TesseractEngine:
+        return get_tesseract_engine(context.character_sets, max_processes=context.ocr_settings.max_processes)
 
     @staticmethod
     def get_tesseract_langs() -> Optional[List[str]]:
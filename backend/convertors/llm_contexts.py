@@ -1,12 +1,22 @@
+from typing import List, Optional
+
 from kb.knowledge_base import KnowledgeBase
+from settings import PDFRenderSettings, OcrSettings, LlmConversionSettings
 
 
 class ChatContext:
-    def __init__(self, llm_model: str, system_prompt: str, kb: KnowledgeBase):
+    def __init__(self, llm_model: str, system_prompt: str, kb: Optional[KnowledgeBase],
+                 kbs: Optional[List[KnowledgeBase]] = None):
         self.llm_model = llm_model
         self.system_prompt = system_prompt
-        self.kb = kb
+        # kbs are searched together, kb is the first of them
+        self.kbs = [x for x in kbs if x is not None] if kbs is not None else ([] if kb is None else [kb])
+        self.kb = self.kbs[0] if len(self.kbs) > 0 else None
 
 class DocumentContext:
-    def __init__(self, kb: KnowledgeBase):
+    def __init__(self, kb: KnowledgeBase, pdf_render_settings: Optional[PDFRenderSettings] = None,
+                 ocr_settings: Optional[OcrSettings] = None, llm_conversion: Optional[LlmConversionSettings] = None):
         self.character_sets = kb.languages
+        self.pdf_render_settings = pdf_render_settings
+        self.ocr_settings = ocr_settings if ocr_settings is not None else OcrSettings()
+        self.llm_conversion = llm_conversion if llm_conversion is not None else LlmConversionSettings()
@@ -1,6 +1,6 @@
 import base64
 
-from typing import Optional
+from typing import List, Optional
 from convertors.document_image_convertor import DocumentImageConvertor
 from convertors.llm_contexts import DocumentContext
 from llm_runners.llm_runner import LLMRunner
@@ -35,7 +35,7 @@ class LlmConvertor(DocumentImageConvertor):
         self.user_text: str = user_text
         self.options: dict = options if options is not None else LlmConvertor.OPTIONS
 
-    def image_to_text(self, input_data, context: DocumentContext) -> str:
+    def _messages(self, image_path: str) -> List[dict]:
         system_message= {
             "role": "system",
             "content": self.system_text
@@ -43,9 +43,16 @@ class LlmConvertor(DocumentImageConvertor):
         user_message = {
             'role': 'user',
             'content': self.user_text,
-            'images': [encode_image(input_data)]
+            'images': [encode_image(image_path)]
         }
-        messages = [system_message, user_message]
+        return [system_message, user_message]
+
+    def image_to_text(self, input_data, context: DocumentContext) -> str:
+        return self.llm_runner.run_text_completion_simple(self.model, self._messages(input_data), self.options)
 
-        return self.llm_runner.run_text_completion_simple(self.model,messages, self.options)
+    def images_to_text(self, image_paths: List[str], context: DocumentContext) -> List[Optional[str]]:
+        return self.llm_runner.run_text_completion_batch(self.model, [self._messages(x) for x in image_paths],
+                                                         self.options, context.llm_conversion.concurrency)
 
+    def batch_size(self, context: DocumentContext) -> int:
+        return context.llm_conversion.batch_size
@@ -1,5 +1,6 @@
+from typing import List, Optional
+
 from convertors.document_image_convertor import DocumentImageConvertor
-import os
 
 from convertors.llm_contexts import DocumentContext
 
@@ -11,9 +12,10 @@ class OcrConvertor(DocumentImageConvertor):
         super().__init__(conversion_type, None)
         
     def image_to_text(self, input_data: str, context: DocumentContext) -> str:
-        return DocumentImageConvertor.tesseract_convert(
-            tesseract_path=os.environ.get("TESSERACT_PATH", "tesseract"),
-            image_path=input_data,
-            character_sets=context.character_sets
-        )
+        return DocumentImageConvertor.tesseract_engine(context).image_to_text(input_data)
+
+    def images_to_text(self, image_paths: List[str], context: DocumentContext) -> List[Optional[str]]:
+        return DocumentImageConvertor.tesseract_engine(context).images_to_text(image_paths)
 
+    def batch_size(self, context: DocumentContext) -> int:
+        return context.ocr_settings.batch_size
@@ -0,0 +1,140 @@
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from logger import logger
+
+# Tesseract's default page_separator, appended after every page in file list mode
+PAGE_SEPARATOR = "\f"
+
+
+class OcrStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = 0
+        self.failed_pages = 0
+        self.batches = 0
+        self.total_s = 0.0
+        self.last_page_s: Optional[float] = None
+        self.min_page_s: Optional[float] = None
+        self.max_page_s: Optional[float] = None
+
+    def record(self, pages: int, failed_pages: int, duration_s: float):
+        if pages == 0:
+            return
+        page_s = duration_s / pages
+        with self.lock:
+            self.pages += pages
+            self.failed_pages += failed_pages
+            self.batches += 1
+            self.total_s += duration_s
+            self.last_page_s = page_s
+            self.min_page_s = page_s if self.min_page_s is None else min(self.min_page_s, page_s)
+            self.max_page_s = page_s if self.max_page_s is None else max(self.max_page_s, page_s)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "pages": self.pages,
+                "failed_pages": self.failed_pages,
+                "batches": self.batches,
+                "avg_page_s": round(self.total_s / self.pages, 3) if self.pages > 0 else None,
+                "last_page_s": None if self.last_page_s is None else round(self.last_page_s, 3),
+                "min_page_s": None if self.min_page_s is None else round(self.min_page_s, 3),
+                "max_page_s": None if self.max_page_s is None else round(self.max_page_s, 3),
+            }
+
+
+class TesseractEngine:
+    """
+    Tesseract OCR for one language set. Pages are sent in batches through tesseract's file list mode,
+    so language data is loaded once per batch instead of once per page.
+    """
+    def __init__(self, tesseract_path: str, languages: List[str], max_processes: int = 2):
+        self.tesseract_path = tesseract_path
+        self.languages = languages
+        self.max_processes = max(1, max_processes)
+        self.process_slots = threading.BoundedSemaphore(self.max_processes)
+        self.stats = OcrStats()
+
+    def image_to_text(self, image_path: str) -> Optional[str]:
+        return self.images_to_text([image_path])[0]
+
+    def images_to_text(self, image_paths: List[str]) -> List[Optional[str]]:
+        if len(image_paths) == 0:
+            return []
+        started = time.perf_counter()
+        with self.process_slots:
+            if len(image_paths) == 1:
+                texts = [self._run(image_paths[0])]
+            else:
+                texts = self._run_batch(image_paths)
+        duration_s = time.perf_counter() - started
+        failed_pages = len([x for x in texts if x is None])
+        self.stats.record(len(image_paths), failed_pages, duration_s)
+        logger.info(f"[ocr]{"+".join(self.languages)}: {len(image_paths)} page(s) in {duration_s:.2f}s "
+                    f"({duration_s / len(image_paths):.2f}s/page)")
+        return texts
+
+    def _args(self) -> List[str]:
+        return ["-l", "+".join(self.languages)]
+
+    def _run(self, image_path: str) -> Optional[str]:
+        process = subprocess.run(
+            [self.tesseract_path] + self._args() + [image_path, "stdout"],
+            text=True,
+            capture_output=True,
+        )
+        if process.returncode != 0:
+            logger.error(f"Error converting {image_path} with tesseract ocr. Error: {process.stderr}")
+            return None
+        return process.stdout
+
+    def _run_batch(self, image_paths: List[str]) -> List[Optional[str]]:
+        file_list = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+        try:
+            with file_list:
+                file_list.write("\n".join(os.path.abspath(x) for x in image_paths) + "\n")
+            process = subprocess.run(
+                [self.tesseract_path] + self._args() + [file_list.name, "stdout"],
+                text=True,
+                capture_output=True,
+            )
+        finally:
+            os.remove(file_list.name)
+        pages = process.stdout.split(PAGE_SEPARATOR)
+        # Every page ends with the separator, so the last part is empty. Pages keep the separator like
+        # single page output does.
+        if process.returncode == 0 and len(pages) == len(image_paths) + 1:
+            return [x + PAGE_SEPARATOR for x in pages[:-1]]
+        logger.warning(f"Tesseract batch of {len(image_paths)} pages failed, converting pages one by one. "
+                       f"Error: {process.stderr}")
+        return [self._run(x) for x in image_paths]
+
+
+_engines: Dict[Tuple[str, Tuple[str, ...]], TesseractEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_tesseract_engine(languages: Optional[List[str]] = None, tesseract_path: Optional[str] = None,
+                         max_processes: int = 2) -> TesseractEngine:
+    if languages is None or len(languages) == 0:
+        languages = ["eng"]
+    if tesseract_path is None:
+        tesseract_path = os.environ.get("TESSERACT_PATH", "tesseract")
+    key = (tesseract_path, tuple(languages))
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = TesseractEngine(tesseract_path, list(languages), max_processes)
+            _engines[key] = engine
+        return engine
+
+
+def ocr_stats() -> List[dict]:
+    with _engines_lock:
+        engines = list(_engines.values())
+    return [{"engine": "tesseract", "languages": x.languages, **x.stats.to_dict()} for x in engines]
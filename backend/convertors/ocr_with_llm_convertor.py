@@ -1,4 +1,5 @@
-import os
+from typing import List, Optional
+
 from convertors.document_image_convertor import DocumentImageConvertor
 from bs4 import BeautifulSoup
 
@@ -23,26 +24,57 @@ class OcrLlmConvertor(DocumentImageConvertor):
         self.user_text: str = user_text
         self.options: dict = options if options is not None else OcrLlmConvertor.OPTIONS
 
-    def image_to_text(self, input_data: str, context: DocumentContext) -> str:
+    def image_to_text(self, input_data: str, context: DocumentContext) -> Optional[str]:
+        input_text = DocumentImageConvertor.tesseract_engine(context).image_to_text(input_data)
+        if input_text is None:
+            return None
+        return self.proofread(input_text)
+
+    def images_to_text(self, image_paths: List[str], context: DocumentContext) -> List[Optional[str]]:
+        # OCR the whole batch in one tesseract run, then proofread the pages together
+        input_texts = self.ocr_images(image_paths, context)
+        if any(x is None for x in input_texts):
+            return [None for _ in image_paths]
+        return self.texts_to_text(input_texts, context)
+
+    def batch_size(self, context: DocumentContext) -> int:
+        return min(context.ocr_settings.batch_size, context.llm_conversion.batch_size)
+
+    def has_ocr_step(self) -> bool:
+        return True
+
+    def ocr_images(self, image_paths: List[str], context: DocumentContext) -> List[Optional[str]]:
+        return DocumentImageConvertor.tesseract_engine(context).images_to_text(image_paths)
+
+    def ocr_batch_size(self, context: DocumentContext) -> int:
+        return context.ocr_settings.batch_size
+
+    def texts_to_text(self, input_texts: List[str], context: DocumentContext) -> List[Optional[str]]:
+        contents = self.llm_runner.run_text_completion_batch(self.model, [self._messages(x) for x in input_texts],
+                                                             self.options, context.llm_conversion.concurrency)
+        thinking_support = self.llm_runner.supports_thinking(self.model)
+        return [None if content is None else self._clean(content, input_text, thinking_support)
+                for content, input_text in zip(contents, input_texts)]
+
+    def _messages(self, input_text: str) -> List[dict]:
         system_message = {
             'role': 'system',
             'content': self.system_text,
         }
-        input_text = DocumentImageConvertor.tesseract_convert(
-            tesseract_path=os.environ.get("TESSERACT_PATH", "tesseract"),
-            image_path=input_data,
-            character_sets=context.character_sets
-        )
         # TODO: Sanitize input_text.
         user_message = {
             'role': 'user',
             'content': f"{self.user_text}\n\n<text>{input_text}</text>",
         }
-        messages = [system_message, user_message]
-        thinking_support = self.llm_runner.supports_thinking(self.model)
+        return [system_message, user_message]
 
-        content = self.llm_runner.run_text_completion_simple(self.model,messages, self.options)
+    def proofread(self, input_text: str) -> str:
+        thinking_support = self.llm_runner.supports_thinking(self.model)
+        content = self.llm_runner.run_text_completion_simple(self.model, self._messages(input_text), self.options)
+        return self._clean(content, input_text, thinking_support)
 
+    @staticmethod
+    def _clean(content: str, input_text: str, thinking_support: Optional[bool]) -> str:
         # Filtering for models with baked-in thinking and content integrity check to see if input intended to contain <think> tags or not.
         if content.startswith("<think>") and not thinking_support and not input_text.startswith("<think>"):
             soup = BeautifulSoup(content, "html.parser")
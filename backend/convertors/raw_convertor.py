@@ -4,7 +4,6 @@ from convertors.convertor_result import ConvertorResult
 from convertors.convertor import Convertor
 from convertors.document_file import DocumentFile
 from convertors.llm_contexts import DocumentContext
-from utils import compute_folder_hash
 from logger import logger
 
 class RawConvertor(Convertor):
@@ -29,9 +28,7 @@ class RawConvertor(Convertor):
         try:
             document.raw_dump()
             output_path = self.get_output_path(document)
-            result_hash = compute_folder_hash(output_path)
-            metadata["conversions"].append(self.conversion_metadata(result_hash))
-            document.write_metadata(metadata)
+            result_hash = self.record_conversion(document, metadata)
             return ConvertorResult(
                 pages=[x.path for x in os.scandir(os.path.abspath(output_path))],
                 document_metadata=metadata,
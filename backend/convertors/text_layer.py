@@ -0,0 +1,21 @@
+import unicodedata
+from typing import Optional
+
+
+def text_quality(text: str) -> float:
+    # Share of letters and digits among visible characters. Broken font encodings extract as symbols,
+    # private use characters or replacement characters and score low.
+    visible = [x for x in text if not x.isspace()]
+    if len(visible) == 0:
+        return 0.0
+    good = len([x for x in visible if unicodedata.category(x)[0] in "LN"])
+    return good / len(visible)
+
+
+def is_usable_text_layer(text: Optional[str], min_chars: int, min_quality: float) -> bool:
+    if text is None:
+        return False
+    visible_chars = len("".join(text.split()))
+    if visible_chars < min_chars:
+        return False
+    return text_quality(text) >= min_quality
@@ -0,0 +1,192 @@
+import fnmatch
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from logger import logger
+
+# Folders modified this recently may still change within the same mtime tick, they are scanned again next time
+RACY_MTIME_NS = 2 * 1000 * 1000 * 1000
+
+
+class DirectoryNode:
+    def __init__(self):
+        self.mtime_ns: Optional[int] = None
+        self.checked: Optional[float] = None
+        self.files: List[str] = []
+        self.dirs: Dict[str, "DirectoryNode"] = {}
+
+
+def _is_hidden(name: str) -> bool:
+    return name.startswith(".")
+
+
+def _has_magic(segment: str) -> bool:
+    return any(x in segment for x in ["*", "?", "["])
+
+
+def _join(prefix: str, name: str) -> str:
+    return name if prefix == "" else prefix + "/" + name
+
+
+class DirectoryIndex:
+    """
+    In-memory tree of the files and folders under root_path, answers glob patterns like glob.glob(recursive=True).
+    Folders are read with os.scandir when a pattern first reaches them. Later, a folder's modification time is
+    checked at most every refresh_interval_s and it is only read again when that changed.
+    """
+    def __init__(self, root_path: str, refresh_interval_s: float = 1.0):
+        self.root_path = os.path.abspath(root_path)
+        self.refresh_interval_s = refresh_interval_s
+        self.lock = threading.Lock()
+        self.root = DirectoryNode()
+        self.scans = 0
+
+    def _fresh(self, node: DirectoryNode, relative_path: str) -> DirectoryNode:
+        # Caller holds self.lock
+        now = time.monotonic()
+        if node.checked is not None and node.mtime_ns is not None and now - node.checked < self.refresh_interval_s:
+            return node
+        node.checked = now
+        path = os.path.join(self.root_path, relative_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            node.mtime_ns, node.files, node.dirs = None, [], {}
+            return node
+        if node.mtime_ns == stat.st_mtime_ns:
+            return node
+        files = []
+        dirs = {}
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            # Known subfolders keep their contents, they are checked when they are reached
+                            dirs[entry.name] = node.dirs.get(entry.name) or DirectoryNode()
+                        elif entry.is_file():
+                            files.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.error(f"Could not list {path}. Error: {e}")
+        self.scans += 1
+        node.files = sorted(files)
+        node.dirs = dict(sorted(dirs.items()))
+        # Changes in the same mtime tick as the scan would go unnoticed
+        node.mtime_ns = stat.st_mtime_ns if time.time_ns() - stat.st_mtime_ns > RACY_MTIME_NS else None
+        return node
+
+    def _node(self, segments: List[str]) -> Optional[DirectoryNode]:
+        # Caller holds self.lock
+        node = self._fresh(self.root, "")
+        for i, segment in enumerate(segments):
+            node = node.dirs.get(segment)
+            if node is None:
+                return None
+            node = self._fresh(node, "/".join(segments[:i + 1]))
+        return node
+
+    def file_type(self, relative_path: str) -> Optional[str]:
+        """"dir" or "file" for a path relative to the root, None if it does not exist."""
+        segments = [x for x in relative_path.split("/") if x not in ["", "."]]
+        with self.lock:
+            return self._file_type(segments)
+
+    def _file_type(self, segments: List[str]) -> Optional[str]:
+        # Caller holds self.lock
+        if len(segments) == 0:
+            return "dir" if os.path.isdir(self.root_path) else None
+        parent = self._node(segments[:-1])
+        if parent is None:
+            return None
+        if segments[-1] in parent.dirs:
+            return "dir"
+        return "file" if segments[-1] in parent.files else None
+
+    def glob(self, pattern: str) -> List[Tuple[str, bool]]:
+        """
+        (path relative to the root, is_dir) of the files and folders matching a posix glob pattern. "**" spans
+        folders, hidden names are only matched by patterns that start with ".", a trailing "/" matches folders only.
+        """
+        if pattern.endswith("/"):
+            return [x for x in self.glob(pattern.rstrip("/")) if x[1]]
+        segments = [x for x in pattern.split("/") if x not in ["", "."]]
+        if ".." in segments:
+            return []
+        literal = []
+        for segment in segments:
+            if _has_magic(segment):
+                break
+            literal.append(segment)
+        with self.lock:
+            if len(literal) == len(segments):
+                file_type = self._file_type(segments)
+                return [] if file_type is None or len(segments) == 0 else [("/".join(segments), file_type == "dir")]
+            node = self._node(literal)
+            if node is None:
+                return []
+            return list(self._match(node, "/".join(literal), segments[len(literal):]))
+
+    def _everything(self, node: DirectoryNode, prefix: str) -> Iterator[Tuple[str, bool]]:
+        # Every visible file and folder below node
+        for name in node.files:
+            if not _is_hidden(name):
+                yield _join(prefix, name), False
+        for name, child in node.dirs.items():
+            if not _is_hidden(name):
+                yield _join(prefix, name), True
+                yield from self._everything(self._fresh(child, _join(prefix, name)), _join(prefix, name))
+
+    def _folders(self, node: DirectoryNode, prefix: str) -> Iterator[Tuple[str, DirectoryNode]]:
+        # node and every visible folder below it
+        yield prefix, node
+        for name, child in node.dirs.items():
+            if not _is_hidden(name):
+                yield from self._folders(self._fresh(child, _join(prefix, name)), _join(prefix, name))
+
+    def _match(self, node: DirectoryNode, prefix: str, segments: List[str]) -> Iterator[Tuple[str, bool]]:
+        segment, rest = segments[0], segments[1:]
+        if segment == "**":
+            if len(rest) == 0:
+                # Like glob, "folder/**" lists the folder itself and everything below it
+                if prefix != "":
+                    yield prefix, True
+                yield from self._everything(node, prefix)
+                return
+            seen = set()
+            for path, child in self._folders(node, prefix):
+                for match in self._match(child, path, rest):
+                    # "**/**" would find the same paths through several folders
+                    if match not in seen:
+                        seen.add(match)
+                        yield match
+            return
+        if _has_magic(segment):
+            names = [x for x in list(node.dirs) + node.files if not _is_hidden(x) or _is_hidden(segment)]
+            names = sorted(fnmatch.filter(names, segment))
+        else:
+            names = [segment] if segment in node.dirs or segment in node.files else []
+        for name in names:
+            child = node.dirs.get(name)
+            if len(rest) == 0:
+                yield _join(prefix, name), child is not None
+            elif child is not None:
+                yield from self._match(self._fresh(child, _join(prefix, name)), _join(prefix, name), rest)
+
+
+_indexes: Dict[str, DirectoryIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_directory_index(root_path: str) -> DirectoryIndex:
+    # Shared by every doc source with the same root folder
+    key = os.path.abspath(root_path)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = DirectoryIndex(root_path)
+            _indexes[key] = index
+        return index
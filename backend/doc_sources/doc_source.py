@@ -1,16 +1,17 @@
-import json
 import os
-import shutil
 from abc import ABC, abstractmethod
-from typing import List, Dict, Union, Optional
+from typing import List, Dict, Union, Optional, Tuple
 
+from cache_index import CacheIndex, get_cache_index
 from convertors.document_file import DocumentFile
+from logger import logger
 from settings import Settings
 from utils import to_posix_path
 
 
 class DocSource(ABC):
     DEFAULT_CACHE_DIR = os.path.join(".cache", "doc_hash_cache")
+    HASH_NAMESPACE = "hashes"
     FORBIDDEN_NAME_SYMBOLS = [
         "/",
         "\\",
@@ -27,36 +28,53 @@ class DocSource(ABC):
                 raise (ValueError(
                     f"DocSource name cannot contain {DocSource.FORBIDDEN_NAME_SYMBOLS} characters! Given name: {name}"))
         self.name: str = name
-        self.hash_cache: dict = {}
         self.hash_cache_path = None
+        self.legacy_hash_cache_path = None
         if cache_hashes:
-            os.makedirs(cache_dir, exist_ok=True)
-            self.hash_cache_path = os.path.join(cache_dir, name + ".json")
-            if os.path.exists(self.hash_cache_path):
-                with open(self.hash_cache_path, "r") as fh:
-                    self.hash_cache = json.load(fh)
+            self.hash_cache_path = os.path.join(cache_dir, name + ".sqlite3")
+            self.legacy_hash_cache_path = os.path.join(cache_dir, name + ".json")
+
+    def _hash_cache(self) -> Optional[CacheIndex]:
+        # Opened on first use, SuperDocSource delegates to its sources and never needs one
+        if self.hash_cache_path is None:
+            return None
+        try:
+            return get_cache_index(self.hash_cache_path, {DocSource.HASH_NAMESPACE: self.legacy_hash_cache_path})
+        except Exception as e:
+            logger.error(f"Could not open hash cache {self.hash_cache_path}. Error: {e}")
+            return None
+
+    def get_cached_hash(self, document_path: str) -> Optional[dict]:
+        hash_cache = self._hash_cache()
+        return None if hash_cache is None else hash_cache.get(DocSource.HASH_NAMESPACE, document_path)
+
+    def watch_roots(self) -> Dict[str, str]:
+        # Document path prefix -> local folder that can be watched for changes
+        return {}
+
+    def cached_hash_state(self, path: str) -> Tuple[Optional[str], bool]:
+        # Hash recorded at the last update_cache of the document at path, None if the file changed since,
+        # and whether a recorded hash is out of date. The file is not read, changes are noticed by its
+        # modification time and size.
+        return None, False
+
+    def cached_file_hash(self, path: str) -> Optional[str]:
+        return self.cached_hash_state(path)[0]
 
     def update_cache(self, doc: DocumentFile):
-        self.hash_cache.update(
-            {
-                doc.get_document_path(): {
-                    "hash": doc.file_hash,
-                    "last_modified": doc.last_modified.isoformat(),
-                    "file_size": doc.file_size
-                }
-            }
-        )
-        self._save_cache()
-
-    def _save_cache(self):
-        temp_cache = self.hash_cache_path + ".temp"
-        with open(temp_cache, "w") as fh:
-            json.dump(self.hash_cache, fh, indent=2)
-        shutil.move(temp_cache, self.hash_cache_path)
+        hash_cache = self._hash_cache()
+        if hash_cache is None:
+            return
+        hash_cache.put(DocSource.HASH_NAMESPACE, doc.get_document_path(), {
+            "hash": doc.file_hash,
+            "last_modified": doc.last_modified.isoformat(),
+            "file_size": doc.file_size
+        })
 
     def clear_cache(self):
-        self.hash_cache.clear()
-        self._save_cache()
+        hash_cache = self._hash_cache()
+        if hash_cache is not None:
+            hash_cache.delete_namespace(DocSource.HASH_NAMESPACE)
 
     @abstractmethod
     def _list(self, pattern: str) -> List[Dict[str, Union[str, bool]]]:
@@ -136,6 +154,21 @@ class SuperDocSource(DocSource):
                 return document
         return document
 
+    def watch_roots(self) -> Dict[str, str]:
+        roots = {}
+        for doc_source in self.doc_sources:
+            for prefix, root_path in doc_source.watch_roots().items():
+                roots[self.name + "/" + prefix if len(self.name) > 0 else prefix] = root_path
+        return roots
+
+    def cached_hash_state(self, path: str) -> Tuple[Optional[str], bool]:
+        _, doc_path = to_posix_path(path).split("/", maxsplit=1) if len(self.name) > 0 else (None, path)
+        for doc_source in self.doc_sources:
+            file_hash, stale = doc_source.cached_hash_state(doc_path)
+            if file_hash is not None or stale:
+                return file_hash, stale
+        return None, False
+
     def to_dict(self) -> List[dict]:
         return [x.to_dict() for x in self.doc_sources]
 
@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from logger import logger
+from settings import WatchSettings
+from utils import to_posix_path
+
+
+class ChangeJournal:
+    """
+    Document paths changed since the last drain. Repeated events of a path are coalesced into one entry that is
+    drained only after the path has been quiet for quiet_s, so burst writes are processed once.
+    """
+    def __init__(self, quiet_s: float = 2.0):
+        self.quiet_s = quiet_s
+        self.lock = threading.Lock()
+        # Document path -> monotonic time of the last event
+        self.changes: Dict[str, float] = {}
+        self.events = 0
+
+    def record(self, path: str):
+        with self.lock:
+            self.changes[path] = time.monotonic()
+            self.events += 1
+
+    def drain(self, force: bool = False) -> List[str]:
+        now = time.monotonic()
+        with self.lock:
+            ready = [path for path, changed in self.changes.items() if force or now - changed >= self.quiet_s]
+            for path in ready:
+                del self.changes[path]
+        return sorted(ready)
+
+    def pending(self) -> int:
+        with self.lock:
+            return len(self.changes)
+
+
+class DocSourceWatcher:
+    """
+    Watches the root folder of a doc source and records changed files in its journal as document paths.
+    Uses inotify (through watchfiles) where available, otherwise compares directory snapshots every poll interval.
+    """
+    def __init__(self, prefix: str, root_path: str, journal: ChangeJournal, settings: WatchSettings):
+        self.prefix = prefix
+        self.root_path = os.path.abspath(root_path)
+        self.journal = journal
+        self.settings = settings
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.mode: Optional[str] = None
+
+    def document_path(self, file_path: str) -> Optional[str]:
+        relative_path = os.path.relpath(os.path.abspath(file_path), self.root_path)
+        if relative_path.startswith(".."):
+            return None
+        return to_posix_path(self.prefix + "/" + relative_path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f"doc_watcher_{self.prefix}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def _run(self):
+        if not self.settings.force_polling:
+            try:
+                self._watch_events()
+                return
+            except ImportError:
+                logger.warning("watchfiles is not installed, polling for document changes")
+            except Exception as e:
+                logger.warning(f"Could not watch {self.root_path} for events, polling instead. Error: {e}")
+        self._watch_polling()
+
+    def _watch_events(self):
+        from watchfiles import watch
+        self.mode = "events"
+        logger.info(f"Watching {self.root_path} for document changes")
+        for changes in watch(self.root_path, stop_event=self.stop_event, debounce=self.settings.debounce_ms,
+                             rust_timeout=self.settings.poll_interval_ms, yield_on_timeout=False):
+            for _, file_path in changes:
+                self._record(file_path)
+
+    def _record(self, file_path: str):
+        document_path = self.document_path(file_path)
+        if document_path is not None:
+            self.journal.record(document_path)
+
+    def snapshot(self) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        for directory, _, file_names in os.walk(self.root_path):
+            for file_name in file_names:
+                file_path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                files[file_path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def _watch_polling(self):
+        self.mode = "polling"
+        logger.info(f"Polling {self.root_path} for document changes every {self.settings.poll_interval_ms} ms")
+        previous = self.snapshot()
+        while not self.stop_event.wait(self.settings.poll_interval_ms / 1000):
+            current = self.snapshot()
+            for file_path in set(previous) | set(current):
+                if previous.get(file_path) != current.get(file_path):
+                    self._record(file_path)
+            previous = current
+
+
+class DocSourceWatch:
+    """
+    One watcher and journal per doc source root. on_changes is called from a dispatcher thread with the coalesced
+    document paths and returns False when they could not be processed yet.
+    """
+    def __init__(self, roots: Dict[str, str], settings: WatchSettings, on_changes: Callable[[List[str]], bool]):
+        self.settings = settings
+        self.on_changes = on_changes
+        self.journals: Dict[str, ChangeJournal] = {}
+        self.watchers: List[DocSourceWatcher] = []
+        for prefix, root_path in roots.items():
+            journal = ChangeJournal(settings.quiet_ms / 1000)
+            self.journals[prefix] = journal
+            self.watchers.append(DocSourceWatcher(prefix, root_path, journal, settings))
+        self.stop_event = threading.Event()
+        self.dispatcher: Optional[threading.Thread] = None
+        self.dispatched = 0
+
+    def start(self):
+        for watcher in self.watchers:
+            watcher.start()
+        self.dispatcher = threading.Thread(target=self._dispatch, name="doc_watch_dispatcher", daemon=True)
+        self.dispatcher.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for watcher in self.watchers:
+            watcher.stop()
+        if self.dispatcher is not None:
+            self.dispatcher.join(timeout=5)
+
+    def drain(self, force: bool = False) -> List[str]:
+        paths = []
+        for journal in self.journals.values():
+            paths += journal.drain(force)
+        return paths
+
+    def _requeue(self, paths: List[str]):
+        for path in paths:
+            prefix = next((x for x in self.journals if path.startswith(x + "/")), None)
+            if prefix is not None:
+                self.journals[prefix].record(path)
+
+    def _dispatch(self):
+        while not self.stop_event.wait(self.settings.quiet_ms / 4000):
+            paths = self.drain()
+            if len(paths) == 0:
+                continue
+            try:
+                processed = self.on_changes(paths)
+            except Exception as e:
+                logger.error(f"Could not process changed documents. Error: {e}")
+                processed = False
+            if processed:
+                self.dispatched += len(paths)
+            else:
+                self._requeue(paths)
+
+    def stats(self) -> dict:
+        return {
+            "watchers": [{"doc_source": x.prefix, "root_path": x.root_path, "mode": x.mode,
+                          "pending": self.journals[x.prefix].pending(), "events": self.journals[x.prefix].events}
+                         for x in self.watchers],
+            "dispatched": self.dispatched,
+        }
@@ -1,9 +1,9 @@
 import datetime
-import glob
 import os
-from typing import List, Dict, Union, Optional
+from typing import List, Dict, Union, Optional, Tuple
 
 from convertors.document_file import DocumentFile
+from doc_sources.directory_index import get_directory_index
 from doc_sources.doc_source import DocSource
 from logger import logger
 from utils import from_posix_path, to_posix_path
@@ -20,15 +20,13 @@ class LocalFileSystemSource(DocSource):
         posix_pattern = to_posix_path(pattern)
         if pattern.startswith(self.name):
             posix_pattern = posix_pattern[len(self.name):].lstrip("/")
-        paths = []
-        dir_to_crawl = self.root_path if posix_pattern == "" else os.path.join(self.root_path,
-                                                                               from_posix_path(posix_pattern))
-        dir_to_crawl = from_posix_path(dir_to_crawl)
+        index = get_directory_index(from_posix_path(self.root_path))
         if not DocSource._is_glob_pattern(posix_pattern):
-            if os.path.isdir(dir_to_crawl):
+            file_type = index.file_type(posix_pattern)
+            if file_type == "dir":
                 # Pattern that lists the directory
-                dir_to_crawl = os.path.join(dir_to_crawl, "*")
-            if os.path.isfile(dir_to_crawl):
+                posix_pattern = posix_pattern.rstrip("/") + "/*" if posix_pattern != "" else "*"
+            elif file_type == "file":
                 # Listing path to a file it returns path to this file
                 return [
                     {
@@ -37,16 +35,13 @@ class LocalFileSystemSource(DocSource):
                         "is_dir": False
                     }
                 ]
-        for x in glob.glob(os.path.join(dir_to_crawl), recursive=True):
-            paths.append(
-                {
-                    "path": to_posix_path(self.name + os.sep + os.path.relpath(x, self.root_path)),
-                    "is_file": os.path.isfile(x),
-                    "is_dir": os.path.isdir(x)
-                }
-            )
-        paths = [x for x in paths if not x["path"].endswith('/.')]
-        return paths
+        return [
+            {
+                "path": self.name + "/" + path,
+                "is_file": not is_dir,
+                "is_dir": is_dir
+            } for path, is_dir in index.glob(posix_pattern)
+        ]
 
     # noinspection PyUnreachableCode
     def get(self, path: str) -> Optional[DocumentFile]:
@@ -60,7 +55,8 @@ class LocalFileSystemSource(DocSource):
             has_changed = False
             last_modified: datetime.datetime = datetime.datetime.fromtimestamp(os.path.getmtime(full_doc_path))
             file_size: int = os.path.getsize(full_doc_path)
-            cached_hash_info: dict = self.hash_cache.get(full_doc_path)
+            # Same key as DocumentFile.get_document_path(), which update_cache stores under
+            cached_hash_info: Optional[dict] = self.get_cached_hash(os.path.join(self.name, str(full_doc_path)))
 
             if cached_hash_info is not None:
                 is_modified = last_modified != datetime.datetime.fromisoformat(cached_hash_info["last_modified"])
@@ -86,6 +82,28 @@ class LocalFileSystemSource(DocSource):
         finally:
             return document
 
+    def watch_roots(self) -> Dict[str, str]:
+        return {self.name: from_posix_path(self.root_path)}
+
+    def cached_hash_state(self, path: str) -> Tuple[Optional[str], bool]:
+        # Same checks as get
+        target_doc_source_name, _, doc_path = to_posix_path(path).partition("/")
+        if target_doc_source_name != self.name:
+            return None, False
+        full_doc_path = os.path.join(from_posix_path(self.root_path), from_posix_path(doc_path))
+        cached_hash_info = self.get_cached_hash(os.path.join(self.name, str(full_doc_path)))
+        if cached_hash_info is None:
+            return None, False
+        try:
+            stat = os.stat(full_doc_path)
+        except OSError:
+            return None, True
+        if datetime.datetime.fromtimestamp(stat.st_mtime) != \
+                datetime.datetime.fromisoformat(cached_hash_info["last_modified"]) or \
+                cached_hash_info["file_size"] != stat.st_size:
+            return None, True
+        return cached_hash_info["hash"], False
+
     def to_dict(self) -> dict:
         output_dict = super().to_dict()
         output_dict["root_path"] = to_posix_path(self.root_path)
@@ -72,12 +72,14 @@ class RoomMessage:
 
 
 class MessageProgress:
-    def __init__(self, status, new_tokens, duration_s, total_response_tokens, message=""):
+    def __init__(self, status, new_tokens, duration_s, total_response_tokens, message="", token_usage=None):
         self.status = status
         self.new_tokens = new_tokens
         self.duration_s = duration_s
         self.total_response_tokens = total_response_tokens
         self.message = message
+        # Prompt tokens of the turn by part, see PromptBuilder
+        self.token_usage: Optional[dict] = token_usage
 
     def __eq__(self, other):
         if isinstance(other, MessageProgress):
@@ -87,6 +89,7 @@ class MessageProgress:
                     and self.duration_s == other.duration_s
                     and self.total_response_tokens == other.total_response_tokens
                     and self.message == other.message
+                    and self.token_usage == other.token_usage
             )
         return False
 
@@ -97,4 +100,5 @@ class MessageProgress:
             "duration_s": self.duration_s,
             "total_response_tokens": self.total_response_tokens,
             "message": self.message,
+            "token_usage": self.token_usage,
         }
@@ -1,6 +1,7 @@
 import argparse
 import json
 import os.path
+import threading
 import uuid
 from typing import List, Optional, Dict
 
@@ -20,7 +21,8 @@ from generation_guard import GenerationGuard
 from llm_runners.debug_runner import DebugRunner
 from llm_runners.llm_runner import ChatContext, LLMRunner, SuperRunner
 from logger import logger
-from settings import DEFAULT_SYSTEM_PROMPT, LLM_RUNNERS, KBSTORES, DOC_SOURCES, RESTORE_DEFAULT, GENERATION_GUARD, RAGSettings
+from settings import DEFAULT_SYSTEM_PROMPT, LLM_RUNNERS, KBSTORES, DOC_SOURCES, RESTORE_DEFAULT, GENERATION_GUARD, RAGSettings, \
+    KB_SERVICE, PromptSettings
 from store.sql_alchemy_stores import SQLAlchemy_ChatStore
 from utils import utc_now
 from room_states import RoomStateRegister, RoomState
@@ -30,6 +32,8 @@ chat_store = SQLAlchemy_ChatStore(db, app)
 def handle_settings_updated(name):
     if name in [RESTORE_DEFAULT, LLM_RUNNERS, KBSTORES, DOC_SOURCES]:
         update_module_deps()
+    elif name == KB_SERVICE:
+        kb_service.update_watch()
 
 
 def host_frontend(base_path):
@@ -185,6 +189,9 @@ def download_rag_sources(msg_id):
 
 # TODO: Combine these
 last_progress: Dict[str, MessageProgress] = {}
+# Model -> thread loading it, every room opened meanwhile shares it
+warm_up_threads: Dict[str, threading.Thread] = {}
+warm_up_lock = threading.Lock()
 room_state_register: RoomStateRegister = RoomStateRegister()
 
 def emit_progress(msg, room_id):
@@ -200,6 +207,24 @@ def get_last_progress(room_id):
     else:
         return "null"
 
+@app.route('/api/room/<room_id>/warm_up', methods=['POST'])
+def warm_up_room_model(room_id):
+    # Called when a room is opened, the model loads while the user types
+    model = request.args.get('model')
+    if model is None:
+        assistant_messages = [x for x in chat_store.messages_by_room(room_id) if x.role == "assistant"]
+        model = assistant_messages[-1].username if len(assistant_messages) > 0 else None
+    if model is None or not super_runner.is_model_installed(model=model):
+        return {"model": model, "status": "unknown model"}, 404
+    with warm_up_lock:
+        thread = warm_up_threads.get(model)
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=super_runner.warm_up, args=(model,), name=f"warm_up_{model}",
+                                      daemon=True)
+            warm_up_threads[model] = thread
+            thread.start()
+    return {"model": model, "status": "warming up"}
+
 @app.route('/api/room/<room_id>/stop')
 def stop_chat_generation(room_id):
     room_state_register.get(room_id).stop()
@@ -214,6 +239,8 @@ def handle_message(data):
         username = data.get('username', 'Anonymous')
         user_text = data.get('user_input', '')
         kb_name = data.get('kb_name', None)
+        # Several knowledge bases are searched together
+        kb_names = data.get('kb_names', None)
         model = data.get('llm_model')
         # send temporary use message (id=null)
         raw_user_message = RoomMessage(room_id=room_id, username=username, role='user', content=user_text)
@@ -237,7 +264,8 @@ def handle_message(data):
                 ChatContext(
                     model,
                     system_prompt,
-                    kb_service.kb_store.get(kb_name)
+                    kb_service.kb_store.get(kb_name),
+                    kbs=kb_service.kb_store.get_many(kb_names) if kb_names else None,
                 ),
                 room_state,
                 user_input,
@@ -245,6 +273,7 @@ def handle_message(data):
                 update_callback=lambda msg: emit_progress(msg, room_id),
                 history=cleaned_history,
                 rag_settings=RAGSettings.from_settings(settings),
+                prompt_settings=PromptSettings.from_settings(settings),
             )
         except Exception as e:
             emit_progress(MessageProgress('error', 0, 0, 0, message=f"{e}"), room_id)
@@ -319,15 +348,20 @@ def update_module_deps():
     runner_list: List[LLMRunner] = LLMRunner.from_settings(settings)
     kb_stores: List[KBStore] = KBStore.from_settings(settings)
 
+    if super_runner is not None:
+        super_runner.close()
     super_runner = SuperRunner(runner_list)
     kb_store = SuperKBStore(kb_stores)
     doc_sources = DocSource.from_settings(settings)
     doc_source = SuperDocSource(doc_sources=doc_sources)
+    if kb_service is not None:
+        kb_service.stop_watch()
     kb_service = KnowledgeBaseService(
         kb_store,
         doc_source,
         super_runner
     )
+    kb_service.update_watch()
     if kb_module is not None:
         kb_module.kb_service = kb_service
     else:
@@ -346,6 +380,8 @@ if __name__ == '__main__':
         print("Running in production mode.")
     else:
         print("Running in debug mode. For production mode add --production to parameters.")
+    super_runner: Optional[SuperRunner] = None
+    kb_service: Optional[KnowledgeBaseService] = None
     kb_module: Optional[KBModule] = None
     llm_module: Optional[LLMModule] = None
     update_module_deps()
@@ -1,3 +1,11 @@
+from collections import deque
+from typing import Deque, Dict, List
+
+# Windows are counted by a polynomial rolling hash of token ids modulo a Mersenne prime
+_HASH_MODULUS = (1 << 61) - 1
+_HASH_BASE = 1_000_003
+
+
 class GenerationGuard:
     def __init__(self, safe_token_threshold: int=-1, max_repeats: int=-1, window_size: int=-1,
                  token_check_interval: int=-1):
@@ -8,9 +16,46 @@ class GenerationGuard:
         self.token_check_interval = token_check_interval
 
         self.current_chunk_count = 0
+        # Removes the oldest token from the window hash
+        self._oldest_token_factor = pow(_HASH_BASE, max(self.window_size - 1, 0), _HASH_MODULUS)
         self.check_token_buffer = []
         self.think_state = False
 
+    @property
+    def check_token_buffer(self) -> List[str]:
+        # Only the latest window is kept, older tokens live on in the window counts
+        return list(self._window_tokens)
+
+    @check_token_buffer.setter
+    def check_token_buffer(self, tokens: List[str]):
+        self._window: Deque[int] = deque()
+        self._window_tokens: Deque[str] = deque()
+        self._window_hash = 0
+        self._token_ids: Dict[str, int] = {}
+        self._window_counts: Dict[int, int] = {}
+        self._max_window_count = 0
+        self._buffer_length = 0
+        for token in tokens:
+            self._push(token)
+
+    def _push(self, token: str):
+        self._buffer_length += 1
+        if self.window_size <= 0 or self.max_repeats < 0 or self._max_window_count >= self.max_repeats:
+            # Disabled, or already repeated enough, counting further can not change the answer
+            return
+        token_id = self._token_ids.setdefault(token, len(self._token_ids) + 1)
+        if len(self._window) == self.window_size:
+            self._window_tokens.popleft()
+            oldest_id = self._window.popleft()
+            self._window_hash = (self._window_hash - oldest_id * self._oldest_token_factor) % _HASH_MODULUS
+        self._window.append(token_id)
+        self._window_tokens.append(token)
+        self._window_hash = (self._window_hash * _HASH_BASE + token_id) % _HASH_MODULUS
+        if len(self._window) == self.window_size:
+            count = self._window_counts.get(self._window_hash, 0) + 1
+            self._window_counts[self._window_hash] = count
+            self._max_window_count = max(self._max_window_count, count)
+
     # Clears the slate for token threshold
     def think_content_switch(self, think_token, content_token):
         if len(think_token)>0 and len(content_token)==0 and self.think_state==False:
@@ -23,26 +68,19 @@ class GenerationGuard:
     def accumulate_tokens(self, token: str):
         self.current_chunk_count += 1
         if self.current_chunk_count > self.safe_token_threshold >= 0:
-            self.check_token_buffer.append(token)
+            self._push(token)
 
     def _is_check_interval(self):
         return self.current_chunk_count % self.token_check_interval == 0
 
     def is_infinite_generation(self) -> bool:
-        if len(self.check_token_buffer) < self.window_size * self.max_repeats\
+        if self._buffer_length < self.window_size * self.max_repeats\
                 or self.max_repeats<0 \
                 or self.window_size<0 \
                 or not self._is_check_interval():
             return False
-
-        # Convert list of tokens to sliding windows
-        sequence_counts = {}
-        for i in range(len(self.check_token_buffer) - self.window_size + 1):
-            seq = tuple(self.check_token_buffer[i:i + self.window_size])
-            sequence_counts[seq] = sequence_counts.get(seq, 0) + 1
-            if sequence_counts[seq] >= self.max_repeats:
-                return True  # Sequence repeated too many times
-        return False
+        # Some window of window_size tokens seen max_repeats times since the buffer was last cleared
+        return self._max_window_count >= self.max_repeats
 
     def message_infinite_loop(self):
         message_text = "\n\n"
@@ -0,0 +1,95 @@
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+from logger import logger
+
+# Document identity and folder hashes are stored in metadata and knowledge bases, they stay SHA-256
+IDENTITY_ALGORITHM = "sha256"
+# Resolved to the fastest available non-cryptographic hash, only for change detection of local files
+FAST_ALGORITHM = "fast"
+
+READ_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 16 * 1024 * 1024
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+_fast_algorithm: Optional[str] = None
+
+
+def fast_algorithm() -> str:
+    """
+    Name of the hash used for FAST_ALGORITHM: xxh3_128 or blake3 when installed. Otherwise sha256, which is
+    hardware-accelerated on most CPUs and faster than the other hashlib algorithms.
+    """
+    global _fast_algorithm
+    if _fast_algorithm is None:
+        try:
+            import xxhash
+            _fast_algorithm = "xxh3_128"
+        except ImportError:
+            try:
+                import blake3
+                _fast_algorithm = "blake3"
+            except ImportError:
+                _fast_algorithm = IDENTITY_ALGORITHM
+    return _fast_algorithm
+
+
+def new_hash(algorithm: str = IDENTITY_ALGORITHM):
+    if algorithm == FAST_ALGORITHM:
+        algorithm = fast_algorithm()
+    if algorithm == "xxh3_128":
+        import xxhash
+        return xxhash.xxh3_128()
+    if algorithm == "blake3":
+        import blake3
+        return blake3.blake3()
+    return hashlib.new(algorithm)
+
+
+def is_available(algorithm: str) -> bool:
+    try:
+        new_hash(algorithm)
+        return True
+    except (ImportError, ValueError):
+        return False
+
+
+def hash_file(file_path: str, algorithm: str = IDENTITY_ALGORITHM) -> str:
+    """
+    Hash of a file's contents. Large files are memory-mapped, others are read in READ_SIZE chunks into one buffer.
+    hashlib releases the GIL while hashing, so files hashed from several threads are hashed in parallel.
+    """
+    hash_func = new_hash(algorithm)
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hash_func.update(mapped)
+        else:
+            buffer = bytearray(min(READ_SIZE, max(size, 1)))
+            view = memoryview(buffer)
+            while read := file.readinto(buffer):
+                hash_func.update(view[:read])
+    return hash_func.hexdigest()
+
+
+def _hash_file_or_none(file_path: str, algorithm: str) -> Optional[str]:
+    try:
+        return hash_file(file_path, algorithm)
+    except OSError as e:
+        logger.error(f"Could not hash {file_path}. Error: {e}")
+        return None
+
+
+def hash_files(file_paths: Iterable[str], algorithm: str = IDENTITY_ALGORITHM,
+               workers: int = DEFAULT_WORKERS) -> Dict[str, Optional[str]]:
+    """File path -> hash, None for files that could not be read. Files are hashed on up to workers threads."""
+    file_paths = list(file_paths)
+    if workers <= 1 or len(file_paths) <= 1:
+        return {x: _hash_file_or_none(x, algorithm) for x in file_paths}
+    with ThreadPoolExecutor(max_workers=min(workers, len(file_paths)), thread_name_prefix="hash") as executor:
+        hashes = executor.map(lambda x: _hash_file_or_none(x, algorithm), file_paths)
+        return dict(zip(file_paths, hashes))
@@ -0,0 +1,481 @@
+import itertools
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from convertors.convertor import Convertor
+from convertors.convertor_result import ConvertorResult
+from convertors.document_file import DocumentFile
+from convertors.document_image_convertor import DocumentImageConvertor
+from convertors.llm_contexts import DocumentContext
+from kb.knowledge_base import KnowledgeBase
+from logger import logger
+from settings import RAGSettings
+
+# Returned by a stage handler when the item is parked and will be handed back with StagedPipeline.resume
+HOLD = "hold"
+# Returned by a stage handler that already handed the item on with StagedPipeline.forward
+FORWARDED = "forwarded"
+
+POLL_INTERVAL_S = 0.1
+
+
+class PipelineStage:
+    def __init__(self, name: str, handler: Callable[[Any], Optional[str]], workers: int = 1, queue_size: int = 0):
+        self.name = name
+        # Handler returns the name of the next stage, None when the item is finished or HOLD
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self.queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        self.lock = threading.Lock()
+        self.in_progress = 0
+        self.processed = 0
+        self.failed = 0
+        self.busy_s = 0.0
+
+    def stats(self, elapsed_s: float) -> dict:
+        with self.lock:
+            return {
+                "stage": self.name,
+                "workers": self.workers,
+                "queue_depth": self.queue.qsize(),
+                "queue_size": self.queue_size,
+                "in_progress": self.in_progress,
+                "processed": self.processed,
+                "failed": self.failed,
+                "items_per_min": round(self.processed * 60 / elapsed_s, 2) if elapsed_s > 0 else 0.0,
+                "avg_duration_s": round(self.busy_s / self.processed, 3) if self.processed > 0 else 0.0,
+            }
+
+
+class PageStream:
+    """
+    Pages of one document passed from a stage to the next one while the first stage is still producing them.
+    put blocks while size pages are waiting, so the producer only works ahead as far as the buffer allows.
+    """
+    _END = object()
+
+    def __init__(self, size: int):
+        self.queue: queue.Queue = queue.Queue(maxsize=max(1, size))
+        self.abandoned = threading.Event()
+        self.error: Optional[BaseException] = None
+
+    def put(self, page: Any) -> bool:
+        # False once the reading side has given up, the producer stops then
+        while not self.abandoned.is_set():
+            try:
+                self.queue.put(page, timeout=POLL_INTERVAL_S)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self, error: Optional[BaseException] = None):
+        self.error = error
+        self.put(PageStream._END)
+
+    def abandon(self):
+        self.abandoned.set()
+
+    def __iter__(self):
+        while True:
+            if self.abandoned.is_set():
+                raise InterruptedError("Page stream was abandoned")
+            try:
+                page = self.queue.get(timeout=POLL_INTERVAL_S)
+            except queue.Empty:
+                continue
+            if page is PageStream._END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield page
+
+
+class StagedPipeline:
+    """
+    Runs items through stages connected by bounded queues, every stage with its own worker threads.
+    A worker blocks when the next stage's queue is full, so fast stages can only work ahead as far as the queues allow.
+    At most max_in_flight items are inside the pipeline at once.
+    """
+    def __init__(self, stages: List[PipelineStage], max_in_flight: int, checkpoint: Callable[[], None],
+                 on_finish: Callable[[Any, bool], None] = None, on_drop: Callable[[Any], None] = None):
+        self.stages: Dict[str, PipelineStage] = {stage.name: stage for stage in stages}
+        self.entry_stage = stages[0]
+        self.max_in_flight = max(1, max_in_flight)
+        self.checkpoint = checkpoint
+        self.on_finish = on_finish
+        self.on_drop = on_drop
+        self.in_flight = threading.Semaphore(self.max_in_flight)
+        self.pending = 0
+        self.pending_lock = threading.Condition()
+        self.stopped = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.started: Optional[float] = None
+
+    def stats(self) -> List[dict]:
+        elapsed_s = 0.0 if self.started is None else time.perf_counter() - self.started
+        return [stage.stats(elapsed_s) for stage in self.stages.values()]
+
+    def run(self, items: Iterable[Any]):
+        self.started = time.perf_counter()
+        threads = []
+        for stage in self.stages.values():
+            for worker_num in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage,), name=f"kb_{stage.name}_{worker_num}",
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+        try:
+            for item in items:
+                while not self.in_flight.acquire(timeout=POLL_INTERVAL_S):
+                    self._check()
+                self._check()
+                with self.pending_lock:
+                    self.pending += 1
+                self._put(self.entry_stage, item)
+            with self.pending_lock:
+                while self.pending > 0:
+                    self.pending_lock.wait(POLL_INTERVAL_S)
+                    self._check()
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            for stage in self.stages.values():
+                while not stage.queue.empty():
+                    self._drop(stage.queue.get_nowait())
+        if self.error is not None:
+            raise self.error
+
+    def resume(self, item: Any):
+        # Parked items keep their in-flight slot, the entry queue is never bounded by a stage limit
+        self.entry_stage.queue.put(item)
+
+    def forward(self, stage_name: str, item: Any):
+        # Hands the item on before its handler returns, the handler then returns FORWARDED
+        self._put(self.stages[stage_name], item)
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+        self.checkpoint()
+
+    def _put(self, stage: PipelineStage, item: Any):
+        while True:
+            if self.stopped.is_set() or self.error is not None:
+                self._drop(item)
+                return
+            try:
+                stage.queue.put(item, timeout=POLL_INTERVAL_S)
+                return
+            except queue.Full:
+                continue
+
+    def _drop(self, item: Any):
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    def _finish(self, item: Any, ok: bool):
+        try:
+            if self.on_finish is not None:
+                self.on_finish(item, ok)
+        finally:
+            self.in_flight.release()
+            with self.pending_lock:
+                self.pending -= 1
+                self.pending_lock.notify_all()
+
+    def _work(self, stage: PipelineStage):
+        while not self.stopped.is_set():
+            try:
+                item = stage.queue.get(timeout=POLL_INTERVAL_S)
+            except queue.Empty:
+                continue
+            if self.error is not None:
+                self._drop(item)
+                continue
+            with stage.lock:
+                stage.in_progress += 1
+            started = time.perf_counter()
+            ok = True
+            next_stage = None
+            try:
+                next_stage = stage.handler(item)
+            except InterruptedError as e:
+                self.error = e
+                self._drop(item)
+                continue
+            except Exception as e:
+                logger.error(f"[{stage.name}] {e}")
+                ok = False
+            finally:
+                with stage.lock:
+                    stage.in_progress -= 1
+                    stage.busy_s += time.perf_counter() - started
+                    if ok:
+                        stage.processed += 1
+                    else:
+                        stage.failed += 1
+            if next_stage in [HOLD, FORWARDED]:
+                continue
+            if next_stage is None:
+                self._finish(item, ok)
+            else:
+                self._put(self.stages[next_stage], item)
+
+
+class DocumentJob:
+    def __init__(self, document_path: str, doc_num: int):
+        self.document_path = document_path
+        self.doc_num = doc_num
+        self.document: Optional[DocumentFile] = None
+        self.claimed = False
+        self.convertor_index = 0
+        self.images: Optional[PageStream] = None
+        # Image path -> OCR text, filled by the OCR stage before the page is passed on
+        self.ocr_texts: Optional[Dict[str, Optional[str]]] = None
+        self.text_pages: Optional[Dict[int, str]] = None
+        self.convertor_result: Optional[ConvertorResult] = None
+        # None means the knowledge base stores convertor results on its own
+        self.chunks = None
+        self.embeddings: Optional[List[List[float]]] = None
+        self.ok = False
+
+
+class DocumentPipeline:
+    """
+    Knowledge base ingestion split into prepare -> render -> ocr -> transcribe -> chunk -> embed -> store stages.
+    Rendered pages stream into the OCR stage and on into transcription through PageStreams of page_buffer pages,
+    so the first pages are converted while the rest of the document is still rendering. Only convertors with an OCR
+    step go through the OCR stage.
+    Conversions already in processed/ skip straight to chunking, failed conversions go back to prepare
+    to try the next convertor.
+    """
+    STAGES = ["prepare", "render", "ocr", "transcribe", "chunk", "embed", "store"]
+
+    def __init__(self, service, kb: KnowledgeBase, convertors: List[Convertor], document_context: DocumentContext,
+                 rag_settings: RAGSettings, stage_settings: Dict[str, dict], max_in_flight: int,
+                 checkpoint: Callable[[], None], on_finish: Callable[[DocumentJob], None] = None,
+                 page_buffer: int = 4):
+        self.service = service
+        self.kb = kb
+        self.convertors = convertors
+        self.document_context = document_context
+        self.rag_settings = rag_settings
+        self.checkpoint = checkpoint
+        self.job_finished = on_finish
+        self.page_buffer = page_buffer
+        self.embedding = None
+        self.embedding_lock = threading.Lock()
+        # Documents with the same file hash share processed/ folders, only one of them goes through at a time
+        self.hash_lock = threading.Lock()
+        self.active_hashes: Dict[str, DocumentJob] = {}
+        self.held: Dict[str, List[DocumentJob]] = {}
+        stages = [PipelineStage(name, getattr(self, name), **stage_settings.get(name, {}))
+                  for name in DocumentPipeline.STAGES]
+        self.pipeline = StagedPipeline(stages, max_in_flight, checkpoint, on_finish=self._finish,
+                                       on_drop=self._drop)
+
+    def run(self, documents: List[str]):
+        self.pipeline.run(DocumentJob(document_path, doc_num) for doc_num, document_path in enumerate(documents, 1))
+
+    def stats(self) -> List[dict]:
+        return self.pipeline.stats()
+
+    def _get_embedding(self):
+        with self.embedding_lock:
+            if self.embedding is None:
+                self.embedding = self.kb.create_document_embedding(self.service.llm_runner.get_embedding)
+            return self.embedding
+
+    def _next_convertor(self, job: DocumentJob) -> str:
+        job.convertor_index += 1
+        job.images = None
+        job.ocr_texts = None
+        job.text_pages = None
+        job.convertor_result = None
+        return "prepare"
+
+    def _mark_done(self, job: DocumentJob):
+        with self.service._get_lock(self.service.kb_locks, self.kb.full_name):
+            self.kb.update_checked(job.document)
+        with self.service.doc_source_cache_lock:
+            self.service.doc_source.update_cache(job.document)
+        job.ok = True
+
+    def prepare(self, job: DocumentJob) -> Optional[str]:
+        self.checkpoint()
+        if job.document is None:
+            job.document = self.service.doc_source.get(job.document_path)
+            if job.document is None:
+                logger.warning(f"Could not get document {job.document_path}")
+                return None
+        if not job.claimed:
+            with self.hash_lock:
+                if job.document.file_hash in self.active_hashes:
+                    self.held.setdefault(job.document.file_hash, []).append(job)
+                    return HOLD
+                self.active_hashes[job.document.file_hash] = job
+            job.claimed = True
+            # Same content is already in the knowledge base, only the document path is added
+            if self.kb.has_full_document(self.service.llm_runner.get_embedding, job.document):
+                with self.service._get_lock(self.service.kb_locks, self.kb.full_name):
+                    self.kb.add_doc_path(self.service.llm_runner.get_embedding, job.document)
+                self._mark_done(job)
+                return None
+        while job.convertor_index < len(self.convertors):
+            convertor = self.convertors[job.convertor_index]
+            if isinstance(convertor, DocumentImageConvertor) and not job.document.image_based:
+                job.convertor_index += 1
+                continue
+            conversion = convertor.get_or_init_conversion(job.document)
+            if len(conversion.pages) > 0:
+                job.convertor_result = conversion
+                return "chunk"
+            return "render" if isinstance(convertor, DocumentImageConvertor) else "transcribe"
+        logger.error(f"Could not convert document {job.document.file_path}")
+        return None
+
+    def render(self, job: DocumentJob) -> Optional[str]:
+        self.checkpoint()
+        convertor: DocumentImageConvertor = self.convertors[job.convertor_index]
+        try:
+            # Pages with a usable text layer or converted by an interrupted run are not rendered
+            job.text_pages, image_pages = convertor.plan_pages(job.document, self.document_context)
+        except Exception as e:
+            logger.error(f"Image conversion failed. File: {job.document.file_name}. Error: {e}")
+            job.document.cleanup_temp_files()
+            return self._next_convertor(job)
+        pages = PageStream(self.page_buffer)
+        job.images = pages
+        self.pipeline.forward("ocr" if convertor.has_ocr_step() else "transcribe", job)
+        try:
+            for image_path in job.document.iter_document_images(self.document_context.pdf_render_settings,
+                                                                image_pages):
+                self.checkpoint()
+                if not pages.put(image_path):
+                    break
+            pages.close()
+        except Exception as e:
+            if not isinstance(e, InterruptedError):
+                logger.error(f"Image conversion failed. File: {job.document.file_name}. Error: {e}")
+            # The reading stage fails the conversion and moves on to the next convertor
+            pages.close(e)
+        return FORWARDED
+
+    def ocr(self, job: DocumentJob) -> Optional[str]:
+        self.checkpoint()
+        convertor: DocumentImageConvertor = self.convertors[job.convertor_index]
+        rendered = job.images
+        pages = PageStream(self.page_buffer)
+        job.ocr_texts = {}
+        job.images = pages
+        self.pipeline.forward("transcribe", job)
+        try:
+            batch_size = convertor.ocr_batch_size(self.document_context)
+            batch = []
+            for image_path in itertools.chain(rendered, [None]):
+                if image_path is not None:
+                    batch.append(image_path)
+                    if len(batch) < batch_size:
+                        continue
+                if len(batch) == 0:
+                    continue
+                for batch_image_path, text in zip(batch, convertor.ocr_images(batch, self.document_context)):
+                    job.ocr_texts[batch_image_path] = text
+                    if not pages.put(batch_image_path):
+                        rendered.abandon()
+                        return FORWARDED
+                batch = []
+            pages.close()
+        except Exception as e:
+            if not isinstance(e, InterruptedError):
+                logger.error(f"OCR failed. File: {job.document.file_name}. Error: {e}")
+            rendered.abandon()
+            pages.close(e)
+        return FORWARDED
+
+    def transcribe(self, job: DocumentJob) -> Optional[str]:
+        self.checkpoint()
+        convertor = self.convertors[job.convertor_index]
+        if isinstance(convertor, DocumentImageConvertor):
+            metadata = job.document.get_or_init_metadata()
+            pages = job.images
+            try:
+                convertor_result = convertor.convert_image_document(job.document, metadata, self.document_context,
+                                                                    images=pages, text_pages=job.text_pages,
+                                                                    ocr_texts=job.ocr_texts)
+            finally:
+                # Earlier stages stop producing pages when the conversion ended early
+                pages.abandon()
+            # convert_image_document removes the rendered pages
+            job.images = None
+            job.ocr_texts = None
+        else:
+            convertor_result = convertor.convert(job.document, self.document_context)
+        if convertor_result is None:
+            return self._next_convertor(job)
+        job.convertor_result = convertor_result
+        return "chunk"
+
+    def chunk(self, job: DocumentJob) -> Optional[str]:
+        self.checkpoint()
+        job.chunks = self.kb.prepare_chunks(self.service.llm_runner.get_embedding, job.convertor_result,
+                                            self.rag_settings)
+        if job.chunks is None or len(job.chunks) == 0:
+            return "store"
+        return "embed"
+
+    def embed(self, job: DocumentJob) -> Optional[str]:
+        self.checkpoint()
+        embedding = self._get_embedding()
+        if embedding is None:
+            logger.error(f"Could not get embedding from model {self.kb.embedding_config.get("model")}")
+            return None
+        job.embeddings = embedding.embed_documents([chunk.page_content for chunk in job.chunks])
+        return "store"
+
+    def store(self, job: DocumentJob) -> Optional[str]:
+        self.checkpoint()
+        self.kb.set_coverage(job.document.file_hash, KnowledgeBase.COVERAGE_PARTIAL)
+        if job.chunks is None:
+            self.kb.store_convertor_result(self.service.llm_runner.get_embedding, job.convertor_result,
+                                           self.rag_settings)
+        elif len(job.chunks) > 0:
+            self.kb.store_chunks(self.service.llm_runner.get_embedding, job.chunks, job.embeddings)
+        self._mark_done(job)
+        # Chunks and vectors are not needed anymore, release them while duplicates are still in flight
+        job.chunks = None
+        job.embeddings = None
+        return None
+
+    def _release(self, job: DocumentJob):
+        if not job.claimed:
+            return
+        with self.hash_lock:
+            self.active_hashes.pop(job.document.file_hash, None)
+            held = self.held.pop(job.document.file_hash, [])
+        if len(held) > 0:
+            # The next duplicate claims the hash, the rest are held again behind it
+            for held_job in held:
+                self.pipeline.resume(held_job)
+
+    def _finish(self, job: DocumentJob, ok: bool):
+        job.ok = job.ok and ok
+        self._drop(job)
+        self._release(job)
+        if self.job_finished is not None:
+            self.job_finished(job)
+
+    def _drop(self, job: DocumentJob):
+        if job.images is not None:
+            job.images.abandon()
+            job.images = None
+            if job.document is not None:
+                job.document.cleanup_temp_files()
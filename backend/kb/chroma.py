@@ -3,11 +3,15 @@ import json
 import os
 import re
 import shutil
+import threading
+import time
 import uuid
 from pathlib import Path
-from typing import Callable, List, Tuple, Dict, Any, Optional
+from typing import Callable, List, Tuple, Dict, Any, Optional, Union
 
+import numpy as np
 from chromadb import ClientAPI, PersistentClient
+from chromadb.api.models.Collection import Collection
 from langchain_chroma import Chroma
 from langchain_community.document_loaders import DirectoryLoader, TextLoader
 from langchain_core.documents import Document
@@ -16,23 +20,59 @@ from langchain_text_splitters import CharacterTextSplitter
 
 from convertors.convertor_result import ConvertorResult
 from convertors.document_file import DocumentFile
+from kb.embedding_cache import embedding_key
+from kb.hybrid_search import LexicalIndex, drop_lexical_index, get_lexical_index, reciprocal_rank_fusion, \
+    record_lookup
 from kb.knowledge_base import KnowledgeBase, KBStore
+from kb.retrieval_cache import bump_kb_version
 from logger import logger
-from settings import RAGSettings
+from settings import RAGSettings, EmbeddingSettings
+
+
+class ChromaHandle:
+    """
+    Embedding, collection and vectorstore of one knowledge base, built once and reused by every lookup and check.
+    """
+    def __init__(self, client: ClientAPI, signature: tuple, embeddings: Embeddings, collection: Collection,
+                 vectorstore: Chroma):
+        self.client = client
+        self.signature = signature
+        self.embeddings = embeddings
+        self.collection = collection
+        self.vectorstore = vectorstore
+
+
+_handles: Dict[Tuple[int, str], ChromaHandle] = {}
+_handles_lock = threading.Lock()
+
+
+# Lexical index file -> thread adding the chunks stored before the index existed
+_lexical_backfills: Dict[str, threading.Thread] = {}
+_lexical_backfills_lock = threading.Lock()
+
+
+def invalidate_chroma_handle(client: ClientAPI, cleaned_name: str):
+    with _handles_lock:
+        _handles.pop((id(client), cleaned_name), None)
 
 
 class ChromaKnowledgeBase(KnowledgeBase):
-    def __init__(self, kb_dict: dict, base_path: str, client: ClientAPI):
-        super().__init__(kb_dict)
+    def __init__(self, kb_dict: dict, base_path: str, client: ClientAPI,
+                 embedding_settings: Optional[EmbeddingSettings] = None):
+        super().__init__(kb_dict, embedding_settings)
         self.client = client
         self.base_path = base_path
         self.config_path = os.path.join(base_path, "config.json")
         self.cleaned_name = os.path.split(base_path)[-1]
-        self.cache_file = os.path.join(base_path, "kb_check_cache.json")
+        self.cache_file = os.path.join(base_path, "kb_check_cache.sqlite3")
+        self.lexical_index_file = os.path.join(base_path, "lexical_index.sqlite3")
 
     def clear(self) -> bool:
         from chromadb.errors import NotFoundError
         super().clear()
+        invalidate_chroma_handle(self.client, self.cleaned_name)
+        drop_lexical_index(self.lexical_index_file)
+        bump_kb_version(self.content_key())
         try:
             # fails if collection does not exist
             self.client.delete_collection(self.cleaned_name)
@@ -40,22 +80,211 @@ class ChromaKnowledgeBase(KnowledgeBase):
         except NotFoundError:
             return False
 
-    def _make_chroma(self, embedding_source: Callable[[dict], Embeddings]) -> Chroma:
-        embeddings = self._create_embedding(embedding_source)
+    def _handle_signature(self, embedding_source: Callable[[dict], Embeddings]) -> tuple:
+        # Anything that changes the embedding function makes a new handle
+        return (embedding_source, embedding_key(self.embedding_config), self.embedding_settings.batch_size,
+                self.embedding_settings.cache)
+
+    def _get_handle(self, embedding_source: Callable[[dict], Embeddings]) -> ChromaHandle:
+        key = (id(self.client), self.cleaned_name)
+        signature = self._handle_signature(embedding_source)
+        with _handles_lock:
+            handle = _handles.get(key)
+        # Holding the client in the handle keeps its id from being reused by another client
+        if handle is not None and handle.client is self.client and handle.signature == signature:
+            return handle
+        embeddings = self.create_document_embedding(embedding_source)
         if embeddings is None:
             logger.error(f"Could not get embedding from model {self.embedding_config["model"]}")
         # ensure the collection exists
-        self.client.get_or_create_collection(self.cleaned_name)
-        return Chroma(client=self.client,
-                      collection_name=self.cleaned_name,
-                      embedding_function=embeddings)
-
-    def rag_lookup(self, embedding_source: Callable[[dict], Embeddings], query: str, document_count: int) -> List[
-        Tuple[Document, float]]:
-        vectorstore = self._make_chroma(embedding_source)
-        relevant_documents = vectorstore.similarity_search_with_score(
-            query=query, k=document_count,
+        collection = self.client.get_or_create_collection(self.cleaned_name)
+        handle = ChromaHandle(self.client, signature, embeddings, collection,
+                              Chroma(client=self.client,
+                                     collection_name=self.cleaned_name,
+                                     embedding_function=embeddings))
+        if embeddings is not None:
+            # Failed embeddings are retried on the next call
+            with _handles_lock:
+                _handles[key] = handle
+        return handle
+
+    def _make_chroma(self, embedding_source: Callable[[dict], Embeddings]) -> Chroma:
+        return self._get_handle(embedding_source).vectorstore
+
+    def content_key(self) -> str:
+        return os.path.abspath(self.base_path)
+
+    def _lexical_index(self) -> Optional[LexicalIndex]:
+        try:
+            return get_lexical_index(self.lexical_index_file)
+        except Exception as e:
+            logger.error(f"Could not open lexical index {self.lexical_index_file}. Error: {e}")
+            return None
+
+    def _index_chunks(self, ids: List[str], chunks: List[Document]):
+        lexical_index = self._lexical_index()
+        if lexical_index is None:
+            return
+        try:
+            # Chunks without an id got a new uuid, there is no earlier text of theirs to replace
+            lexical_index.add(zip(ids, [x.page_content for x in chunks]),
+                              replace=any(x.id is not None for x in chunks))
+        except Exception as e:
+            logger.error(f"Could not add chunks to lexical index {self.lexical_index_file}. Error: {e}")
+
+    def _complete_lexical_index(self, collection: Collection, lexical_index: LexicalIndex, batch_size: int = 1000):
+        # Chunks stored before the knowledge base had a lexical index are added once
+        try:
+            if lexical_index.is_complete():
+                return
+            if lexical_index.count() >= collection.count():
+                lexical_index.set_complete()
+                return
+            logger.info(f"Building lexical index of knowledge base {self.name}...")
+            offset = 0
+            while True:
+                existing = collection.get(include=["documents"], limit=batch_size, offset=offset)
+                if len(existing["ids"]) == 0:
+                    break
+                lexical_index.add(zip(existing["ids"], existing["documents"]))
+                offset += len(existing["ids"])
+            lexical_index.set_complete()
+            logger.info(f"Lexical index of knowledge base {self.name} has {offset} chunks")
+        except Exception as e:
+            logger.error(f"Could not build lexical index of knowledge base {self.name}. Error: {e}")
+
+    def _start_lexical_backfill(self, collection: Collection, lexical_index: LexicalIndex):
+        # Lookups do not wait for the backfill, they search the chunks indexed so far
+        if lexical_index.is_complete():
+            return
+        with _lexical_backfills_lock:
+            thread = _lexical_backfills.get(lexical_index.db_file)
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(target=self._complete_lexical_index, args=(collection, lexical_index),
+                                      name=f"lexical_backfill_{self.cleaned_name}", daemon=True)
+            _lexical_backfills[lexical_index.db_file] = thread
+            thread.start()
+
+    @staticmethod
+    def _distance(space: str, query_vector: List[float], vector: List[float]) -> float:
+        # Same distances as the collection reports for its vector results
+        query_vector = np.asarray(query_vector, dtype=np.float64)
+        vector = np.asarray(vector, dtype=np.float64)
+        if space == "cosine":
+            norm = np.linalg.norm(query_vector) * np.linalg.norm(vector)
+            return float(1.0 - query_vector @ vector / norm) if norm > 0 else 1.0
+        if space == "ip":
+            return float(1.0 - query_vector @ vector)
+        return float(np.sum((query_vector - vector) ** 2))
+
+    def rag_lookup(self, embedding_source: Callable[[dict], Embeddings], query: str, document_count: int,
+                   include_embeddings: bool = False, rag_settings: Optional[RAGSettings] = None
+                   ) -> List[Union[Tuple[Document, float], Tuple[Document, float, Any]]]:
+        if rag_settings is not None and rag_settings.rag_hybrid_search:
+            return self._hybrid_lookup(embedding_source, query, document_count, include_embeddings, rag_settings)
+        started = time.perf_counter()
+        if not include_embeddings:
+            vectorstore = self._make_chroma(embedding_source)
+            relevant_documents = vectorstore.similarity_search_with_score(
+                query=query, k=document_count,
+            )
+            record_lookup({"vector": time.perf_counter() - started, "total": time.perf_counter() - started}, False)
+            return relevant_documents
+        handle = self._get_handle(embedding_source)
+        if handle.embeddings is None:
+            return []
+        query_vector = handle.embeddings.embed_query(query)
+        embedded = time.perf_counter()
+        # Stored vectors come back with the documents, so they do not need to be embedded again for reranking
+        results = handle.collection.query(
+            query_embeddings=[query_vector],
+            n_results=document_count,
+            include=["documents", "metadatas", "distances", "embeddings"],
         )
+        finished = time.perf_counter()
+        record_lookup({"embed": embedded - started, "vector": finished - embedded, "total": finished - started}, False)
+        return [
+            (Document(page_content=content, metadata=metadata or {}, id=chroma_id), distance, vector)
+            for content, metadata, chroma_id, distance, vector in zip(
+                results["documents"][0],
+                results["metadatas"][0],
+                results["ids"][0],
+                results["distances"][0],
+                results["embeddings"][0],
+            )
+        ]
+
+    def _hybrid_lookup(self, embedding_source: Callable[[dict], Embeddings], query: str, document_count: int,
+                       include_embeddings: bool, rag_settings: RAGSettings
+                       ) -> List[Union[Tuple[Document, float], Tuple[Document, float, Any]]]:
+        """
+        Vector and BM25 results fused with reciprocal rank fusion. Every result keeps its vector distance, chunks
+        found only by their terms get it computed from their stored vector, so reranking treats both alike.
+        """
+        timings = {}
+        started = time.perf_counter()
+        handle = self._get_handle(embedding_source)
+        if handle.embeddings is None:
+            return []
+        query_vector = handle.embeddings.embed_query(query)
+        timings["embed"] = time.perf_counter() - started
+
+        step = time.perf_counter()
+        results = handle.collection.query(
+            query_embeddings=[query_vector],
+            n_results=document_count,
+            include=["documents", "metadatas", "distances", "embeddings"],
+        )
+        hits = {
+            chroma_id: (Document(page_content=content, metadata=metadata or {}, id=chroma_id), distance, vector)
+            for content, metadata, chroma_id, distance, vector in zip(
+                results["documents"][0],
+                results["metadatas"][0],
+                results["ids"][0],
+                results["distances"][0],
+                results["embeddings"][0],
+            )
+        }
+        vector_ranking = results["ids"][0]
+        timings["vector"] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        lexical_ranking = []
+        lexical_index = self._lexical_index()
+        if lexical_index is not None:
+            try:
+                self._start_lexical_backfill(handle.collection, lexical_index)
+                lexical_count = rag_settings.rag_lexical_document_count or document_count
+                lexical_ranking = [x[0] for x in lexical_index.search(query, lexical_count)]
+            except Exception as e:
+                logger.error(f"Lexical lookup in knowledge base {self.name} failed. Error: {e}")
+        timings["lexical"] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        missing = [x for x in lexical_ranking if x not in hits]
+        if len(missing) > 0:
+            space = (handle.collection.metadata or {}).get("hnsw:space", "l2")
+            existing = handle.collection.get(ids=missing, include=["documents", "metadatas", "embeddings"])
+            for chroma_id, content, metadata, vector in zip(existing["ids"], existing["documents"],
+                                                            existing["metadatas"], existing["embeddings"]):
+                hits[chroma_id] = (Document(page_content=content, metadata=metadata or {}, id=chroma_id),
+                                   self._distance(space, query_vector, vector), vector)
+        timings["fetch"] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        # Chunks removed from the collection may still be in the lexical index until it is rebuilt
+        lexical_ranking = [x for x in lexical_ranking if x in hits]
+        fused = reciprocal_rank_fusion([vector_ranking, lexical_ranking], rag_settings.rag_rrf_k)[:document_count]
+        relevant_documents = [hits[chroma_id] if include_embeddings else hits[chroma_id][:2]
+                              for chroma_id, _ in fused]
+        timings["fusion"] = time.perf_counter() - step
+        timings["total"] = time.perf_counter() - started
+
+        record_lookup(timings, True)
+        lexical_only = len(set(lexical_ranking) - set(vector_ranking))
+        logger.info(f"Hybrid lookup in {self.name}: {len(relevant_documents)} chunks, {lexical_only} found by terms "
+                    f"only. " + ", ".join(f"{x} {y * 1000:.1f}ms" for x, y in timings.items()))
         return relevant_documents
 
     @staticmethod
@@ -96,11 +325,22 @@ class ChromaKnowledgeBase(KnowledgeBase):
         return chunks
 
     def store_convertor_result(self, embedding_source: Callable[[dict], Embeddings], convertor_result: ConvertorResult, rag_settings: RAGSettings):
+        to_database = self.prepare_chunks(embedding_source, convertor_result, rag_settings)
+        if len(to_database) > 0:
+            vector_database = self._make_chroma(embedding_source)
+            # Known ids let the lexical index refer to the same chunks
+            ids = [chunk.id if chunk.id is not None else str(uuid.uuid4()) for chunk in to_database]
+            vector_database.add_documents(to_database, ids=ids)
+            self._index_chunks(ids, to_database)
+            bump_kb_version(self.content_key())
+
+    def prepare_chunks(self, embedding_source: Callable[[dict], Embeddings], convertor_result: ConvertorResult,
+                       rag_settings: RAGSettings) -> List[Document]:
         document_metadata = convertor_result.document_metadata
         # Validating metadata vs actual folder contents
         valid_document_source = KnowledgeBase.validate_document_source(convertor_result)
         if not valid_document_source:
-            return
+            return []
 
         text_loader_kwargs = {'encoding': 'utf-8'}
 
@@ -108,7 +348,7 @@ class ChromaKnowledgeBase(KnowledgeBase):
         logger.info(f"Checking data...")
         data_exists = self.has_full_convertor_result(embedding_source, convertor_result)
         if data_exists:
-            return
+            return []
 
         logger.info(f"[{convertor_result.conversion_type}]Preparing data from {convertor_result.output_folder_name}...")
         loader = DirectoryLoader(
@@ -118,6 +358,7 @@ class ChromaKnowledgeBase(KnowledgeBase):
         folder_docs = loader.load()
         ChromaKnowledgeBase._add_metadata(folder_docs, document_metadata, convertor_result)
 
+        to_database = []
         if len(folder_docs) > 0:
             logger.info(f"[{convertor_result.conversion_type}]Preparing {len(folder_docs)} documents...")
             text_splitter = CharacterTextSplitter(
@@ -126,7 +367,6 @@ class ChromaKnowledgeBase(KnowledgeBase):
             )
             chunks = text_splitter.split_documents(folder_docs)
             ChromaKnowledgeBase._add_chunk_metadata(chunks)
-            to_database = []
             empty_strings = []
             for chunk in chunks:
                 if len(chunk.page_content) == 0:
@@ -135,9 +375,23 @@ class ChromaKnowledgeBase(KnowledgeBase):
                     to_database.append(chunk)
             if len(empty_strings) > 0:
                 logger.info(f"[{convertor_result.conversion_type}]Empty chunks: {empty_strings}")
-            if len(to_database) > 0:
-                vector_database = self._make_chroma(embedding_source)
-                vector_database.add_documents(to_database)
+        return to_database
+
+    def store_chunks(self, embedding_source: Callable[[dict], Embeddings], chunks: List[Document],
+                     embeddings: List[List[float]]):
+        if len(chunks) == 0:
+            return
+        # Embeddings were computed by the ingestion pipeline, writing straight to the collection skips embedding them again
+        collection = self._get_handle(embedding_source).collection
+        ids = [chunk.id if chunk.id is not None else str(uuid.uuid4()) for chunk in chunks]
+        collection.upsert(
+            ids=ids,
+            embeddings=embeddings,
+            metadatas=[chunk.metadata for chunk in chunks],
+            documents=[chunk.page_content for chunk in chunks],
+        )
+        self._index_chunks(ids, chunks)
+        bump_kb_version(self.content_key())
 
     def has_full_document(self, embedding_source: Callable[[dict], Embeddings], doc: DocumentFile,
                           force_check: bool = False) -> bool:
@@ -201,6 +455,8 @@ class ChromaKnowledgeBase(KnowledgeBase):
                 chroma_document.metadata = existing_data["metadatas"][index]
                 chroma_document.metadata["document_path"] = chroma_document.metadata["document_path"] + ";" + path
                 vector_database.update_document(chroma_id, chroma_document)
+            # Sources returned by lookups carry the document paths
+            bump_kb_version(self.content_key())
 
     def to_dict(self) -> dict:
         return {
@@ -215,8 +471,10 @@ DEFAULT_CHROMA_FOLDER = os.path.join("knowledge_bases", "chroma")
 
 
 class ChromaKBStore(KBStore):
-    def __init__(self, name: str = "chroma_store", kb_store_folder: str = DEFAULT_CHROMA_FOLDER):
+    def __init__(self, name: str = "chroma_store", kb_store_folder: str = DEFAULT_CHROMA_FOLDER,
+                 embedding_settings: Optional[EmbeddingSettings] = None):
         super().__init__("chroma", name, kb_store_folder)
+        self.embedding_settings = embedding_settings
         db_folder = os.path.join(kb_store_folder, "db")
         os.makedirs(db_folder, exist_ok=True)
         self.client = PersistentClient(db_folder)
@@ -249,7 +507,7 @@ class ChromaKBStore(KBStore):
             try:
                 with open(config_file_path, "r") as fh:
                     kb_config = json.load(fh)
-                    kb = ChromaKnowledgeBase(kb_config, base_path, self.client)
+                    kb = ChromaKnowledgeBase(kb_config, base_path, self.client, self.embedding_settings)
                     if kb is not None:
                         kbs[kb.name] = kb
             except Exception as e:
@@ -262,14 +520,14 @@ class ChromaKBStore(KBStore):
             # noinspection PyTypeChecker
             existing: ChromaKnowledgeBase = self.get(name)
             if existing is not None:
-                kb = ChromaKnowledgeBase(kb_config, existing.base_path, self.client)
+                kb = ChromaKnowledgeBase(kb_config, existing.base_path, self.client, self.embedding_settings)
                 # Delete existing if anything critical has changed
                 if existing.needs_refresh(kb):
                     logger.info(f"Knowledge base config has changed! Was {existing}, got {kb}. Clearing old one...")
                     existing.clear()
             else:
                 knowledge_base_path = self._kb_base_path(name)
-                kb = ChromaKnowledgeBase(kb_config, knowledge_base_path, self.client)
+                kb = ChromaKnowledgeBase(kb_config, knowledge_base_path, self.client, self.embedding_settings)
             self._save_kb_config(kb)
         except Exception as e:
             logger.error(f"Failed to upsert knowledge base. Error: {e}")
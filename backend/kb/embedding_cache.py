@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from array import array
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from logger import logger
+
+DEFAULT_EMBEDDING_CACHE_FILE = os.path.join(".cache", "embedding_cache", "embeddings.sqlite3")
+# Keeps "IN (...)" lookups under SQLite's variable limit
+LOOKUP_CHUNK_SIZE = 500
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def embedding_key(embedding_config: dict) -> str:
+    # Whole config, so a changed model parameter never reuses vectors of another one
+    return json.dumps(embedding_config, sort_keys=True)
+
+
+class EmbeddingCache:
+    """
+    On-disk vectors keyed by (embedding config, sha256 of the text). One file is shared by all knowledge bases.
+    """
+    def __init__(self, cache_file: str = DEFAULT_EMBEDDING_CACHE_FILE):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        self.connection = sqlite3.connect(cache_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, text_hash))"
+        )
+        self.connection.commit()
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        result = {}
+        unique_hashes = list(set(hashes))
+        with self.lock:
+            for start in range(0, len(unique_hashes), LOOKUP_CHUNK_SIZE):
+                chunk = unique_hashes[start:start + LOOKUP_CHUNK_SIZE]
+                rows = self.connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN "
+                    f"({",".join("?" * len(chunk))})",
+                    [model, *chunk]
+                ).fetchall()
+                for row_hash, vector in rows:
+                    result[row_hash] = array("d", vector).tolist()
+        return result
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(model, key, array("d", vector).tobytes()) for key, vector in vectors.items()]
+            )
+            self.connection.commit()
+
+    def count(self, model: Optional[str] = None) -> int:
+        with self.lock:
+            if model is None:
+                return self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return self.connection.execute("SELECT COUNT(*) FROM embeddings WHERE model = ?", [model]).fetchone()[0]
+
+
+_caches: Dict[str, EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(cache_file: str = DEFAULT_EMBEDDING_CACHE_FILE) -> EmbeddingCache:
+    key = os.path.abspath(cache_file)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = EmbeddingCache(cache_file)
+            _caches[key] = cache
+        return cache
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeds documents in batches of batch_size, texts found in the cache never reach the embedding model.
+    Queries are passed through.
+    """
+    def __init__(self, embeddings: Embeddings, model: str, batch_size: int = 32, cache: Optional[EmbeddingCache] = None):
+        self.embeddings = embeddings
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(x) for x in texts]
+        vectors: Dict[str, List[float]] = {}
+        if self.cache is not None:
+            try:
+                vectors = self.cache.get_many(self.model, hashes)
+            except Exception as e:
+                logger.error(f"Could not read embedding cache. Error: {e}")
+        # Identical texts are embedded once
+        missing: Dict[str, str] = {}
+        for key, text in zip(hashes, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        missing_keys = list(missing.keys())
+        for start in range(0, len(missing_keys), self.batch_size):
+            batch_keys = missing_keys[start:start + self.batch_size]
+            batch_vectors = self.embeddings.embed_documents([missing[x] for x in batch_keys])
+            new_vectors = dict(zip(batch_keys, batch_vectors))
+            vectors.update(new_vectors)
+            if self.cache is not None:
+                try:
+                    self.cache.put_many(self.model, new_vectors)
+                except Exception as e:
+                    logger.error(f"Could not write embedding cache. Error: {e}")
+        if len(texts) > 0:
+            logger.info(f"Embedded {len(missing_keys)} of {len(texts)} text(s), rest from cache")
+        return [vectors[x] for x in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
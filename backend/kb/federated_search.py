@@ -0,0 +1,118 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from kb.embedding_cache import embedding_key
+from kb.knowledge_base import KnowledgeBase
+from logger import logger
+from settings import RAGSettings
+
+MAX_LOOKUP_WORKERS = 8
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+# Knowledge base content key -> lookups still running after they timed out
+_stalled: Dict[str, int] = {}
+_stalled_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Shared and never waited on, lookups that time out finish in the background
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_LOOKUP_WORKERS, thread_name_prefix="kb_lookup")
+        return _executor
+
+
+def shares_embedding(kbs: List[KnowledgeBase]) -> bool:
+    # Distances and stored vectors of knowledge bases with one embedding config can be compared directly
+    return len(set(embedding_key(x.embedding_config) for x in kbs)) <= 1
+
+
+def is_stalled(kb: KnowledgeBase) -> bool:
+    with _stalled_lock:
+        return _stalled.get(kb.content_key(), 0) > 0
+
+
+def _mark_stalled(kb: KnowledgeBase, future: Future):
+    # Worker threads stuck on a slow knowledge base are not given more of its lookups until they finish
+    key = kb.content_key()
+    with _stalled_lock:
+        _stalled[key] = _stalled.get(key, 0) + 1
+
+    def finished(_):
+        with _stalled_lock:
+            _stalled[key] -= 1
+            if _stalled[key] <= 0:
+                del _stalled[key]
+
+    future.add_done_callback(finished)
+
+
+def _timed_lookup(kb: KnowledgeBase, *args) -> Tuple[list, float]:
+    started = time.perf_counter()
+    results = kb.rag_lookup(*args)
+    return results or [], time.perf_counter() - started
+
+
+def federated_rag_lookup(kbs: List[KnowledgeBase], embedding_source: Callable[[dict], Embeddings], query: str,
+                         document_count: int, rag_settings: RAGSettings, include_embeddings: bool = False
+                         ) -> Tuple[List[tuple], List[dict]]:
+    """
+    rag_lookup on every knowledge base at once, merged into one candidate list ordered by distance.
+    Knowledge bases that do not answer within rag_settings.rag_kb_timeout_s or fail are left out, so are knowledge
+    bases whose earlier lookup timed out and is still running.
+    When the knowledge bases use different embeddings, their distances can not be compared. Candidates are then
+    ordered by their rank within their knowledge base and keep their own distance, so the irrelevance threshold
+    still applies per model. Stored vectors are dropped, as they can not be compared across models either.
+    Returns the candidates and a report per knowledge base.
+    """
+    comparable = shares_embedding(kbs)
+    started = time.perf_counter()
+    report = []
+    futures: Dict[Future, KnowledgeBase] = {}
+    for kb in kbs:
+        if is_stalled(kb):
+            report.append({"knowledge_base": kb.name, "status": "busy", "count": 0})
+            logger.warning(f"Earlier lookup in knowledge base {kb.name} is still running, leaving it out")
+            continue
+        futures[_get_executor().submit(_timed_lookup, kb, embedding_source, query, document_count,
+                                       include_embeddings, rag_settings)] = kb
+    done, not_done = wait(futures, timeout=rag_settings.rag_kb_timeout_s) if len(futures) > 0 else (set(), set())
+    candidates = []
+    for future, kb in futures.items():
+        entry = {"knowledge_base": kb.name, "status": "ok", "count": 0}
+        if future in not_done:
+            if not future.cancel():
+                _mark_stalled(kb, future)
+            entry["status"] = "timeout"
+            logger.warning(f"Lookup in knowledge base {kb.name} did not finish in {rag_settings.rag_kb_timeout_s}s, "
+                           f"leaving it out")
+        elif future.exception() is not None:
+            entry["status"] = "error"
+            logger.error(f"Lookup in knowledge base {kb.name} failed. Error: {future.exception()}")
+        else:
+            results, duration_s = future.result()
+            entry["duration_ms"] = round(duration_s * 1000, 1)
+            if not comparable:
+                results = [(x[0], x[1], None) if len(x) > 2 else x for x in results]
+            for rank, result in enumerate(sorted(results, key=lambda x: x[1])):
+                # The merged sources still tell where they came from
+                document = result[0].model_copy(update={"metadata": {**result[0].metadata,
+                                                                     "knowledge_base": kb.name}})
+                candidates.append((rank, (document, *result[1:])))
+            entry["count"] = len(results)
+        report.append(entry)
+    if comparable:
+        candidates.sort(key=lambda x: x[1][1])
+    else:
+        candidates.sort(key=lambda x: (x[0], x[1][1]))
+    candidates = [x[1] for x in candidates]
+    logger.info(f"Federated lookup in {len(kbs)} knowledge bases: {len(candidates)} candidates in "
+                f"{(time.perf_counter() - started) * 1000:.1f}ms. {report}")
+    return candidates, report
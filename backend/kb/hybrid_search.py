@@ -0,0 +1,177 @@
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from logger import logger
+
+# Letters and digits, so "INV-2024/0012" is looked up as its parts
+TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+LOOKUP_COMPONENTS = ["embed", "vector", "lexical", "fetch", "fusion", "total"]
+
+
+def query_terms(query: str) -> List[str]:
+    terms = []
+    for term in TERM_PATTERN.findall(query.lower()):
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+
+class LexicalIndex:
+    """
+    BM25 index of the chunk texts of one knowledge base, an SQLite FTS5 table next to the knowledge base config.
+    Chunks are keyed by their vector store id, so lexical and vector results can be fused. The FTS5 table cannot
+    look up its UNINDEXED id column, chunk_rows maps ids to FTS5 rowids for replacing chunks.
+    """
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+            "content, chunk_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2');"
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS chunk_rows (chunk_id TEXT PRIMARY KEY, chunk_row INTEGER NOT NULL);"
+        )
+        with self.connection:
+            # Indexes made before chunk_rows existed get their rows mapped once
+            if self.connection.execute("SELECT 1 FROM state WHERE key = 'rows_mapped'").fetchone() is None:
+                self.connection.execute("INSERT OR REPLACE INTO chunk_rows SELECT chunk_id, rowid FROM chunks")
+                self.connection.execute("INSERT INTO state (key, value) VALUES ('rows_mapped', '1')")
+
+    def add(self, chunks: Iterable[Tuple[str, str]], replace: bool = True):
+        """
+        (chunk id, text) pairs, chunks stored again under the same id replace the earlier text.
+        replace=False skips looking for earlier texts, for ids that were just generated.
+        """
+        chunks = list(chunks)
+        with self.lock, self.connection:
+            if replace:
+                rows = []
+                for chunk_id, _ in chunks:
+                    row = self.connection.execute("SELECT chunk_row FROM chunk_rows WHERE chunk_id = ?",
+                                                  [chunk_id]).fetchone()
+                    if row is not None:
+                        rows.append(row)
+                self.connection.executemany("DELETE FROM chunks WHERE rowid = ?", rows)
+            for chunk_id, content in chunks:
+                row = self.connection.execute("INSERT INTO chunks (chunk_id, content) VALUES (?, ?)",
+                                              [chunk_id, content]).lastrowid
+                self.connection.execute("INSERT OR REPLACE INTO chunk_rows (chunk_id, chunk_row) VALUES (?, ?)",
+                                        [chunk_id, row])
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        """(chunk id, BM25 score) of the best matching chunks, higher scores match better."""
+        terms = query_terms(query)
+        if len(terms) == 0 or limit <= 0:
+            return []
+        # Quoted terms are never read as FTS5 operators
+        match = " OR ".join('"' + x.replace('"', '""') + '"' for x in terms)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT chunk_id, bm25(chunks) FROM chunks WHERE chunks MATCH ? ORDER BY bm25(chunks) LIMIT ?",
+                [match, limit]
+            ).fetchall()
+        # FTS5 returns BM25 negated, so it sorts ascending
+        return [(chunk_id, -score) for chunk_id, score in rows]
+
+    def count(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def is_complete(self) -> bool:
+        # False until chunks stored before the index existed were added
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM state WHERE key = 'complete'").fetchone()
+        return row is not None and row[0] == "1"
+
+    def set_complete(self):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('complete', '1')")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_indexes: Dict[str, LexicalIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_lexical_index(db_file: str) -> LexicalIndex:
+    key = os.path.abspath(db_file)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        # Knowledge base folders are removed on delete, the index goes with them
+        if index is not None and not os.path.exists(db_file):
+            index.close()
+            index = None
+        if index is None:
+            index = LexicalIndex(db_file)
+            _indexes[key] = index
+        return index
+
+
+def drop_lexical_index(db_file: str):
+    with _indexes_lock:
+        index = _indexes.pop(os.path.abspath(db_file), None)
+    if index is not None:
+        index.close()
+    for path in [db_file, db_file + "-wal", db_file + "-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    Ids of several best-first rankings ordered by sum(1 / (k + rank)). Ids ranked well by any ranking come first,
+    scores of the rankings themselves are not compared.
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, 1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+class LookupStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hybrid_lookups = 0
+        self.total_s = {x: 0.0 for x in LOOKUP_COMPONENTS}
+        self.last_s: Dict[str, float] = {}
+
+    def record(self, timings: Dict[str, float], hybrid: bool):
+        with self.lock:
+            self.lookups += 1
+            if hybrid:
+                self.hybrid_lookups += 1
+            for component, duration_s in timings.items():
+                self.total_s[component] = self.total_s.get(component, 0.0) + duration_s
+            self.last_s = dict(timings)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "lookups": self.lookups,
+                "hybrid_lookups": self.hybrid_lookups,
+                "avg_ms": {x: round(self.total_s[x] * 1000 / self.lookups, 2) if self.lookups > 0 else None
+                           for x in self.total_s},
+                "last_ms": {x: round(y * 1000, 2) for x, y in self.last_s.items()},
+            }
+
+
+_lookup_stats = LookupStats()
+
+
+def lookup_stats() -> dict:
+    return _lookup_stats.to_dict()
+
+
+def record_lookup(timings: Dict[str, float], hybrid: bool):
+    _lookup_stats.record(timings, hybrid)
@@ -1,24 +1,31 @@
 import datetime
-import json
 import os
-from pathlib import Path
-import shutil
 from abc import ABC, abstractmethod
 from typing import List, Optional, Callable, Dict
 
+from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 
+from cache_index import CacheIndex, get_cache_index, drop_cache_index
+from convertors.conversion_manifest import get_conversion_manifest
 from convertors.convertor_result import ConvertorResult
 from convertors.document_file import DocumentFile
+from kb.embedding_cache import CachedEmbeddings, embedding_key, get_embedding_cache
 from logger import logger
-from settings import Settings, DEFAULT_KNOWLEDGE_BASE, RAGSettings
+from settings import Settings, DEFAULT_KNOWLEDGE_BASE, RAGSettings, EmbeddingSettings
 from utils import compute_folder_hash, from_posix_path
 
 
 class KnowledgeBase(ABC):
     DEFAULT_CACHE_DIR = os.path.join(".cache", "kb_check_cache")
-
-    def __init__(self, kb_dict: dict):
+    CHECKED_NAMESPACE = "checked"
+    COVERAGE_NAMESPACE = "coverage"
+    # Coverage of a document hash in the knowledge base
+    COVERAGE_COMPLETE = "complete"
+    COVERAGE_PARTIAL = "partial"
+    COVERAGE_MISSING = "missing"
+
+    def __init__(self, kb_dict: dict, embedding_settings: Optional[EmbeddingSettings] = None):
         self.name: str = kb_dict["name"]
         self.full_name: str = self.name
         self.selection: List[str] = kb_dict["selection"]
@@ -26,49 +33,86 @@ class KnowledgeBase(ABC):
         self.embedding_config: dict = kb_dict["embedding"]
         self.languages = kb_dict.get("languages", ["eng"])
         cache_dir = os.path.join(".cache", "kb_check_cache")
-        self.cache_file = os.path.join(cache_dir, from_posix_path(self.name) + ".json")
+        self.cache_file = os.path.join(cache_dir, from_posix_path(self.name) + ".sqlite3")
+        self.embedding_settings = embedding_settings if embedding_settings is not None else EmbeddingSettings()
 
     def _create_embedding(self, embedding_source: Callable[[dict], Embeddings]):
         return embedding_source(self.embedding_config)
 
+    def create_document_embedding(self, embedding_source: Callable[[dict], Embeddings]) -> Optional[Embeddings]:
+        # Batched and cached, vectors are shared with every knowledge base using the same embedding config
+        embeddings = self._create_embedding(embedding_source)
+        if embeddings is None:
+            return None
+        cache = get_embedding_cache() if self.embedding_settings.cache else None
+        return CachedEmbeddings(embeddings, embedding_key(self.embedding_config), self.embedding_settings.batch_size,
+                                cache)
+
+    def _legacy_cache_file(self) -> str:
+        # Caches written before the index existed are JSON files next to it
+        return os.path.splitext(self.cache_file)[0] + ".json"
+
+    def _check_cache(self) -> Optional[CacheIndex]:
+        try:
+            return get_cache_index(self.cache_file, {KnowledgeBase.CHECKED_NAMESPACE: self._legacy_cache_file()})
+        except Exception as e:
+            logger.error(f"Could not open check cache {self.cache_file}. Error: {e}")
+            return None
+
     def is_checked(self, doc: DocumentFile):
-        cache_file = self.cache_file
-        if os.path.exists(cache_file):
-            with open(cache_file, "r") as fh:
-                cache = json.load(fh)
-            doc_cache = cache.get(doc.get_document_path())
-            if doc_cache is not None:
-                if doc_cache.get("last_checked") is not None:
-                    return True
-        return False
+        check_cache = self._check_cache()
+        if check_cache is None:
+            return False
+        doc_cache = check_cache.get(KnowledgeBase.CHECKED_NAMESPACE, doc.get_document_path())
+        return doc_cache is not None and doc_cache.get("last_checked") is not None
 
     def update_checked(self, doc: DocumentFile):
-        cache_file = self.cache_file
-        os.makedirs(Path(cache_file).parent, exist_ok=True)
-        cache = {}
-        if os.path.exists(cache_file):
-            with open(cache_file, "r") as fh:
-                cache = json.load(fh)
-        cache.update(
-            {
-                doc.get_document_path(): {
-                    "last_checked": datetime.datetime.now(datetime.UTC).isoformat()
-                }
-            }
-        )
-        temp_cache_file = cache_file + ".temp"
-        with open(temp_cache_file, "w") as fh:
-            json.dump(cache, fh, indent=2)
-        shutil.move(temp_cache_file, cache_file)
+        check_cache = self._check_cache()
+        if check_cache is None:
+            return
+        check_cache.put(KnowledgeBase.CHECKED_NAMESPACE, doc.get_document_path(),
+                        {"last_checked": datetime.datetime.now(datetime.UTC).isoformat()})
+        self.set_coverage(doc.file_hash, KnowledgeBase.COVERAGE_COMPLETE)
+
+    def get_coverage(self, file_hash: str) -> Optional[str]:
+        check_cache = self._check_cache()
+        if check_cache is None:
+            return None
+        coverage = check_cache.get(KnowledgeBase.COVERAGE_NAMESPACE, file_hash)
+        return None if coverage is None else coverage["status"]
+
+    def set_coverage(self, file_hash: str, status: str):
+        # Kept up to date by ingestion, so status listings never have to query the vector store
+        check_cache = self._check_cache()
+        if check_cache is None:
+            return
+        check_cache.put(KnowledgeBase.COVERAGE_NAMESPACE, file_hash,
+                        {"status": status, "updated": datetime.datetime.now(datetime.UTC).isoformat()})
+
+    def content_key(self) -> str:
+        # Identifies the stored contents, cached lookups are invalidated under this key
+        return self.name
 
     @abstractmethod
-    def rag_lookup(self, embedding_source: Callable[[dict], Embeddings], query: str, document_count: int):
+    def rag_lookup(self, embedding_source: Callable[[dict], Embeddings], query: str, document_count: int,
+                   include_embeddings: bool = False, rag_settings: Optional[RAGSettings] = None):
+        # Returns (document, score) tuples, with include_embeddings (document, score, stored vector) tuples.
+        # rag_settings turn on hybrid lexical and vector lookup where the knowledge base supports it.
         pass
 
     @abstractmethod
     def store_convertor_result(self, embedding_source: Callable[[dict], Embeddings], convertor_result: ConvertorResult, rag_settings: RAGSettings):
         pass
 
+    def prepare_chunks(self, embedding_source: Callable[[dict], Embeddings], convertor_result: ConvertorResult,
+                       rag_settings: RAGSettings) -> Optional[List[Document]]:
+        # Knowledge bases that can not store precomputed embeddings return None and get store_convertor_result instead
+        return None
+
+    def store_chunks(self, embedding_source: Callable[[dict], Embeddings], chunks: List[Document],
+                     embeddings: List[List[float]]):
+        raise NotImplementedError(f"{type(self).__name__} does not store precomputed embeddings")
+
     @abstractmethod
     def has_full_document(self, embedding_source: Callable[[dict], Embeddings], doc: DocumentFile) -> bool:
         pass
@@ -95,9 +139,9 @@ class KnowledgeBase(ABC):
             return False
 
     def clear_cache(self):
-        cache_file = self.cache_file
-        if os.path.exists(cache_file):
-            os.remove(cache_file)
+        drop_cache_index(self.cache_file)
+        if os.path.exists(self._legacy_cache_file()):
+            os.remove(self._legacy_cache_file())
 
     def needs_refresh(self, new_kb) -> bool:
         for existing_selection in self.selection:
@@ -113,6 +157,10 @@ class KnowledgeBase(ABC):
 
     @staticmethod
     def validate_document_source(convertor: ConvertorResult) -> bool:
+        # Output recorded in the manifest and not touched since needs no rehashing
+        if convertor.result_hash is not None and get_conversion_manifest().is_unchanged(
+                convertor.output_path, convertor.conversion_type, convertor.model, convertor.result_hash):
+            return True
         extra_string_list = []
         if convertor.model is not None:
             extra_string_list = [convertor.model]
@@ -137,12 +185,12 @@ class KnowledgeBase(ABC):
 
 class AddressedKnowledgeBase(KnowledgeBase):
     def __init__(self, kb: KnowledgeBase, prefix: str):
-        super().__init__(kb.to_dict())
+        super().__init__(kb.to_dict(), kb.embedding_settings)
         self.kb = kb
         self.prefix = prefix
         self.full_name = self.prefix + kb.full_name
         if kb.cache_file.startswith(KnowledgeBase.DEFAULT_CACHE_DIR):
-            self.cache_file = os.path.join(KnowledgeBase.DEFAULT_CACHE_DIR, from_posix_path(self.name) + ".json")
+            self.cache_file = os.path.join(KnowledgeBase.DEFAULT_CACHE_DIR, from_posix_path(self.name) + ".sqlite3")
         else:
             self.cache_file = kb.cache_file
 
@@ -156,12 +204,24 @@ class AddressedKnowledgeBase(KnowledgeBase):
     def clear(self):
         self.kb.clear()
 
-    def rag_lookup(self, embedding_source: Callable[[dict], Embeddings], query: str, document_count: int):
-        return self.kb.rag_lookup(embedding_source, query, document_count)
+    def content_key(self) -> str:
+        return self.kb.content_key()
+
+    def rag_lookup(self, embedding_source: Callable[[dict], Embeddings], query: str, document_count: int,
+                   include_embeddings: bool = False, rag_settings: Optional[RAGSettings] = None):
+        return self.kb.rag_lookup(embedding_source, query, document_count, include_embeddings, rag_settings)
 
     def store_convertor_result(self, embedding_source: Callable[[dict], Embeddings], convertor_result: ConvertorResult, rag_settings: RAGSettings):
         self.kb.store_convertor_result(embedding_source, convertor_result, rag_settings)
 
+    def prepare_chunks(self, embedding_source: Callable[[dict], Embeddings], convertor_result: ConvertorResult,
+                       rag_settings: RAGSettings) -> Optional[List[Document]]:
+        return self.kb.prepare_chunks(embedding_source, convertor_result, rag_settings)
+
+    def store_chunks(self, embedding_source: Callable[[dict], Embeddings], chunks: List[Document],
+                     embeddings: List[List[float]]):
+        self.kb.store_chunks(embedding_source, chunks, embeddings)
+
     def has_full_document(self, embedding_source: Callable[[dict], Embeddings], doc: DocumentFile) -> bool:
         return self.kb.has_full_document(embedding_source, doc)
 
@@ -207,6 +267,17 @@ class KBStore(ABC):
     def get(self, name: str) -> Optional[KnowledgeBase]:
         return self._kbs.get(name)
 
+    def get_many(self, names: List[str]) -> List[KnowledgeBase]:
+        # Knowledge bases searched together, missing ones are left out
+        kbs = []
+        for name in names:
+            kb = self.get(name)
+            if kb is None:
+                logger.warning(f"Knowledge base {name} not found")
+            else:
+                kbs.append(kb)
+        return kbs
+
     @staticmethod
     def from_settings(settings: Settings):
         kb_stores = []
@@ -214,7 +285,8 @@ class KBStore(ABC):
             if kb_store_config["store_type"] == "chroma":
                 from kb.chroma import ChromaKBStore
                 kb_store = ChromaKBStore(name=kb_store_config["name"],
-                                         kb_store_folder=kb_store_config["kb_store_folder"])
+                                         kb_store_folder=kb_store_config["kb_store_folder"],
+                                         embedding_settings=EmbeddingSettings.from_settings(settings))
                 if not kb_store.is_initialized:
                     # Ensures kb_store.kb_store_folder and knowledge base config
                     kb_store.upsert(settings[DEFAULT_KNOWLEDGE_BASE])
@@ -0,0 +1,207 @@
+import copy
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from kb.knowledge_base import KnowledgeBase
+from logger import logger
+from settings import RAGSettings, RetrievalCacheSettings
+
+_versions: Dict[str, int] = {}
+_versions_lock = threading.Lock()
+
+
+def kb_version(content_key: str) -> int:
+    with _versions_lock:
+        return _versions.get(content_key, 0)
+
+
+def bump_kb_version(content_key: str):
+    # Called whenever the contents of a knowledge base change, cached lookups of it are dropped
+    with _versions_lock:
+        _versions[content_key] = _versions.get(content_key, 0) + 1
+    if _cache is not None:
+        _cache.invalidate(content_key)
+
+
+def normalize_query(query: str) -> str:
+    query = unicodedata.normalize("NFKC", query).casefold()
+    query = re.sub(r"\s+", " ", query).strip()
+    return query.rstrip("?!.。 ")
+
+
+class CacheEntry:
+    def __init__(self, value: Any, cost_s: float, query_vector: Optional[np.ndarray]):
+        self.value = value
+        self.cost_s = cost_s
+        self.query_vector = query_vector
+        self.created = time.monotonic()
+
+
+class RetrievalCache:
+    """
+    Reranked RAG sources keyed by (knowledge bases and their content versions, normalized query, RAG settings).
+    With a similarity threshold, a query that misses is embedded and matched against the cached queries of the
+    same knowledge bases, so rephrased questions hit too. Entries are evicted least recently used first and expire
+    after ttl_s.
+    """
+    def __init__(self, max_entries: int = 256, ttl_s: float = 600.0, similarity_threshold: Optional[float] = None):
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[tuple, CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.saved_s = 0.0
+        self.configure(max_entries, ttl_s, similarity_threshold)
+
+    def configure(self, max_entries: int, ttl_s: float, similarity_threshold: Optional[float]):
+        with self.lock:
+            self.max_entries = max(1, max_entries)
+            self.ttl_s = ttl_s
+            self.similarity_threshold = similarity_threshold
+            self._evict()
+
+    @staticmethod
+    def key(kbs: List[KnowledgeBase], query: str, rag_settings: RAGSettings) -> tuple:
+        kb_part = tuple((x.content_key(), kb_version(x.content_key())) for x in kbs)
+        return kb_part, rag_settings.retrieval_signature(), normalize_query(query)
+
+    def _evict(self):
+        # Caller holds self.lock
+        now = time.monotonic()
+        for key in [k for k, v in self.entries.items() if now - v.created >= self.ttl_s]:
+            del self.entries[key]
+            self.evictions += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _hit(self, key: tuple, entry: CacheEntry, near: bool) -> Any:
+        # Caller holds self.lock
+        self.entries.move_to_end(key)
+        if near:
+            self.near_hits += 1
+        else:
+            self.hits += 1
+        self.saved_s += entry.cost_s
+        return copy.deepcopy(entry.value)
+
+    def get(self, key: tuple) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.created >= self.ttl_s:
+                del self.entries[key]
+                self.evictions += 1
+                return None
+            return self._hit(key, entry, False)
+
+    def get_similar(self, key: tuple, query_vector: np.ndarray) -> Optional[Any]:
+        if self.similarity_threshold is None:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            best_key, best_similarity = None, self.similarity_threshold
+            for entry_key, entry in self.entries.items():
+                if entry_key[:2] != key[:2] or entry.query_vector is None or now - entry.created >= self.ttl_s:
+                    continue
+                similarity = float(entry.query_vector @ query_vector)
+                if similarity >= best_similarity:
+                    best_key, best_similarity = entry_key, similarity
+            if best_key is None:
+                return None
+            return self._hit(best_key, self.entries[best_key], True)
+
+    def put(self, key: tuple, value: Any, cost_s: float, query_vector: Optional[np.ndarray] = None):
+        with self.lock:
+            self.entries[key] = CacheEntry(copy.deepcopy(value), cost_s, query_vector)
+            self.entries.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, content_key: str):
+        with self.lock:
+            keys = [k for k in self.entries if any(x[0] == content_key for x in k[0])]
+            for key in keys:
+                del self.entries[key]
+            self.invalidations += len(keys)
+
+    def get_or_retrieve(self, kbs: List[KnowledgeBase], query: str, rag_settings: RAGSettings,
+                        retrieve: Callable[[], Tuple[Any, bool]],
+                        embed_query: Optional[Callable[[], List[float]]] = None) -> Any:
+        """
+        Cached result of retrieve() for the query. retrieve returns the result and whether it may be cached,
+        partial results (e.g. a knowledge base timed out) are returned but not kept.
+        embed_query is only called for the near-duplicate tier.
+        """
+        key = RetrievalCache.key(kbs, query, rag_settings)
+        value = self.get(key)
+        if value is not None:
+            return value
+        query_vector = None
+        if self.similarity_threshold is not None and embed_query is not None:
+            try:
+                query_vector = np.asarray(embed_query(), dtype=np.float64)
+                norm = np.linalg.norm(query_vector)
+                query_vector = query_vector / norm if norm > 0 else None
+            except Exception as e:
+                logger.warning(f"Could not embed query for the retrieval cache. Error: {e}")
+            if query_vector is not None:
+                value = self.get_similar(key, query_vector)
+                if value is not None:
+                    return value
+        with self.lock:
+            self.misses += 1
+        started = time.perf_counter()
+        value, cacheable = retrieve()
+        if cacheable:
+            self.put(key, value, time.perf_counter() - started, query_vector)
+        return value
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl_s,
+                "similarity_threshold": self.similarity_threshold,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.near_hits) / lookups, 3) if lookups > 0 else None,
+                "saved_s": round(self.saved_s, 3),
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+_cache: Optional[RetrievalCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_retrieval_cache(settings: Optional[RetrievalCacheSettings] = None) -> RetrievalCache:
+    # One cache for all rooms, settings changes resize it in place
+    global _cache
+    if settings is None:
+        settings = RetrievalCacheSettings()
+    with _cache_lock:
+        if _cache is None:
+            _cache = RetrievalCache(settings.max_entries, settings.ttl_s, settings.similarity_threshold)
+        elif (_cache.max_entries, _cache.ttl_s, _cache.similarity_threshold) != \
+                (settings.max_entries, settings.ttl_s, settings.similarity_threshold):
+            _cache.configure(settings.max_entries, settings.ttl_s, settings.similarity_threshold)
+        return _cache
+
+
+def retrieval_cache_stats() -> dict:
+    with _cache_lock:
+        cache = _cache
+    return {"enabled": cache is not None, **({} if cache is None else cache.stats())}
@@ -1,19 +1,33 @@
+from cache_index import flush_cache_indexes
 from convertors.llm_contexts import DocumentContext
-from kb.knowledge_base import KBStore
+from kb.knowledge_base import KBStore, KnowledgeBase
 from doc_sources.doc_source import DocSource
 from llm_runners.llm_runner import LLMRunner
 from logger import logger
 from convertors.convertor import Convertor
 from convertors.document_image_convertor import DocumentImageConvertor
 from convertors.convertor_result import ConvertorResult
+import multiprocessing
 import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from convertors.document_file import DocumentFile
-from settings import RAG_SETTINGS, RAGSettings
-from utils import utc_now
-from typing import Optional, List, Dict, Any
+from ingestion_pipeline import DocumentPipeline, DocumentJob
+from doc_sources.doc_watcher import DocSourceWatch
+from settings import RAG_SETTINGS, RAGSettings, KBServiceSettings, PDFRenderSettings, OcrSettings, \
+    LlmConversionSettings, WatchSettings
+from utils import utc_now, selection_matches
+from typing import Optional, List, Dict, Any, Callable, Iterator
 from config import settings
 
 class KnowledgeBaseService:
+    # Document statuses of kb_status
+    PROCESSED = "processed"
+    PARTIAL = "partial"
+    NOT_PROCESSED = "not_processed"
+    # Changed since it was last hashed, known again after the next run
+    UNKNOWN = "unknown"
+    DOCUMENT_STATUSES = [PROCESSED, PARTIAL, NOT_PROCESSED, UNKNOWN]
+
     def __init__(self, kb_store: KBStore, doc_source: DocSource, llm_runner: LLMRunner):
         self.kb_store: KBStore = kb_store
         self.doc_source: DocSource = doc_source
@@ -21,105 +35,217 @@ class KnowledgeBaseService:
         self.active: bool = False
         self.lock = threading.Lock()
         self.status: dict = {"status": "done"}
+        # Per-worker progress, keyed by worker thread name
+        self.status_lock = threading.Lock()
+        self.worker_status: Dict[str, dict] = {}
+        # Guards for writes that are not safe to run from several workers at once
+        self.locks_lock = threading.Lock()
+        self.document_locks: Dict[str, threading.Lock] = {}
+        self.kb_locks: Dict[str, threading.Lock] = {}
+        self.doc_source_cache_lock = threading.Lock()
+        self.process_pool: Optional[ProcessPoolExecutor] = None
+        self.pipeline: Optional[DocumentPipeline] = None
+        # Dispatches runs of changed documents, the dispatcher only takes self.lock
+        self.watch_lock = threading.Lock()
+        self.watch: Optional[DocSourceWatch] = None
 
-    def start(self):
+    def start(self, document_paths: Optional[List[str]] = None) -> bool:
+        # document_paths limits the run to these documents, otherwise every selected document is checked
         with self.lock:
-            if not self.active:
-                self.active = True
-                t = threading.Thread(target=self._run)
-                t.start()
+            if self.active:
+                return False
+            self.active = True
+            t = threading.Thread(target=self._run, args=(document_paths,))
+            t.start()
+            return True
 
     def stop(self):
         with self.lock:
             self.active = False
 
+    def update_watch(self):
+        watch_settings = WatchSettings.from_settings(settings)
+        with self.watch_lock:
+            if self.watch is not None:
+                if watch_settings.enabled and watch_settings == self.watch.settings:
+                    return
+                self.watch.stop()
+                self.watch = None
+            if not watch_settings.enabled:
+                return
+            roots = self.doc_source.watch_roots()
+            if len(roots) == 0:
+                logger.warning("Document watch is enabled, but no doc source can be watched")
+                return
+            self.watch = DocSourceWatch(roots, watch_settings, self._on_documents_changed)
+            self.watch.start()
+
+    def stop_watch(self):
+        with self.watch_lock:
+            if self.watch is not None:
+                self.watch.stop()
+                self.watch = None
+
+    def _on_documents_changed(self, document_paths: List[str]) -> bool:
+        # Deleted files and folders are dropped, a running sweep gets the paths again after it is done
+        existing = [x for x in document_paths if DocumentFile.is_supported(x) and x in self.doc_source.list_files(x)]
+        if len(existing) == 0:
+            return True
+        logger.info(f"{len(existing)} changed document(s): {", ".join(existing[:10])}")
+        return self.start(existing)
+
     def service_status(self):
-        return self.status
+        with self.status_lock:
+            status = dict(self.status)
+            if len(self.worker_status) > 0:
+                status["workers"] = [{"worker": name, **worker_status} for name, worker_status in
+                                     sorted(self.worker_status.items())]
+            pipeline = self.pipeline
+        if pipeline is not None:
+            status["stages"] = pipeline.stats()
+        watch = self.watch
+        if watch is not None:
+            status["watch"] = watch.stats()
+        return status
 
-    def kb_status(self, name):
-        kb = self.kb_store.get(name)
-        documents = []
+    def _kb_documents(self, kb: KnowledgeBase, checkpoint: Optional[Callable[[], None]] = None) -> List[str]:
+        documents: list = []
         for pattern in kb.selection:
+            if checkpoint is not None:
+                checkpoint()
             documents += self.doc_source.list_files(pattern)
-        documents = list(set(documents))
-        documents = sorted(documents)
-        processed_documents = []
-        not_processed_documents = []
-        for document_path in documents:
+        return sorted(set(documents))
+
+    def _document_status(self, kb: KnowledgeBase, document_path: str) -> str:
+        # Answered from the coverage index, documents never hashed by ingestion are not processed
+        file_hash, stale = self.doc_source.cached_hash_state(document_path)
+        if file_hash is None:
+            if stale:
+                return KnowledgeBaseService.UNKNOWN
+            return KnowledgeBaseService.NOT_PROCESSED
+        coverage = kb.get_coverage(file_hash)
+        if coverage is None:
+            # Ingested before the coverage index existed, looked up in the vector store once
             document = self.doc_source.get(document_path)
             if document is None:
-                continue
-            if kb.has_full_document(self.llm_runner.get_embedding, document):
-                processed_documents.append(document_path)
-            else:
-                not_processed_documents.append(document_path)
+                return KnowledgeBaseService.NOT_PROCESSED
+            complete = kb.has_full_document(self.llm_runner.get_embedding, document)
+            coverage = KnowledgeBase.COVERAGE_COMPLETE if complete else KnowledgeBase.COVERAGE_MISSING
+            kb.set_coverage(file_hash, coverage)
+        if coverage == KnowledgeBase.COVERAGE_COMPLETE:
+            return KnowledgeBaseService.PROCESSED
+        if coverage == KnowledgeBase.COVERAGE_PARTIAL:
+            return KnowledgeBaseService.PARTIAL
+        return KnowledgeBaseService.NOT_PROCESSED
+
+    def iter_kb_status(self, name: str) -> Optional[Iterator[dict]]:
+        kb = self.kb_store.get(name)
+        if kb is None:
+            return None
+        return ({"path": x, "status": self._document_status(kb, x)} for x in self._kb_documents(kb)
+                if DocumentFile.is_supported(x))
+
+    def kb_status(self, name: str, offset: Optional[int] = None, limit: Optional[int] = None,
+                  status: Optional[str] = None) -> Optional[dict]:
+        statuses = self.iter_kb_status(name)
+        if statuses is None:
+            return None
+        statuses = list(statuses)
+        if offset is None and limit is None and status is None:
+            return {
+                "processed_documents": [x["path"] for x in statuses if x["status"] == KnowledgeBaseService.PROCESSED],
+                "not_processed_documents": [x["path"] for x in statuses
+                                            if x["status"] != KnowledgeBaseService.PROCESSED],
+            }
+        counts = {x: 0 for x in KnowledgeBaseService.DOCUMENT_STATUSES}
+        for x in statuses:
+            counts[x["status"]] += 1
+        if status is not None:
+            statuses = [x for x in statuses if x["status"] == status]
+        offset = 0 if offset is None else max(0, offset)
         return {
-            "processed_documents": processed_documents,
-            "not_processed_documents": not_processed_documents,
+            "total": len(statuses),
+            "counts": counts,
+            "offset": offset,
+            "limit": limit,
+            "documents": statuses[offset:] if limit is None else statuses[offset:offset + max(0, limit)],
         }
 
     def _status_update(self, **kwargs):
-        self.status = kwargs
+        with self.status_lock:
+            self.status = kwargs
 
-    def _run(self):
+    def _worker_update(self, worker: str, **kwargs):
+        with self.status_lock:
+            if len(kwargs) > 0:
+                self.worker_status[worker] = kwargs
+            else:
+                self.worker_status.pop(worker, None)
+
+    def _get_lock(self, locks: Dict[str, threading.Lock], key: str) -> threading.Lock:
+        with self.locks_lock:
+            if key not in locks:
+                locks[key] = threading.Lock()
+            return locks[key]
+
+    def _run(self, document_paths: Optional[List[str]] = None):
         def checkpoint():
             if not self.active:
                 raise(InterruptedError())
         self._status_update(status="started")
-        logger.info(f"Run started at: {utc_now()}")
+        if document_paths is None:
+            logger.info(f"Run started at: {utc_now()}")
+        else:
+            logger.info(f"Run of {len(document_paths)} changed document(s) started at: {utc_now()}")
         error_block: Dict[str, Any] = {"error": False}
         try:
+            service_settings = KBServiceSettings.from_settings(settings)
+            if service_settings.pipeline_enabled:
+                logger.info(f"Processing documents with the staged pipeline, "
+                            f"{service_settings.pipeline_max_in_flight} document(s) in flight")
+            else:
+                logger.info(f"Processing documents with {service_settings.workers} {service_settings.worker_type} worker(s)")
+            if service_settings.worker_type == "process" and not service_settings.pipeline_enabled:
+                # "spawn" avoids forking a process that already runs threads (flask, chroma, other workers)
+                self.process_pool = ProcessPoolExecutor(max_workers=service_settings.workers,
+                                                        mp_context=multiprocessing.get_context("spawn"))
             kb_list = self.kb_store.list()
             for kb_num, kb in enumerate(kb_list, 1):
                 checkpoint()
+                if document_paths is None:
+                    documents = self._kb_documents(kb, checkpoint)
+                else:
+                    documents = [x for x in document_paths if selection_matches(x, kb.selection)]
+                    if len(documents) == 0:
+                        continue
                 self._status_update(status="processing", kb_num=kb_num, kb_name=kb.name, kb_total=len(kb_list))
-                documents: list = []
-                for pattern in kb.selection:
-                    checkpoint()
-                    documents += self.doc_source.list_files(pattern)
-                documents = list(set(documents))
-                documents = sorted(documents)
                 convertors: List[Convertor] = [Convertor.from_config(x, self.llm_runner) for x in kb.convertor_configs]
                 convertors = [x for x in convertors if x is not None]
-                document_context = DocumentContext(kb)
-                for doc_num, document_path in enumerate(documents, 1):
-                    checkpoint()
-                    self._status_update(status="processing", kb_num=kb_num, kb_name=kb.name, kb_total=len(kb_list),
-                                        doc_num=doc_num, doc_path=document_path, doc_total=len(documents))
-                    # TODO: binary in DocumentFile
-                    document: DocumentFile = self.doc_source.get(document_path)
-                    if document is None:
-                        logger.warning(f"Could not get document {document_path}")
-                        error_block["error"] = True
-                        continue
-
-                    # Check if a document with same content (same file hash) is in knowledge base
-                    # If there is such a document, then try to add current document path to existing entry metadata.
-                    # This prevents duplicate documents from being loaded into knowledge base and polluting query results
-                    # with same content. Duplicate documents are documents with exactly the same content,
-                    # but with different file name, different file location or different file source.
-                    if kb.has_full_document(self.llm_runner.get_embedding, document):
-                        kb.add_doc_path(self.llm_runner.get_embedding, document)
-                        self.doc_source.update_cache(document)
-                        kb.update_checked(document)
-                        continue
-                    convertor_result = None
-                    for convertor in convertors:
-                        checkpoint()
-                        if isinstance(convertor, DocumentImageConvertor) and not document.image_based:
-                            continue
-                        self._status_update(status="processing", kb_num=kb_num, kb_name=kb.name, kb_total=len(kb_list),
-                                            doc_num=doc_num, doc_path=document_path, doc_total=len(documents),
-                                            convertor=convertor.conversion_type)
-                        convertor_result: Optional[ConvertorResult] = convertor.convert(document, document_context)
-                        if convertor_result is not None:
-                            kb.store_convertor_result(self.llm_runner.get_embedding, convertor_result, RAGSettings.from_settings(settings))
-                            self.doc_source.update_cache(document)
-                            kb.update_checked(document)
-                            break
-                    if convertor_result is None:
-                        logger.error(f"Could not convert document {document.file_path}")
+                document_context = DocumentContext(kb, PDFRenderSettings.from_settings(settings),
+                                                   OcrSettings.from_settings(settings),
+                                                   LlmConversionSettings.from_settings(settings))
+                if service_settings.pipeline_enabled:
+                    if not self._run_pipeline(kb, convertors, document_context, documents, service_settings,
+                                              checkpoint, kb_num, len(kb_list)):
                         error_block["error"] = True
+                    continue
+                with ThreadPoolExecutor(max_workers=service_settings.workers,
+                                        thread_name_prefix="kb_worker") as executor:
+                    futures = [
+                        executor.submit(self._process_document, kb, convertors, document_context, document_path,
+                                        doc_num, len(documents), checkpoint)
+                        for doc_num, document_path in enumerate(documents, 1)
+                    ]
+                    try:
+                        for doc_done, future in enumerate(as_completed(futures), 1):
+                            if not future.result():
+                                error_block["error"] = True
+                            self._status_update(status="processing", kb_num=kb_num, kb_name=kb.name,
+                                                kb_total=len(kb_list), doc_done=doc_done, doc_total=len(documents))
+                    finally:
+                        # Only matters when a worker failed or the run got cancelled
+                        for future in futures:
+                            future.cancel()
         except InterruptedError as e:
             logger.error(e)
             error_block["status"] = "cancelled"
@@ -127,9 +253,107 @@ class KnowledgeBaseService:
             logger.error(all_e)
             error_block["error"] = True
         finally:
+            if self.process_pool is not None:
+                self.process_pool.shutdown(wait=False, cancel_futures=True)
+                self.process_pool = None
+            # Check and hash caches commit in batches
+            flush_cache_indexes()
             with self.lock:
                 self.active = False
             logger.info(f"Run complete at: {utc_now()}")
             final_status: Dict[str, Any] = {"status": "done"}
             final_status.update(error_block)
-            self._status_update(**final_status)
\ No newline at end of file
+            self._status_update(**final_status)
+
+    def _run_pipeline(self, kb: KnowledgeBase, convertors: List[Convertor], document_context: DocumentContext,
+                      documents: List[str], service_settings: KBServiceSettings, checkpoint: Callable[[], None],
+                      kb_num: int, kb_total: int) -> bool:
+        progress = {"doc_done": 0, "ok": True}
+        progress_lock = threading.Lock()
+
+        def on_finish(job: DocumentJob):
+            with progress_lock:
+                progress["doc_done"] += 1
+                progress["ok"] = progress["ok"] and job.ok
+                self._status_update(status="processing", kb_num=kb_num, kb_name=kb.name, kb_total=kb_total,
+                                    doc_done=progress["doc_done"], doc_total=len(documents))
+
+        pipeline = DocumentPipeline(self, kb, convertors, document_context, RAGSettings.from_settings(settings),
+                                    service_settings.pipeline_stages, service_settings.pipeline_max_in_flight,
+                                    checkpoint, on_finish=on_finish,
+                                    page_buffer=service_settings.pipeline_page_buffer)
+        with self.status_lock:
+            self.pipeline = pipeline
+        try:
+            pipeline.run(documents)
+        finally:
+            with self.status_lock:
+                self.pipeline = None
+        return progress["ok"]
+
+    def _process_document(self, kb: KnowledgeBase, convertors: List[Convertor], document_context: DocumentContext,
+                          document_path: str, doc_num: int, doc_total: int, checkpoint: Callable[[], None]) -> bool:
+        worker = threading.current_thread().name
+        try:
+            checkpoint()
+            self._worker_update(worker, kb_name=kb.name, doc_num=doc_num, doc_path=document_path, doc_total=doc_total)
+            # TODO: binary in DocumentFile
+            document: DocumentFile = self.doc_source.get(document_path)
+            if document is None:
+                logger.warning(f"Could not get document {document_path}")
+                return False
+
+            # Documents with the same content share their processed/ folder and knowledge base entries, therefore
+            # only one worker at a time may handle a given file hash.
+            with self._get_lock(self.document_locks, document.file_hash):
+                # Check if a document with same content (same file hash) is in knowledge base
+                # If there is such a document, then try to add current document path to existing entry metadata.
+                # This prevents duplicate documents from being loaded into knowledge base and polluting query results
+                # with same content. Duplicate documents are documents with exactly the same content,
+                # but with different file name, different file location or different file source.
+                if kb.has_full_document(self.llm_runner.get_embedding, document):
+                    with self._get_lock(self.kb_locks, kb.full_name):
+                        kb.add_doc_path(self.llm_runner.get_embedding, document)
+                        kb.update_checked(document)
+                    with self.doc_source_cache_lock:
+                        self.doc_source.update_cache(document)
+                    return True
+                for convertor in convertors:
+                    checkpoint()
+                    if isinstance(convertor, DocumentImageConvertor) and not document.image_based:
+                        continue
+                    self._worker_update(worker, kb_name=kb.name, doc_num=doc_num, doc_path=document_path,
+                                        doc_total=doc_total, convertor=convertor.conversion_type)
+                    convertor_result: Optional[ConvertorResult] = self._convert(convertor, document,
+                                                                                 document_context, checkpoint)
+                    if convertor_result is not None:
+                        # Until update_checked, an interrupted store leaves the document partially in the knowledge base
+                        kb.set_coverage(document.file_hash, KnowledgeBase.COVERAGE_PARTIAL)
+                        # Chroma client handles concurrent writes of different documents, chunk ids are unique.
+                        kb.store_convertor_result(self.llm_runner.get_embedding, convertor_result,
+                                                  RAGSettings.from_settings(settings))
+                        with self._get_lock(self.kb_locks, kb.full_name):
+                            kb.update_checked(document)
+                        with self.doc_source_cache_lock:
+                            self.doc_source.update_cache(document)
+                        return True
+            logger.error(f"Could not convert document {document.file_path}")
+            return False
+        finally:
+            self._worker_update(worker)
+
+    def _convert(self, convertor: Convertor, document: DocumentFile, document_context: DocumentContext,
+                 checkpoint: Callable[[], None]) -> Optional[ConvertorResult]:
+        if self.process_pool is None:
+            return convertor.convert(document, document_context)
+        future = self.process_pool.submit(convertor.convert, document, document_context)
+        while True:
+            try:
+                checkpoint()
+            except InterruptedError:
+                future.cancel()
+                raise
+            try:
+                return future.result(timeout=1)
+            except TimeoutError:
+                continue
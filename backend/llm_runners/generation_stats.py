@@ -0,0 +1,78 @@
+import threading
+from typing import Dict, Optional
+
+NS_PER_S = 1_000_000_000
+
+
+class ModelTimings:
+    def __init__(self):
+        self.requests = 0
+        self.loads = 0
+        self.prompt_tokens = 0
+        self.prompt_s = 0.0
+        self.eval_tokens = 0
+        self.eval_s = 0.0
+        self.load_s = 0.0
+        self.last: Dict[str, float] = {}
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "loads": self.loads,
+            "prompt_tokens": self.prompt_tokens,
+            "prompt_tokens_per_s": round(self.prompt_tokens / self.prompt_s, 1) if self.prompt_s > 0 else None,
+            "eval_tokens": self.eval_tokens,
+            "eval_tokens_per_s": round(self.eval_tokens / self.eval_s, 1) if self.eval_s > 0 else None,
+            "avg_load_ms": round(self.load_s * 1000 / self.requests, 1) if self.requests > 0 else None,
+            "last": dict(self.last),
+        }
+
+
+class GenerationStats:
+    """
+    Prompt evaluation (prefill) and generation timings per model, from the counters Ollama sends with the last
+    message of a response. Few prompt tokens per request against a long history mean the prompt cache was reused.
+    """
+    # A model that takes longer than this to be ready was loaded for the request
+    LOAD_THRESHOLD_S = 0.5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models: Dict[str, ModelTimings] = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record(self, model: str, response: dict) -> Optional[dict]:
+        if "eval_count" not in response and "prompt_eval_count" not in response:
+            return None
+        last = {
+            "prompt_tokens": int(response.get("prompt_eval_count", 0)),
+            "prompt_ms": round(response.get("prompt_eval_duration", 0) / NS_PER_S * 1000, 1),
+            "eval_tokens": int(response.get("eval_count", 0)),
+            "eval_ms": round(response.get("eval_duration", 0) / NS_PER_S * 1000, 1),
+            "load_ms": round(response.get("load_duration", 0) / NS_PER_S * 1000, 1),
+            "total_ms": round(response.get("total_duration", 0) / NS_PER_S * 1000, 1),
+        }
+        with self.lock:
+            timings = self.models.setdefault(model, ModelTimings())
+            timings.requests += 1
+            if last["load_ms"] / 1000 >= GenerationStats.LOAD_THRESHOLD_S:
+                timings.loads += 1
+            timings.prompt_tokens += last["prompt_tokens"]
+            timings.prompt_s += response.get("prompt_eval_duration", 0) / NS_PER_S
+            timings.eval_tokens += last["eval_tokens"]
+            timings.eval_s += response.get("eval_duration", 0) / NS_PER_S
+            timings.load_s += response.get("load_duration", 0) / NS_PER_S
+            timings.last = last
+        return last
+
+    def to_dict(self) -> Dict[str, dict]:
+        with self.lock:
+            return {model: timings.to_dict() for model, timings in self.models.items()}
@@ -8,29 +8,37 @@ from langchain_huggingface import HuggingFaceEmbeddings
 from domain import MessageProgress
 from generation_guard import GenerationGuard
 from llm_runners.llm_runner import LLMRunner, MAX_TOKENS_LIMIT
+from llm_runners.model_residency import get_residency_manager
 from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
 from transformers import pipeline
 from huggingface_hub import snapshot_download
 from threading import Thread
 
+from settings import ModelResidencySettings
 from utils import utc_now
 from logger import logger
 
 class HFRunner(LLMRunner):
-    def __init__(self, api_token):
+    def __init__(self, api_token, residency_settings: Optional[ModelResidencySettings] = None):
         self.api_token = api_token
         self.model_cache = ".hf_model_cache"
         os.makedirs(self.model_cache, exist_ok=True)
         os.makedirs(os.path.join(self.model_cache, ".locks"), exist_ok=True)
         # Cleanup if needed
         self._cleanup()
+        self.residency = get_residency_manager()
+        self.residency.configure(residency_settings if residency_settings is not None else ModelResidencySettings())
+        for model in self.residency.settings.preload:
+            if self.is_model_installed(model) and not self.residency.is_resident(model):
+                self.residency.preload(model, lambda m=model: self._load_generator(m), self._model_size_on_disk(model),
+                                       self._generator_footprint)
 
     @staticmethod
     def from_dict(config: dict):
         runner = None
         try:
             if config.get('type') == 'huggingface':
-                runner = HFRunner(config['api_token'])
+                runner = HFRunner(config['api_token'], ModelResidencySettings.from_runner_config(config))
         except Exception as e:
             logger.error(f"Could not create HuggingFace transformers runner from config. Reason: {e}")
         return runner
@@ -54,6 +62,53 @@ class HFRunner(LLMRunner):
                 return os.path.join(snapshot_folder, snapshot)
         return model
 
+    def _load_generator(self, model: str):
+        tokenizer = AutoTokenizer.from_pretrained(self._get_local_model_path(model), device_map="auto",
+                                                  local_files_only=True,
+
+                                                  )
+        llm_model = AutoModelForCausalLM.from_pretrained(self._get_local_model_path(model), device_map="auto",
+                                                         local_files_only=True,
+                                                         )
+        return pipeline("text-generation", model=llm_model, tokenizer=tokenizer)
+
+    def _model_size_on_disk(self, model: str) -> int:
+        # Size of the weight files, known before loading so other models can be unloaded first
+        model_path = self._get_local_model_path(model)
+        if not os.path.isdir(model_path):
+            return 0
+        return sum(os.path.getsize(os.path.join(model_path, x)) for x in os.listdir(model_path)
+                   if x.endswith((".safetensors", ".bin")))
+
+    @staticmethod
+    def _generator_footprint(generator) -> int:
+        return generator.model.get_memory_footprint()
+
+    def _use_generator(self, model: str):
+        return self.residency.use(model, lambda: self._load_generator(model), self._model_size_on_disk(model),
+                                  self._generator_footprint)
+
+    def count_tokens(self, model: str, text: str, chars_per_token: float = 4.0) -> int:
+        # The tokenizer is only used once the model is loaded, counting does not load it
+        if self.residency.is_resident(model):
+            try:
+                generator = self.residency.get(model, lambda: self._load_generator(model))
+                return len(generator.tokenizer.encode(text, add_special_tokens=False))
+            except Exception as e:
+                logger.warning(f"Could not count tokens with the tokenizer of {model}. Error: {e}")
+        return super().count_tokens(model, text, chars_per_token)
+
+    def warm_up(self, model: str) -> bool:
+        if not self.is_model_installed(model):
+            return False
+        if not self.residency.is_resident(model):
+            self.residency.preload(model, lambda: self._load_generator(model), self._model_size_on_disk(model),
+                                   self._generator_footprint)
+        return True
+
+    def residency_stats(self) -> List[dict]:
+        return [{"runner": "huggingface", **self.residency.stats()}]
+
     def list_chat_models(self):
         models = ["/".join((x.split("--"))[1:]) for x in os.listdir(self.model_cache) if not x.startswith(".")]
         return models
@@ -69,24 +124,21 @@ class HFRunner(LLMRunner):
     def run_text_completion_streaming(self, model: str, messages: List[dict], is_stopped: Callable[[], bool],
                                       gen_guard: GenerationGuard,
                                       update_callback: Callable[[MessageProgress], None], options: dict = None) -> Tuple[Optional[str], bool]:
-        failed_status = False
         if gen_guard is None:
             gen_guard = GenerationGuard()
-        tokenizer = AutoTokenizer.from_pretrained(self._get_local_model_path(model), device_map="auto",
-                                                  local_files_only=True,
+        with self._use_generator(model) as generator:
+            return self._stream_generation(generator, messages, is_stopped, gen_guard, update_callback)
 
-                                                  )
-        llm_model = AutoModelForCausalLM.from_pretrained(self._get_local_model_path(model), device_map="auto",
-                                                         local_files_only=True,
-                                                         )
-
-        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    @staticmethod
+    def _stream_generation(generator, messages: List[dict], is_stopped: Callable[[], bool], gen_guard: GenerationGuard,
+                           update_callback: Callable[[MessageProgress], None]) -> Tuple[Optional[str], bool]:
+        failed_status = False
+        streamer = TextIteratorStreamer(generator.tokenizer, skip_prompt=True, skip_special_tokens=True)
         generation_args = {
             "streamer": streamer,
             "text_inputs": messages,
             "max_new_tokens": MAX_TOKENS_LIMIT
         }
-        generator = pipeline("text-generation", model=llm_model, tokenizer=tokenizer)
         thread = Thread(
             target=generator,
             kwargs=generation_args,
@@ -144,18 +196,27 @@ class HFRunner(LLMRunner):
     def run_text_completion_simple(self, model: str, messages: List[dict], options: dict = None):
         if options is None:
             options = {}
-        tokenizer = AutoTokenizer.from_pretrained(self._get_local_model_path(model), device_map="auto",
-                                                  local_files_only=True,
-
-                                                  )
-        llm_model = AutoModelForCausalLM.from_pretrained(self._get_local_model_path(model), device_map="auto",
-                                                         local_files_only=True,
-                                                         )
         _options = {"max_new_tokens": MAX_TOKENS_LIMIT}
-        generator = pipeline("text-generation", model=llm_model, tokenizer=tokenizer)
-        result: List[dict] = generator(messages, **_options)[0]["generated_text"]
+        with self._use_generator(model) as generator:
+            result: List[dict] = generator(messages, **_options)[0]["generated_text"]
         return result[-1]["content"]
 
+    def run_text_completion_batch(self, model: str, messages_batch: List[List[dict]], options: dict = None,
+                                  concurrency: int = 1) -> List[Optional[str]]:
+        # One pipeline call, conversations are padded and generated together
+        if len(messages_batch) <= 1:
+            return super().run_text_completion_batch(model, messages_batch, options, concurrency)
+        _options = {"max_new_tokens": MAX_TOKENS_LIMIT, "batch_size": len(messages_batch)}
+        try:
+            with self._use_generator(model) as generator:
+                if generator.tokenizer.pad_token_id is None:
+                    generator.tokenizer.pad_token_id = generator.tokenizer.eos_token_id
+                results = generator(messages_batch, **_options)
+            return [x[0]["generated_text"][-1]["content"] for x in results]
+        except Exception as e:
+            logger.warning(f"Batched generation with {model} failed, generating one by one. Error: {e}")
+            return super().run_text_completion_batch(model, messages_batch, options, 1)
+
     def get_embedding(self, embedding_config) -> Optional[Embeddings]:
         model_path = self._get_local_model_path(embedding_config["model"])
 
@@ -197,6 +258,7 @@ class HFRunner(LLMRunner):
                 os.path.join(os.path.join(self.model_cache, ".locks"), hf_model_folder) + ".delete",
             )
             self._cleanup()
+            self.residency.evict(model)
             return True
         else:
             return False
\ No newline at end of file
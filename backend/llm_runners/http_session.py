@@ -0,0 +1,180 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from settings import HttpSettings
+
+# Connections opened by the current thread's request, read back once the response headers arrive
+_connects = threading.local()
+
+
+def _record_connect(duration_s: float):
+    _connects.count = getattr(_connects, "count", 0) + 1
+    _connects.duration_s = getattr(_connects, "duration_s", 0.0) + duration_s
+
+
+def _take_connects():
+    count, duration_s = getattr(_connects, "count", 0), getattr(_connects, "duration_s", 0.0)
+    _connects.count, _connects.duration_s = 0, 0.0
+    return count, duration_s
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _record_connect(time.perf_counter() - started)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _record_connect(time.perf_counter() - started)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+
+
+class HttpStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.new_connections = 0
+        self.reused_requests = 0
+        self.connect_s = 0.0
+        self.wait_s = 0.0
+        self.transfer_s = 0.0
+
+    def __getstate__(self):
+        # Runners are pickled into conversion worker processes, locks are not picklable
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record(self, new_connections: int, connect_s: float, wait_s: float, transfer_s: float, failed: bool = False):
+        with self.lock:
+            self.requests += 1
+            self.errors += 1 if failed else 0
+            self.new_connections += new_connections
+            self.reused_requests += 1 if new_connections == 0 and not failed else 0
+            self.connect_s += connect_s
+            self.wait_s += wait_s
+            self.transfer_s += transfer_s
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            requests_made = max(1, self.requests)
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "new_connections": self.new_connections,
+                "reused_requests": self.reused_requests,
+                "reuse_ratio": round(self.reused_requests / requests_made, 3),
+                "connect_s": round(self.connect_s, 3),
+                "wait_s": round(self.wait_s, 3),
+                "transfer_s": round(self.transfer_s, 3),
+                "avg_connect_s": round(self.connect_s / requests_made, 3),
+                "avg_wait_s": round(self.wait_s / requests_made, 3),
+                "avg_transfer_s": round(self.transfer_s / requests_made, 3),
+            }
+
+
+class HttpSession:
+    """
+    Keep-alive connection pool of one runner. Records per request the time spent connecting, waiting for the
+    response headers and transferring the body.
+    """
+    def __init__(self, settings: HttpSettings = None):
+        self.settings = settings if settings is not None else HttpSettings()
+        self.stats = HttpStats()
+        self.session = requests.Session()
+        retry = Retry(
+            total=self.settings.retries,
+            connect=self.settings.retries,
+            read=0,
+            status=0,
+            backoff_factor=self.settings.backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = _TimedHTTPAdapter(
+            pool_connections=self.settings.pool_connections,
+            pool_maxsize=self.settings.pool_maxsize,
+            pool_block=True,
+            max_retries=retry,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __getstate__(self):
+        # Open connections stay with this process, a copy in another process opens its own
+        return {"settings": self.settings}
+
+    def __setstate__(self, state):
+        self.__init__(state["settings"])
+
+    @property
+    def timeout(self):
+        return self.settings.connect_timeout_s, self.settings.read_timeout_s
+
+    @contextmanager
+    def stream(self, method: str, url: str, **kwargs) -> Iterator[requests.Response]:
+        kwargs.setdefault("timeout", self.timeout)
+        _take_connects()
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, stream=True, **kwargs)
+        except Exception:
+            new_connections, connect_s = _take_connects()
+            self.stats.record(new_connections, connect_s, time.perf_counter() - started - connect_s, 0.0, failed=True)
+            raise
+        headers_received = time.perf_counter()
+        new_connections, connect_s = _take_connects()
+        try:
+            yield response
+        finally:
+            response.close()
+            self.stats.record(new_connections, connect_s, max(0.0, headers_received - started - connect_s),
+                              time.perf_counter() - headers_received)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        with self.stream(method, url, **kwargs) as response:
+            # Reading the whole body here returns the connection to the pool
+            _ = response.content
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -1,5 +1,8 @@
 import json
+import uuid
+import weakref
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, List, Optional, Tuple
 
 from convertors.llm_contexts import ChatContext
@@ -7,9 +10,14 @@ from domain import RoomMessage, MessageProgress
 from langchain_core.embeddings import Embeddings
 
 from generation_guard import GenerationGuard
+from kb.embedding_cache import embedding_key
+from kb.federated_search import federated_rag_lookup
+from kb.retrieval_cache import get_retrieval_cache
+from llm_runners.model_registry import ModelRegistry, get_model_registry
 from logger import logger
 from room_states import RoomState
-from settings import Settings, RAGSettings
+from prompt_builder import PromptBuilder, get_token_estimator
+from settings import Settings, RAGSettings, PromptSettings
 from utils import utc_now
 from reranker import rerank
 
@@ -43,16 +51,9 @@ class LLMRunner(ABC):
              gen_guard: Optional[GenerationGuard],
              update_callback: Optional[Callable] = None,
              history: Optional[List[RoomMessage]] = None,
-             rag_settings: RAGSettings = None) -> Tuple[str, str, str]:
+             rag_settings: RAGSettings = None,
+             prompt_settings: Optional[PromptSettings] = None) -> Tuple[str, str, str]:
 
-        def rag_context_builder(rag_sources: dict):
-            rag_tag_start = "<rag_source>"
-            rag_tag_end = "</rag_source>"
-            context_text_rag = "\n\nThe following text is context provided by RAG: \n"
-            return context_text_rag + "\n" + '\n'.join([rag_tag_start + x["content"] + rag_tag_end for x in rag_sources])
-
-
-        context_text_no_rag = "\n\nRAG did not find any relevant documents..."
         system_rag_instruct = (
             'Use RAG model provided context where it is appropriate. '
             'The input may contain retrieved context wrapped in <rag_source></rag_source> tags. '
@@ -73,64 +74,44 @@ class LLMRunner(ABC):
         system_text = system_prompt_history[0].content if len(system_prompt_history) > 0 else None
         if system_text is None:
             system_text = ctx.system_prompt if ctx.kb is None else ctx.system_prompt + system_rag_instruct
-        sys_message = {
-            'role': 'system',
-            'content': system_text
-        }
 
         failed_status = False
         try:
             llm_model = ctx.llm_model
             self.check_model_installed(llm_model)
-            context = ""
             reranked_rag_sources = None
             if ctx.kb is not None:
-                embedding_model = ctx.kb.embedding_config["model"]
-                self.check_model_installed(embedding_model)
-                retrieved_documents = ctx.kb.rag_lookup(
-                    self.get_embedding,
-                    user_input,
-                    rag_settings.rag_document_count,
-                )
-                logger.info(f"RAG used in room {room_state.room_id}! Document count: {str(len(retrieved_documents))}")
-                raw_rag_sources = [{"id": x[0].id, "similarity_score": x[1], "metadata": x[0].metadata,
-                                    "content": x[0].page_content}
-                                   for x in retrieved_documents]
-                rag_context = ""
-                reranked_rag_sources = rerank(raw_rag_sources, self.get_embedding(ctx.kb.embedding_config), rag_settings)
+                for embedding_model in set(x.embedding_config["model"] for x in ctx.kbs):
+                    self.check_model_installed(embedding_model)
+                if rag_settings.cache.enabled:
+                    reranked_rag_sources = get_retrieval_cache(rag_settings.cache).get_or_retrieve(
+                        ctx.kbs,
+                        user_input,
+                        rag_settings,
+                        lambda: self.retrieve_rag_sources(ctx, user_input, rag_settings),
+                        embed_query=lambda: self.get_embedding(ctx.kb.embedding_config).embed_query(user_input),
+                    )
+                else:
+                    reranked_rag_sources, _ = self.retrieve_rag_sources(ctx, user_input, rag_settings)
+
+            if prompt_settings is None:
+                prompt_settings = PromptSettings()
+            prompt = PromptBuilder(
+                lambda text: self.count_tokens(llm_model, text, prompt_settings.chars_per_token),
+                prompt_settings.prompt_budget(llm_model),
+                prompt_settings,
+            ).build(system_text, _history, user_input, reranked_rag_sources, room_state.prompt_window_start)
+            room_state.prompt_window_start = prompt.window_start
+            messages = prompt.messages
+            reranked_rag_sources = prompt.rag_sources
+            if reranked_rag_sources is not None:
                 if len(reranked_rag_sources) > 0:
-                    rag_context = rag_context_builder(reranked_rag_sources)
                     logger.info(f"After reranking documents of room {room_state.room_id}, relevant document count: {str(len(reranked_rag_sources))}")
-
-                if len(rag_context) == 0:
-                    rag_context = context_text_no_rag
+                else:
                     logger.info(f"RAG result in {room_state.room_id}: No relevant documents found!")
-                context += rag_context
-
-            user_message = {
-                'role': 'user',
-                'content': user_input + context,
-            }
-            if len(_history) == 0:
-                messages = [sys_message, user_message]
-            else:
-                messages = []
-                for message_item in history:
-                    context = ""
-                    if message_item.rag_sources is not None:
-                        rag_sources_used = json.loads(message_item.rag_sources)
-                        if rag_sources_used is not None:
-                            if len(rag_sources_used) > 0:
-                                context += rag_context_builder(rag_sources_used)
-                            else:
-                                context += context_text_no_rag
-                    messages.append(
-                        {
-                            "role": message_item.role,
-                            "content": message_item.content + context,
-                        }
-                    )
-                messages.append(user_message)
+            logger.info(f"Prompt tokens of room {room_state.room_id}: {prompt.token_usage}")
+            if update_callback is not None:
+                update_callback(MessageProgress("started", 0, 0, 0, token_usage=prompt.token_usage))
 
             assistant_text, failed_status = self.run_text_completion_streaming(model=llm_model, messages=messages, is_stopped=room_state.is_stopped, gen_guard=gen_guard, update_callback=update_callback)
             messages.append({"role": "assistant", "content": assistant_text})
@@ -141,6 +122,46 @@ class LLMRunner(ABC):
             room_state.stop()
         return system_text, assistant_text, json.dumps(reranked_rag_sources)
 
+    def retrieve_rag_sources(self, ctx: ChatContext, user_input: str,
+                             rag_settings: RAGSettings) -> Tuple[List[dict], bool]:
+        """
+        Reranked sources and whether every knowledge base answered, partial results should not be cached.
+        """
+        complete = True
+        if len(ctx.kbs) > 1:
+            retrieved_documents, report = federated_rag_lookup(
+                ctx.kbs,
+                self.get_embedding,
+                user_input,
+                rag_settings.rag_document_count,
+                rag_settings,
+                include_embeddings=True,
+            )
+            complete = all(x["status"] == "ok" for x in report)
+        else:
+            retrieved_documents = ctx.kb.rag_lookup(
+                self.get_embedding,
+                user_input,
+                rag_settings.rag_document_count,
+                include_embeddings=True,
+                rag_settings=rag_settings,
+            )
+        logger.info(f"RAG lookup in {[x.name for x in ctx.kbs]}! Document count: {str(len(retrieved_documents))}")
+        # Distances of knowledge bases with different embeddings are reranked apart
+        score_groups = {kb.name: embedding_key(kb.embedding_config) for kb in ctx.kbs}
+        raw_rag_sources = [{"id": x[0].id, "similarity_score": x[1], "metadata": x[0].metadata,
+                            "content": x[0].page_content, "embedding": x[2] if len(x) > 2 else None,
+                            "score_group": score_groups.get(x[0].metadata.get("knowledge_base"))}
+                           for x in retrieved_documents]
+        # Stored vectors are used for reranking, the embedding model is only needed if some are missing.
+        # Sources of knowledge bases with different embeddings are all embedded with the first one's model.
+        reranking_embedding = None
+        if any(x["embedding"] is None for x in raw_rag_sources):
+            reranking_embedding = self.get_embedding(ctx.kb.embedding_config)
+        reranked_rag_sources = rerank(raw_rag_sources, reranking_embedding, rag_settings)
+        # Vectors are not part of the sources saved with the message or cached
+        return [{k: v for k, v in x.items() if k not in ["embedding", "score_group"]} for x in reranked_rag_sources], complete
+
     @abstractmethod
     def run_text_completion_streaming(self, model: str, messages: List[dict], is_stopped: Callable[[], bool], gen_guard: Optional[GenerationGuard], update_callback: Callable[[MessageProgress], None], options: dict = None) -> Tuple[Optional[str], bool]:
         pass
@@ -149,6 +170,29 @@ class LLMRunner(ABC):
     def run_text_completion_simple(self, model: str, messages: List[dict], options: dict = None):
         pass
 
+    def run_text_completion_batch(self, model: str, messages_batch: List[List[dict]], options: dict = None,
+                                  concurrency: int = 1) -> List[Optional[str]]:
+        """
+        Runs independent completions, results keep the order of messages_batch. Failed completions are None.
+        Runners without batching send up to concurrency requests at once, one conversation per request.
+        """
+        def run_one(messages: List[dict]) -> Optional[str]:
+            try:
+                return self.run_text_completion_simple(model, messages, options)
+            except Exception as e:
+                logger.error(f"Completion with model {model} failed. Error: {e}")
+                return None
+
+        if concurrency <= 1 or len(messages_batch) <= 1:
+            return [run_one(x) for x in messages_batch]
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(messages_batch)),
+                                thread_name_prefix="llm_batch") as executor:
+            return list(executor.map(run_one, messages_batch))
+
+    def count_tokens(self, model: str, text: str, chars_per_token: float = 4.0) -> int:
+        # Runners with the tokenizer of the model at hand count exactly
+        return get_token_estimator().count(model, text, chars_per_token)
+
     @abstractmethod
     def get_embedding(self, embedding_config) -> Optional[Embeddings]:
         pass
@@ -157,6 +201,22 @@ class LLMRunner(ABC):
     def supports_thinking(self, model: str) -> Optional[bool]:
         pass
 
+    def http_stats(self) -> List[dict]:
+        # Connection pool stats of runners that talk to their models over HTTP
+        return []
+
+    def residency_stats(self) -> List[dict]:
+        # Models kept loaded in this process, only for runners that load models themselves
+        return []
+
+    def generation_stats(self) -> List[dict]:
+        # Prompt evaluation and generation timings, for runners whose server reports them
+        return []
+
+    def warm_up(self, model: str) -> bool:
+        # Loads the model ahead of the first request, False if the runner can not
+        return False
+
     @staticmethod
     @abstractmethod
     def from_dict(config: dict):
@@ -217,21 +277,47 @@ class SuperRunner(LLMRunner):
 
     def remove_model(self, model) -> bool:
         model_removed = False
-        for runner in self.runners:
-            if runner.is_model_installed(model):
-                runner.remove_model(model)
-                model_removed = True
+        try:
+            for runner in self.runners:
+                if runner.is_model_installed(model):
+                    runner.remove_model(model)
+                    model_removed = True
+        finally:
+            self.registry.invalidate(self.registry_owner)
         return model_removed
 
     def is_model_installed(self, model) -> bool:
-        for runner in self.runners:
-            is_installed = runner.is_model_installed(model)
-            if is_installed:
-                return True
-        return False
+        return self._runner_for(model) is not None
 
-    def __init__(self, runners: List[LLMRunner]):
+    def __init__(self, runners: List[LLMRunner], registry: Optional[ModelRegistry] = None):
         self.runners = runners
+        self.registry = registry if registry is not None else get_model_registry()
+        # Routes of every SuperRunner instance are kept apart, runners change with settings
+        self.registry_owner = f"super_runner-{uuid.uuid4()}"
+        self._track_registry_owner()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._track_registry_owner()
+
+    def _track_registry_owner(self):
+        # Routes of a discarded instance are dropped with it
+        weakref.finalize(self, self.registry.invalidate, self.registry_owner)
+
+    def close(self):
+        self.registry.invalidate(self.registry_owner)
+
+    def _find_runner(self, model) -> Optional[LLMRunner]:
+        for runner in self.runners:
+            if runner.is_model_installed(model):
+                return runner
+        return None
+
+    def _runner_for(self, model) -> Optional[LLMRunner]:
+        # model -> runner routing table, refreshed after the registry TTL or a pull/remove
+        # Models not found are looked up again on the next call, they may be pulled any moment
+        return self.registry.get(self.registry_owner, f"route:{model}", lambda: self._find_runner(model),
+                                 cache_none=False)
 
     def list_chat_models(self):
         models = []
@@ -247,19 +333,32 @@ class SuperRunner(LLMRunner):
     def run_text_completion_streaming(self, model: str, messages: List[dict], is_stopped: Callable[[], bool], gen_guard: Optional[GenerationGuard], update_callback: Callable[[MessageProgress], None], options: dict = None) -> Tuple[Optional[str], bool]:
         if options is None:
             options = {}
-        for runner in self.runners:
-            if runner.is_model_installed(model):
-                return runner.run_text_completion_streaming(model, messages, is_stopped, gen_guard, update_callback, options)
+        runner = self._runner_for(model)
+        if runner is not None:
+            return runner.run_text_completion_streaming(model, messages, is_stopped, gen_guard, update_callback, options)
         return None, True
 
     def run_text_completion_simple(self, model: str, messages: List[dict], options: dict = None):
         if options is None:
             options = {}
-        for runner in self.runners:
-            if runner.is_model_installed(model):
-                return runner.run_text_completion_simple(model, messages, options)
+        runner = self._runner_for(model)
+        if runner is not None:
+            return runner.run_text_completion_simple(model, messages, options)
         return None
 
+    def run_text_completion_batch(self, model: str, messages_batch: List[List[dict]], options: dict = None,
+                                  concurrency: int = 1) -> List[Optional[str]]:
+        runner = self._runner_for(model)
+        if runner is not None:
+            return runner.run_text_completion_batch(model, messages_batch, options, concurrency)
+        return [None for _ in messages_batch]
+
+    def count_tokens(self, model: str, text: str, chars_per_token: float = 4.0) -> int:
+        runner = self._runner_for(model)
+        if runner is not None:
+            return runner.count_tokens(model, text, chars_per_token)
+        return super().count_tokens(model, text, chars_per_token)
+
     def get_embedding(self, embedding_config: dict) -> Optional[Embeddings]:
         for runner in self.runners:
             embedding = runner.get_embedding(embedding_config)
@@ -268,12 +367,35 @@ class SuperRunner(LLMRunner):
         return None
 
     def supports_thinking(self, model: str) -> Optional[bool]:
-        for runner in self.runners:
-            supports_thinking = runner.supports_thinking(model)
-            if supports_thinking is not None:
-                return supports_thinking
+        runner = self._runner_for(model)
+        if runner is not None:
+            return runner.supports_thinking(model)
         return None
 
+    def http_stats(self) -> List[dict]:
+        stats = []
+        for runner in self.runners:
+            stats += runner.http_stats()
+        return stats
+
+    def residency_stats(self) -> List[dict]:
+        stats = []
+        for runner in self.runners:
+            stats += runner.residency_stats()
+        return stats
+
+    def generation_stats(self) -> List[dict]:
+        stats = []
+        for runner in self.runners:
+            stats += runner.generation_stats()
+        return stats
+
+    def warm_up(self, model: str) -> bool:
+        runner = self._runner_for(model)
+        if runner is not None:
+            return runner.warm_up(model)
+        return False
+
     def pull_model(self, model) -> bool:
         model_ready = False
         for runner in self.runners:
@@ -283,4 +405,5 @@ class SuperRunner(LLMRunner):
                 model_ready = runner.pull_model(model)
             except Exception:
                 pass
+        self.registry.invalidate(self.registry_owner)
         return model_ready
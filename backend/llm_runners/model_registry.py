@@ -0,0 +1,59 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+DEFAULT_TTL_S = 30.0
+
+
+class ModelRegistry:
+    """
+    Time limited cache of model metadata (installed models, model capabilities, model to runner routes).
+    Entries are grouped by owner, usually a runner host, so pulling or removing a model drops only that owner's entries.
+    """
+    def __init__(self, ttl_s: float = DEFAULT_TTL_S):
+        self.ttl_s = ttl_s
+        self.lock = threading.Lock()
+        self.entries: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __reduce__(self):
+        # Copies in conversion worker processes start empty, the shared registry stays the shared one there
+        if self is _model_registry:
+            return get_model_registry, ()
+        return ModelRegistry, (self.ttl_s,)
+
+    def get(self, owner: str, key: str, loader: Callable[[], Any], cache_none: bool = True) -> Any:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get((owner, key))
+            if entry is not None and now - entry[0] < self.ttl_s:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Loader errors are not cached, the next call tries again
+        value = loader()
+        if value is None and not cache_none:
+            return value
+        with self.lock:
+            self.entries[(owner, key)] = (time.monotonic(), value)
+        return value
+
+    def invalidate(self, owner: Optional[str] = None):
+        with self.lock:
+            if owner is None:
+                self.entries.clear()
+            else:
+                for entry_key in [x for x in self.entries.keys() if x[0] == owner]:
+                    del self.entries[entry_key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "ttl_s": self.ttl_s}
+
+
+_model_registry = ModelRegistry()
+
+
+def get_model_registry() -> ModelRegistry:
+    return _model_registry
@@ -0,0 +1,176 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from logger import logger
+from settings import ModelResidencySettings
+
+
+class ResidentModel:
+    def __init__(self, name: str, value: Any, size_bytes: int, load_s: float):
+        self.name = name
+        self.value = value
+        self.size_bytes = size_bytes
+        self.load_s = load_s
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+        self.uses = 0
+        self.in_use = 0
+
+    def to_dict(self, pinned: bool) -> dict:
+        return {
+            "model": self.name,
+            "size_gb": round(self.size_bytes / 1024 ** 3, 3),
+            "load_s": round(self.load_s, 3),
+            "loaded_at": self.loaded_at,
+            "uses": self.uses,
+            "in_use": self.in_use,
+            "pinned": pinned,
+        }
+
+
+class ModelResidencyManager:
+    """
+    Keeps loaded models in memory between requests. When a new model does not fit into max_models or the memory
+    budget, least recently used models that are neither pinned nor in use are unloaded first.
+    """
+    def __init__(self, settings: Optional[ModelResidencySettings] = None):
+        self.lock = threading.Lock()
+        self.models: Dict[str, ResidentModel] = {}
+        # One lock per model name, so a model is loaded once even if requested from several threads
+        self.load_locks: Dict[str, threading.Lock] = {}
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.settings = settings if settings is not None else ModelResidencySettings()
+
+    def __reduce__(self):
+        # Loaded models are not sent to other processes, a copy there loads its own
+        if self is _residency_manager:
+            return get_residency_manager, ()
+        return ModelResidencyManager, (self.settings,)
+
+    def configure(self, settings: ModelResidencySettings):
+        with self.lock:
+            self.settings = settings
+            self._evict(0)
+
+    def _is_pinned(self, name: str) -> bool:
+        return name in self.settings.pinned
+
+    def _evict(self, incoming_bytes: int, incoming: int = 0):
+        # Caller holds self.lock
+        budget = self.settings.memory_budget_bytes
+        while True:
+            used_bytes = sum(x.size_bytes for x in self.models.values())
+            over_count = len(self.models) + incoming > self.settings.max_models
+            over_budget = budget > 0 and used_bytes + incoming_bytes > budget
+            if not over_count and not over_budget:
+                return
+            candidates = [x for x in self.models.values() if x.in_use == 0 and not self._is_pinned(x.name)]
+            if len(candidates) == 0:
+                logger.warning(f"Model residency over limits, nothing can be unloaded. Used: {used_bytes} bytes, "
+                               f"{len(self.models)} model(s)")
+                return
+            victim = min(candidates, key=lambda x: x.last_used)
+            del self.models[victim.name]
+            self.evictions += 1
+            logger.info(f"Unloaded model {victim.name}, last used {time.monotonic() - victim.last_used:.0f}s ago")
+
+    def _touch(self, resident: ResidentModel, lease: bool):
+        # Caller holds self.lock
+        resident.last_used = time.monotonic()
+        resident.uses += 1
+        if lease:
+            resident.in_use += 1
+
+    def _acquire(self, name: str, loader: Callable[[], Any], size_hint: int,
+                 size_of: Optional[Callable[[Any], int]], lease: bool) -> ResidentModel:
+        with self.lock:
+            resident = self.models.get(name)
+            if resident is not None:
+                self.hits += 1
+                self._touch(resident, lease)
+                return resident
+            load_lock = self.load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            with self.lock:
+                resident = self.models.get(name)
+                if resident is not None:
+                    self.hits += 1
+                    self._touch(resident, lease)
+                    return resident
+                self._evict(size_hint, 1)
+            started = time.perf_counter()
+            value = loader()
+            load_s = time.perf_counter() - started
+            size_bytes = size_hint
+            if size_of is not None:
+                try:
+                    size_bytes = size_of(value)
+                except Exception as e:
+                    logger.warning(f"Could not get memory footprint of {name}. Error: {e}")
+            resident = ResidentModel(name, value, size_bytes, load_s)
+            with self.lock:
+                self.models[name] = resident
+                self.loads += 1
+                self._touch(resident, lease)
+            logger.info(f"Loaded model {name} in {load_s:.2f}s ({size_bytes / 1024 ** 3:.2f} GB)")
+            return resident
+
+    def get(self, name: str, loader: Callable[[], Any], size_hint: int = 0,
+            size_of: Optional[Callable[[Any], int]] = None) -> Any:
+        return self._acquire(name, loader, size_hint, size_of, False).value
+
+    @contextmanager
+    def use(self, name: str, loader: Callable[[], Any], size_hint: int = 0,
+            size_of: Optional[Callable[[Any], int]] = None) -> Iterator[Any]:
+        # Models in use are not unloaded until the block exits
+        resident = self._acquire(name, loader, size_hint, size_of, True)
+        try:
+            yield resident.value
+        finally:
+            with self.lock:
+                resident.in_use -= 1
+                resident.last_used = time.monotonic()
+
+    def preload(self, name: str, loader: Callable[[], Any], size_hint: int = 0,
+                size_of: Optional[Callable[[Any], int]] = None) -> threading.Thread:
+        def _preload():
+            try:
+                self._acquire(name, loader, size_hint, size_of, False)
+            except Exception as e:
+                logger.error(f"Could not preload model {name}. Error: {e}")
+
+        thread = threading.Thread(target=_preload, name=f"preload_{name}", daemon=True)
+        thread.start()
+        return thread
+
+    def evict(self, name: str) -> bool:
+        with self.lock:
+            return self.models.pop(name, None) is not None
+
+    def is_resident(self, name: str) -> bool:
+        with self.lock:
+            return name in self.models
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "models": [x.to_dict(self._is_pinned(x.name)) for x in self.models.values()],
+                "used_gb": round(sum(x.size_bytes for x in self.models.values()) / 1024 ** 3, 3),
+                "memory_budget_gb": self.settings.memory_budget_gb,
+                "max_models": self.settings.max_models,
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions,
+            }
+
+
+_residency_manager = ModelResidencyManager()
+
+
+def get_residency_manager() -> ModelResidencyManager:
+    # Shared, runners are recreated on every settings change but loaded models should stay
+    return _residency_manager
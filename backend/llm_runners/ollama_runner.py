@@ -1,15 +1,21 @@
 import datetime
 import json
-from typing import Optional, List, Callable, Tuple
+import threading
+import time
+from typing import Optional, List, Callable, Tuple, Set
 
-import requests
 from langchain_ollama import OllamaEmbeddings
 
 from domain import MessageProgress
+from llm_runners.generation_stats import GenerationStats
+from llm_runners.http_session import HttpSession
 from llm_runners.llm_runner import LLMRunner, RANDOM_SEED, MAX_TOKENS_LIMIT
+from llm_runners.model_registry import ModelRegistry, get_model_registry
 from utils import utc_now
 from logger import logger
 from generation_guard import GenerationGuard
+from prompt_builder import MESSAGE_OVERHEAD_TOKENS, get_token_estimator
+from settings import HttpSettings, KeepAliveSettings
 
 
 class OllamaRunner(LLMRunner):
@@ -18,27 +24,76 @@ class OllamaRunner(LLMRunner):
         runner = None
         try:
             if config.get('type') == 'ollama':
-                runner = OllamaRunner(config['host'])
+                runner = OllamaRunner(config['host'], http_settings=HttpSettings.from_runner_config(config),
+                                      keep_alive_settings=KeepAliveSettings.from_runner_config(config))
         except Exception as e:
             logger.error(f"Could not create Ollama runner from config. Reason: {e}")
         return runner
 
-    def __init__(self, host: str):
+    def __init__(self, host: str, registry: Optional[ModelRegistry] = None, http_settings: Optional[HttpSettings] = None,
+                 keep_alive_settings: Optional[KeepAliveSettings] = None):
         if host.endswith('/'):
             host = host[:-1]
         self.host = host
+        self.registry = registry if registry is not None else get_model_registry()
+        self.http = HttpSession(http_settings)
+        self.keep_alive = keep_alive_settings if keep_alive_settings is not None else KeepAliveSettings()
+        self.generation_timings = GenerationStats()
+        self.warming_up: Set[str] = set()
+        self.warming_up_lock = threading.Lock()
 
-    def list_chat_models(self) -> List[str]:
-        completion_models = []
-        model_list = json.loads(requests.get(f"{self.host}/api/tags").content)["models"]
-        for model in model_list:
-            model_info = json.loads(
-                requests.post(
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["warming_up_lock"]
+        state["warming_up"] = set()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.warming_up_lock = threading.Lock()
+
+    def _payload(self, model: str, **payload) -> dict:
+        # Options stay the same from request to request, a change of them reloads the model
+        keep_alive = self.keep_alive.for_model(model)
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+        return {"model": model, **payload}
+
+    def _record_timings(self, model: str, messages: List[dict], response: dict):
+        last = self.generation_timings.record(model, response)
+        if last is None or last["prompt_tokens"] <= 0:
+            return
+        # Prompts evaluated in full correct the token estimate of the model. With a reused prompt cache fewer
+        # tokens are evaluated than estimated, those counts are left out
+        estimator = get_token_estimator()
+        chars = sum(len(x.get("content", "")) for x in messages)
+        tokens = last["prompt_tokens"] - MESSAGE_OVERHEAD_TOKENS * len(messages)
+        if tokens > 0 and tokens >= estimator.count(model, " " * chars):
+            estimator.calibrate(model, chars, tokens)
+
+    def _installed_models(self) -> List[dict]:
+        return self.registry.get(
+            self.host, "tags",
+            lambda: json.loads(self.http.get(f"{self.host}/api/tags").content)["models"]
+        )
+
+    def _model_info(self, model: str) -> dict:
+        return self.registry.get(
+            self.host, f"show:{model}",
+            lambda: json.loads(
+                self.http.post(
                     self.host + '/api/show',
-                    data='{"model": "' + model["model"] + '"}',
+                    data=json.dumps({"model": model}),
                     headers={'Content-Type': 'application/json'}
                 ).content
             )
+        )
+
+    def list_chat_models(self) -> List[str]:
+        completion_models = []
+        model_list = self._installed_models()
+        for model in model_list:
+            model_info = self._model_info(model["model"])
             if 'completion' in model_info['capabilities']:
                 completion_models.append(model["model"])
         return completion_models
@@ -54,17 +109,12 @@ class OllamaRunner(LLMRunner):
         if gen_guard is None:
             gen_guard = GenerationGuard()
         url = f"{self.host}/api/chat"
-        payload = {
-            "model": model,
-            "messages": messages,
-            "stream": True,
-            "options": _options
-        }
+        payload = self._payload(model, messages=messages, stream=True, options=_options)
         assistant_text = ''
         num_chunks = 0
         last_timestamp: Optional[datetime.datetime] = None
         try:
-            with requests.post(url, json=payload, stream=True) as r:
+            with self.http.stream("POST", url, json=payload) as r:
                 if r.status_code != 200:
                     logger.error(f"STATUS: {r.status_code}. Message: {r.text}")
                     failed_status = True
@@ -83,6 +133,7 @@ class OllamaRunner(LLMRunner):
                     data = json.loads(line.decode("utf-8"))
 
                     if data.get("done"):
+                        self._record_timings(model, messages, data)
                         break
                     if data.get("error"):
                         raise(Exception(f"{data["error"]}"))
@@ -137,23 +188,25 @@ class OllamaRunner(LLMRunner):
         _options.update(options)
 
         url = f"{self.host}/api/chat"
-        payload = {
-            "model": model,
-            "messages": messages,
-            "stream": False,
-            "options": _options
-        }
+        payload = self._payload(model, messages=messages, stream=False, options=_options)
 
-        with requests.post(url, json=payload, stream=True) as r:
-            # Only "content" is relevant for RAG document prep.
-            return r.json()["message"]["content"]
+        response = self.http.post(url, json=payload).json()
+        self._record_timings(model, messages, response)
+        # Only "content" is relevant for RAG document prep.
+        return response["message"]["content"]
 
 
     def get_embedding(self, embedding_config: dict) -> Optional[OllamaEmbeddings]:
         allowed_parameters = ["model"]
         filtered_embedding_config = {parameter: embedding_config[parameter] for parameter in allowed_parameters if embedding_config.get(parameter) is not None}
+        keep_alive = self.keep_alive.for_model(embedding_config.get("model"))
+        if keep_alive is not None:
+            filtered_embedding_config["keep_alive"] = keep_alive
         try:
-            return OllamaEmbeddings(base_url=self.host, validate_model_on_init=True, **filtered_embedding_config)
+            # The embedding client keeps its own keep-alive connections
+            return OllamaEmbeddings(base_url=self.host, validate_model_on_init=True,
+                                    client_kwargs={"timeout": self.http.settings.read_timeout_s},
+                                    **filtered_embedding_config)
         except ValueError as ve:
             # validation error is OK, if model is not expected to be in this runner
             if not "validation error" in str(ve):
@@ -163,49 +216,77 @@ class OllamaRunner(LLMRunner):
         return None
 
     def check_model_installed(self, model):
-        model_list = json.loads(requests.get(f"{self.host}/api/tags").content)["models"]
+        model_list = self._installed_models()
         if not self.is_model_installed(model):
             logger.error(f"[LLM_MODEL_NOT_FOUND]_{model}_{utc_now().isoformat()}")
             raise ValueError(
                 f"Model {repr(model)} not installed! Available models: {';'.join([x["model"] for x in model_list])}")
 
     def is_model_installed(self, model) -> bool:
-        model_list = json.loads(requests.get(f"{self.host}/api/tags").content)["models"]
+        model_list = self._installed_models()
         return model in [x["model"] for x in model_list] and model is not None
 
+    def http_stats(self) -> List[dict]:
+        return [{"runner": "ollama", "host": self.host, **self.http.stats.to_dict()}]
+
+    def generation_stats(self) -> List[dict]:
+        return [{"runner": "ollama", "host": self.host, "models": self.generation_timings.to_dict()}]
+
+    def warm_up(self, model: str) -> bool:
+        # An empty prompt loads the model and starts its keep_alive without generating anything
+        with self.warming_up_lock:
+            if model in self.warming_up:
+                return True
+            self.warming_up.add(model)
+        try:
+            started = time.perf_counter()
+            response = self.http.post(f"{self.host}/api/generate", json=self._payload(model, prompt="", stream=False))
+            if response.status_code != 200:
+                logger.error(f"Could not warm up model {model}. STATUS: {response.status_code}. Message: {response.text}")
+                return False
+            logger.info(f"Model {model} ready in {time.perf_counter() - started:.2f}s")
+            return True
+        except Exception as e:
+            logger.error(f"Could not warm up model {model}. Error: {e}")
+            return False
+        finally:
+            with self.warming_up_lock:
+                self.warming_up.discard(model)
+
     def supports_thinking(self, model: str) -> Optional[bool]:
         if self.is_model_installed(model):
-            model_info = json.loads(
-                requests.post(
-                    f"{self.host}/api/show",
-                    data=json.dumps({"model": model}),
-                    headers={'Content-Type': 'application/json'}
-                ).content
-            )
-            return "thinking" in model_info["capabilities"]
+            return "thinking" in self._model_info(model)["capabilities"]
         return None
 
     def pull_model(self, model):
         # {"status": "success" or "error": "<error message>"}
-        response = json.loads(
-            requests.post(
-                self.host + '/api/pull',
-                data=json.dumps({"name": model, "stream": False}),
-                headers={'Content-Type': 'application/json'}
-            ).content
-        )
+        try:
+            response = json.loads(
+                self.http.post(
+                    self.host + '/api/pull',
+                    data=json.dumps({"name": model, "stream": False}),
+                    headers={'Content-Type': 'application/json'},
+                    # Nothing is sent back until the whole model is downloaded
+                    timeout=(self.http.settings.connect_timeout_s, None),
+                ).content
+            )
+        finally:
+            self.registry.invalidate(self.host)
         if "error" in response.keys():
             return False
         return True
 
     def remove_model(self, model) -> bool:
-        response = json.loads(
-            requests.post(
-                self.host + '/api/delete',
-                data=json.dumps({"name": model}),
-                headers={'Content-Type': 'application/json'}
-            ).content
-        )
+        try:
+            response = json.loads(
+                self.http.post(
+                    self.host + '/api/delete',
+                    data=json.dumps({"name": model}),
+                    headers={'Content-Type': 'application/json'}
+                ).content
+            )
+        finally:
+            self.registry.invalidate(self.host)
         if "error" in response.keys():
             return False
         return True
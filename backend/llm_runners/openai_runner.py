@@ -4,16 +4,17 @@ import os.path
 import shutil
 from typing import Optional, List, Callable, Tuple
 
-import requests
 from langchain_core.embeddings import Embeddings
 from langchain_openai import OpenAIEmbeddings
 from pydantic import SecretStr
 
 from domain import MessageProgress
 from generation_guard import GenerationGuard
+from llm_runners.http_session import HttpSession
 from llm_runners.llm_runner import LLMRunner, MAX_TOKENS_LIMIT
 
 from logger import logger
+from settings import HttpSettings
 
 from utils import utc_now
 
@@ -24,14 +25,15 @@ class OpenAIRunner(LLMRunner):
         runner = None
         try:
             if config.get('type') == 'openai':
-                runner = OpenAIRunner(api_key=config["api_key"])
+                runner = OpenAIRunner(api_key=config["api_key"], http_settings=HttpSettings.from_runner_config(config))
         except Exception as e:
             logger.error(f"Could not create Ollama runner from config. Reason: {e}")
         return runner
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, http_settings: Optional[HttpSettings] = None):
         self.host_api = "https://api.openai.com/v1"
         self.api_key = api_key
+        self.http = HttpSession(http_settings)
         self._model_list_file = "openai_models.json"
         if os.path.exists(self._model_list_file):
             with open(self._model_list_file, "r") as fh:
@@ -63,7 +65,7 @@ class OpenAIRunner(LLMRunner):
     def get_openai_models(self) -> List[str]:
         if self.last_update is None or datetime.datetime.now(datetime.UTC) - self.last_update > datetime.timedelta(days=1):
             response = json.loads(
-                requests.get(
+                self.http.get(
                     f"{self.host_api}/models",
                     headers={"Authorization": f"Bearer {self.api_key}"}
                 ).content
@@ -74,7 +76,7 @@ class OpenAIRunner(LLMRunner):
 
     def is_model_installed(self, model) -> bool:
         response = json.loads(
-            requests.get(
+            self.http.get(
                 f"{self.host_api}/models/{model}",
                 headers={"Authorization": f"Bearer {self.api_key}"}
             ).content
@@ -124,7 +126,7 @@ class OpenAIRunner(LLMRunner):
         num_chunks = 0
         last_timestamp: Optional[datetime.datetime] = None
         try:
-            with requests.post(url, headers=headers, json=payload, stream=True) as r:
+            with self.http.stream("POST", url, headers=headers, json=payload) as r:
                 if r.status_code != 200:
                     logger.error(f"STATUS: {r.status_code}. Message: {r.text}")
                     failed_status = True
@@ -214,14 +216,18 @@ class OpenAIRunner(LLMRunner):
             **_options
         }
 
-        with requests.post(url, headers=headers, json=payload, stream=True) as r:
-            return r.json()["output"][0]["content"][0]["text"]
+        return self.http.post(url, headers=headers, json=payload).json()["output"][0]["content"][0]["text"]
 
     def get_embedding(self, embedding_config) -> Optional[Embeddings]:
         if self.is_model_installed(embedding_config["model"]):
-            return OpenAIEmbeddings(model=embedding_config["model"], api_key=SecretStr(self.api_key))
+            return OpenAIEmbeddings(model=embedding_config["model"], api_key=SecretStr(self.api_key),
+                                    max_retries=self.http.settings.retries,
+                                    request_timeout=self.http.settings.read_timeout_s)
         return None
 
+    def http_stats(self) -> List[dict]:
+        return [{"runner": "openai", "host": self.host_api, **self.http.stats.to_dict()}]
+
     def supports_thinking(self, model: str) -> Optional[bool]:
         """
         OpenAI library does not provide a way to tell programmatically if the model is reasoning (thinking) or not.
@@ -2,11 +2,18 @@ import os
 import shutil
 import subprocess
 import uuid
-from typing import List, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
 from pdf2image import convert_from_path
+from pypdf import PdfReader
 
 from logger import logger
 
+DEFAULT_DPI = 300
+PAGE_IMAGE_PREFIX = "page"
+
 
 def make_absolute_path(path):
     if os.path.isabs(path):
@@ -15,18 +22,25 @@ def make_absolute_path(path):
         return os.path.abspath(os.path.join(os.getcwd(), path))
 
 
-def convert_pdf(pdf_path: str, output_folder: str = "temp_images") -> Optional[List[str]]:
+def convert_pdf(pdf_path: str, output_folder: str = "temp_images", dpi: int = DEFAULT_DPI, workers: int = 1,
+                pages_per_range: int = 0) -> Optional[List[str]]:
+    if workers > 1 or pages_per_range > 0:
+        try:
+            return list(iter_pdf_pages(pdf_path, output_folder, dpi, workers, pages_per_range))
+        except Exception as e:
+            logger.error(f"Could not convert pdf to images! File: {pdf_path}. Error: {e}")
+            return None
     pdf_path = make_absolute_path(pdf_path)
     temp_folder = os.path.join(os.getcwd(), output_folder)
     paths = None
     if not get_xpdf_path() == "__disabled__":
         try:
-            paths = xpdf_convert(pdf_path, temp_folder)
+            paths = xpdf_convert(pdf_path, temp_folder, dpi=dpi)
         except Exception as e:
             logger.error(f"XPDF could not convert pdf. Error: {e}")
     if paths is None and not get_poppler_path() == "__disabled__":
         try:
-            paths = poppler_convert(pdf_path, temp_folder)
+            paths = poppler_convert(pdf_path, temp_folder, dpi=dpi)
         except Exception as e:
             logger.error(f"POPPLER could not convert pdf. Error: {e}")
     if paths is None:
@@ -34,7 +48,110 @@ def convert_pdf(pdf_path: str, output_folder: str = "temp_images") -> Optional[L
     return paths
 
 
-def xpdf_convert(pdf_path: str, output: str) -> List[str]:
+def get_page_count(pdf_path: str) -> Optional[int]:
+    try:
+        return len(PdfReader(pdf_path).pages)
+    except Exception as e:
+        logger.error(f"Could not read page count of {pdf_path}. Error: {e}")
+        return None
+
+
+def split_page_ranges(page_count: int, pages_per_range: int) -> List[Tuple[int, int]]:
+    return split_page_list(range(1, page_count + 1), pages_per_range)
+
+
+def split_page_list(pages: Iterable[int], pages_per_range: int) -> List[Tuple[int, int]]:
+    # Consecutive pages are grouped into ranges of at most pages_per_range pages
+    pages_per_range = max(1, pages_per_range)
+    ranges = []
+    for page in sorted(set(pages)):
+        if len(ranges) > 0 and page == ranges[-1][1] + 1 and page - ranges[-1][0] < pages_per_range:
+            ranges[-1] = (ranges[-1][0], page)
+        else:
+            ranges.append((page, page))
+    return ranges
+
+
+def page_image_name(page_number: int) -> str:
+    # Page number goes after the last "-", knowledge bases read it back from the file stem
+    return f"{PAGE_IMAGE_PREFIX}-{page_number:06d}.png"
+
+
+def iter_pdf_pages(pdf_path: str, output_folder: str = "temp_images", dpi: int = DEFAULT_DPI, workers: int = 1,
+                   pages_per_range: int = 0, pages: Optional[List[int]] = None) -> Iterator[str]:
+    """
+    Renders page ranges in parallel and yields page images in page order as soon as their range is done.
+    Only a few ranges are rendered ahead of the consumer, so temp images do not pile up for long documents.
+    pages limits rendering to the given page numbers, all pages are rendered by default.
+    """
+    pdf_path = make_absolute_path(pdf_path)
+    output = os.path.join(os.getcwd(), output_folder)
+    if pages is None:
+        page_count = get_page_count(pdf_path)
+        if page_count is None:
+            raise RuntimeError(f"Could not convert pdf to images! File: {pdf_path}")
+        pages = list(range(1, page_count + 1))
+    if len(pages) == 0:
+        return
+    workers = max(1, workers)
+    if pages_per_range <= 0:
+        # Evenly spread pages over the workers
+        pages_per_range = -(-len(pages) // workers)
+    os.makedirs(output, exist_ok=True)
+    ranges = deque(split_page_list(pages, pages_per_range))
+    # Rendering happens in pdftopng/pdftoppm subprocesses, threads only wait for them
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf_render") as executor:
+        futures = deque()
+        try:
+            while len(ranges) > 0 or len(futures) > 0:
+                while len(ranges) > 0 and len(futures) <= workers:
+                    first_page, last_page = ranges.popleft()
+                    futures.append(executor.submit(render_page_range, pdf_path, output, first_page, last_page, dpi))
+                paths = futures.popleft().result()
+                if paths is None:
+                    raise RuntimeError(f"Could not convert pdf to images! File: {pdf_path}")
+                for path in paths:
+                    yield path
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def render_page_range(pdf_path: str, output: str, first_page: int, last_page: int,
+                      dpi: int = DEFAULT_DPI) -> Optional[List[str]]:
+    range_folder = os.path.join(output, f"range-{first_page:06d}-{uuid.uuid4().hex}")
+    paths = None
+    try:
+        if not get_xpdf_path() == "__disabled__":
+            try:
+                paths = xpdf_convert(pdf_path, range_folder, first_page, last_page, dpi)
+                if len(paths) != last_page - first_page + 1:
+                    logger.error(f"XPDF rendered {len(paths)} pages of {first_page}-{last_page}. File: {pdf_path}")
+                    paths = None
+            except Exception as e:
+                logger.error(f"XPDF could not convert pages {first_page}-{last_page}. Error: {e}")
+        if paths is None and not get_poppler_path() == "__disabled__":
+            try:
+                paths = poppler_convert(pdf_path, range_folder, first_page, last_page, dpi)
+            except Exception as e:
+                logger.error(f"POPPLER could not convert pages {first_page}-{last_page}. Error: {e}")
+        if paths is None:
+            return None
+        # Renderers pad page numbers differently, rename to one scheme that sorts in page order
+        paths = sorted(paths, key=lambda x: int(Path(x).stem.split("-")[-1]))
+        result = []
+        for page_number, path in enumerate(paths, first_page):
+            page_path = os.path.join(output, page_image_name(page_number))
+            shutil.move(path, page_path)
+            result.append(page_path)
+        return result
+    finally:
+        if os.path.exists(range_folder):
+            shutil.rmtree(range_folder)
+
+
+def xpdf_convert(pdf_path: str, output: str, first_page: Optional[int] = None, last_page: Optional[int] = None,
+                 dpi: int = DEFAULT_DPI) -> List[str]:
     """
     OPTIONS:
     −f number - Specifies the first page to convert.
@@ -62,7 +179,11 @@ def xpdf_convert(pdf_path: str, output: str) -> List[str]:
         shutil.rmtree(output)
     os.makedirs(output, exist_ok=True)
 
-    args = ["-r", "300"]
+    args = ["-r", str(dpi)]
+    if first_page is not None:
+        args += ["-f", str(first_page)]
+    if last_page is not None:
+        args += ["-l", str(last_page)]
     subprocess.run(
         [xpdf_path] + args + [pdf_path, prefix],
         cwd=output,
@@ -78,14 +199,18 @@ def get_xpdf_path() -> str:
 def get_poppler_path() -> str:
     return make_absolute_path(os.environ.get("POPPLER_PATH", "/usr/bin"))
 
-def poppler_convert(pdf_path: str, output: str) -> List[str]:
+def poppler_convert(pdf_path: str, output: str, first_page: Optional[int] = None, last_page: Optional[int] = None,
+                    dpi: int = DEFAULT_DPI) -> List[str]:
+    os.makedirs(output, exist_ok=True)
     # Library telling lies about output type. If paths_only=True, then List[str], not List[Image]
     # noinspection PyTypeChecker
     images: List[str] = convert_from_path(
         pdf_path=pdf_path,
-        dpi=300,
+        dpi=dpi,
         poppler_path=get_poppler_path(),
         output_folder=output,
+        first_page=first_page,
+        last_page=last_page,
         paths_only=True,
         fmt="png",
     )
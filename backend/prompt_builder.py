@@ -0,0 +1,235 @@
+import hashlib
+import json
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from domain import RoomMessage
+from logger import logger
+from settings import PromptSettings
+
+RAG_TAG_START = "<rag_source>"
+RAG_TAG_END = "</rag_source>"
+RAG_CONTEXT_TEXT = "\n\nThe following text is context provided by RAG: \n"
+NO_RAG_CONTEXT_TEXT = "\n\nRAG did not find any relevant documents..."
+SUMMARY_TEXT = "\n\nEarlier turns of this conversation were left out. In them the user asked:\n"
+# Role markers and separators the chat template adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_QUESTION_CHARS = 200
+
+
+def rag_context(rag_sources: List[dict]) -> str:
+    return RAG_CONTEXT_TEXT + "\n" + '\n'.join([RAG_TAG_START + x["content"] + RAG_TAG_END for x in rag_sources])
+
+
+def source_key(source: dict) -> str:
+    if source.get("id") is not None:
+        return str(source["id"])
+    return hashlib.sha256(source.get("content", "").encode("utf-8")).hexdigest()
+
+
+class TokenEstimator:
+    """
+    Token counts of models whose tokenizer is not at hand, from a characters per token ratio per model.
+    The ratio starts at chars_per_token and follows the prompt token counts runners report for the model.
+    """
+    SMOOTHING = 0.3
+    MIN_CHARS_PER_TOKEN = 1.0
+    MAX_CHARS_PER_TOKEN = 8.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ratios: Dict[str, float] = {}
+
+    def ratio(self, model: str, chars_per_token: float = 4.0) -> float:
+        with self.lock:
+            return self.ratios.get(model, chars_per_token)
+
+    def count(self, model: str, text: str, chars_per_token: float = 4.0) -> int:
+        return math.ceil(len(text) / self.ratio(model, chars_per_token))
+
+    def calibrate(self, model: str, chars: int, tokens: int):
+        if chars <= 0 or tokens <= 0:
+            return
+        with self.lock:
+            ratio = min(TokenEstimator.MAX_CHARS_PER_TOKEN, max(TokenEstimator.MIN_CHARS_PER_TOKEN, chars / tokens))
+            current = self.ratios.get(model)
+            self.ratios[model] = ratio if current is None else \
+                current + TokenEstimator.SMOOTHING * (ratio - current)
+
+
+_estimator = TokenEstimator()
+
+
+def get_token_estimator() -> TokenEstimator:
+    return _estimator
+
+
+class Prompt:
+    def __init__(self, messages: List[dict], rag_sources: Optional[List[dict]], token_usage: dict,
+                 window_start: Optional[int] = None):
+        self.messages = messages
+        # Sources of this turn that fit in the budget
+        self.rag_sources = rag_sources
+        self.token_usage = token_usage
+        # Id of the oldest history message sent, the next turn starts its window there
+        self.window_start = window_start
+
+
+class PromptBuilder:
+    """
+    Messages of one chat turn that fit in the prompt budget of the model.
+    The system message and the user input always go in, then as many RAG sources of this turn as fit, best first,
+    then the history window. History RAG context goes with user messages only, and sources already given earlier
+    in the window are not repeated.
+    The window keeps its start from turn to turn, so the messages before the new turn are sent exactly as before and
+    the server can reuse the prompt cache of that prefix. Once the window does not fit, it moves on by
+    window_slack of the budget at once.
+    """
+    def __init__(self, count_tokens: Callable[[str], int], budget: int, settings: Optional[PromptSettings] = None):
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.settings = settings if settings is not None else PromptSettings()
+
+    def _message_tokens(self, content: str) -> int:
+        return self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+    def _turn_rag_sources(self, rag_sources: List[dict], available: int) -> List[dict]:
+        # Reranked sources are best first, the worst ones are left out
+        sources = list(rag_sources)
+        while len(sources) > 0 and self.count_tokens(rag_context(sources)) > available:
+            sources.pop()
+        return sources
+
+    def _history_context(self, message: RoomMessage, seen: Optional[set]) -> Tuple[str, int]:
+        # RAG context of a history message and the count of its sources left out as repeated
+        if message.role != "user" or message.rag_sources is None:
+            return "", 0
+        try:
+            sources = json.loads(message.rag_sources)
+        except ValueError as e:
+            logger.warning(f"Could not read RAG sources of message {message.id}. Error: {e}")
+            return "", 0
+        if sources is None:
+            return "", 0
+        if len(sources) == 0:
+            return NO_RAG_CONTEXT_TEXT, 0
+        repeated = 0
+        if seen is not None:
+            new_sources = [x for x in sources if source_key(x) not in seen]
+            repeated = len(sources) - len(new_sources)
+            sources = new_sources
+            seen.update(source_key(x) for x in sources)
+        return (rag_context(sources) if len(sources) > 0 else ""), repeated
+
+    def _window(self, history: List[RoomMessage], start: int) -> Tuple[List[dict], set, int, int]:
+        # Messages from start on, oldest first, so the context of a message does not depend on later turns
+        kept = []
+        seen = set()
+        tokens = 0
+        deduplicated = 0
+        for message in history[start:]:
+            message_context, repeated = self._history_context(
+                message, seen if self.settings.dedupe_rag_sources else None)
+            kept.append({"role": message.role, "content": message.content + message_context})
+            tokens += self._message_tokens(message.content + message_context)
+            deduplicated += repeated
+        return kept, seen, tokens, deduplicated
+
+    def _slide(self, history: List[RoomMessage], start: int, target: int) -> int:
+        # New window start whose messages fit in target tokens even without leaving out repeated sources
+        tokens = 0
+        index = len(history)
+        while index > start:
+            message = history[index - 1]
+            tokens += self._message_tokens(message.content + self._history_context(message, None)[0])
+            if tokens > target:
+                break
+            index -= 1
+        # The window starts with a question, not with an answer to a question that was left out
+        while index < len(history) and history[index].role != "user":
+            index += 1
+        return index
+
+    def _summary(self, dropped: List[RoomMessage], available: int) -> str:
+        lines = []
+        tokens = self.count_tokens(SUMMARY_TEXT)
+        for message in reversed(dropped):
+            if message.role != "user":
+                continue
+            question = " ".join(message.content.split())
+            if len(question) > SUMMARY_QUESTION_CHARS:
+                question = question[:SUMMARY_QUESTION_CHARS] + "..."
+            line = f"- {question}"
+            line_tokens = self.count_tokens(line) + 1
+            if tokens + line_tokens > available:
+                break
+            lines.append(line)
+            tokens += line_tokens
+        if len(lines) == 0:
+            return ""
+        return SUMMARY_TEXT + "\n".join(reversed(lines))
+
+    def build(self, system_text: str, history: List[RoomMessage], user_input: str,
+              rag_sources: Optional[List[dict]], window_start: Optional[int] = None) -> Prompt:
+        """
+        rag_sources are the reranked sources of this turn, None if no knowledge base is used.
+        window_start is the window start of the previous turn, see Prompt.window_start.
+        """
+        system_tokens = self._message_tokens(system_text)
+        user_tokens = self._message_tokens(user_input)
+        used_sources = rag_sources
+        if rag_sources is not None and len(rag_sources) > 0:
+            used_sources = self._turn_rag_sources(rag_sources, self.budget - system_tokens - user_tokens)
+        rag_tokens = self.count_tokens(rag_context(used_sources)) if used_sources else 0
+
+        history = [x for x in history if not x.failed and x.role != "system"]
+        # Room for the summary of the turns that do not fit
+        summary_reserve = self.settings.summary_tokens if self.settings.summarize_dropped else 0
+        history_budget = max(0, self.budget - system_tokens - user_tokens - rag_tokens - summary_reserve)
+        start = 0
+        if window_start is not None:
+            start = next((i for i, x in enumerate(history) if x.id == window_start), 0)
+        kept, seen, history_tokens, deduplicated = self._window(history, start)
+        if history_tokens > history_budget:
+            start = self._slide(history, start, int(history_budget * (1 - self.settings.window_slack)))
+            kept, seen, history_tokens, deduplicated = self._window(history, start)
+        dropped = history[:start]
+
+        context = ""
+        if rag_sources is not None and len(rag_sources) == 0:
+            context = NO_RAG_CONTEXT_TEXT
+        elif used_sources:
+            # Sources the window already holds are not given again
+            new_sources = [x for x in used_sources if source_key(x) not in seen] \
+                if self.settings.dedupe_rag_sources else used_sources
+            deduplicated += len(used_sources) - len(new_sources)
+            context = rag_context(new_sources) if len(new_sources) > 0 else ""
+        rag_tokens = self.count_tokens(context) if len(context) > 0 else 0
+        total = system_tokens + user_tokens + rag_tokens + history_tokens
+
+        summary = ""
+        if len(dropped) > 0 and self.settings.summarize_dropped:
+            summary = self._summary(dropped, min(self.settings.summary_tokens, self.budget - total))
+        summary_tokens = self.count_tokens(summary) if len(summary) > 0 else 0
+        total += summary_tokens
+
+        messages = [{"role": "system", "content": system_text + summary}] + kept + \
+                   [{"role": "user", "content": user_input + context}]
+        token_usage = {
+            "budget": self.budget,
+            "total": total,
+            "system": system_tokens,
+            "user": user_tokens,
+            "rag": rag_tokens,
+            "history": history_tokens,
+            "summary": summary_tokens,
+            "history_messages": len(kept),
+            "dropped_messages": len(dropped),
+            "rag_sources": len(used_sources) if used_sources is not None else 0,
+            "rag_sources_left_out": len(rag_sources) - len(used_sources) if rag_sources is not None else 0,
+            "sources_deduplicated": deduplicated,
+        }
+        if total > self.budget:
+            logger.warning(f"Prompt of {total} tokens does not fit in the budget of {self.budget} tokens")
+        return Prompt(messages, used_sources, token_usage, history[start].id if start < len(history) else None)
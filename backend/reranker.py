@@ -1,45 +1,51 @@
-from sklearn.metrics.pairwise import cosine_similarity
-import itertools
-from typing import List
+from typing import List, Optional
+
+import numpy as np
 from langchain_core.embeddings import Embeddings
 
 from settings import RAGSettings
 
 
-def rerank(documents: List[dict], embedding: Embeddings, rag_settings: RAGSettings):
+def _cosine_similarity_matrix(embeddings: List) -> np.ndarray:
+    vectors = np.asarray(embeddings, dtype=np.float64)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    # Zero vectors are not similar to anything, same as sklearn's cosine_similarity
+    norms[norms == 0] = 1.0
+    vectors = vectors / norms
+    return vectors @ vectors.T
+
+
+def rerank(documents: List[dict], embedding: Optional[Embeddings], rag_settings: RAGSettings):
+    """
+    Drops irrelevant documents and keeps only the most relevant document out of every group of similar ones.
+    Documents may carry their stored vector in "embedding", only documents without it are embedded here.
+    Scores of documents with different "score_group" come from different embedding models and are not compared,
+    the score margin applies from the best score of every group.
+    """
     relevant_documents = [x for x in documents if x["similarity_score"] < rag_settings.rag_cosine_distance_irrelevance_threshold]
     if len(relevant_documents) == 0:
         return relevant_documents
-    min_score = min([x["similarity_score"] for x in relevant_documents])
-    min_filtered_documents = [x for x in relevant_documents if x["similarity_score"] < min_score + rag_settings.rag_score_margin]
-
-    embeddings = [embedding.embed_query(x["content"]) for x in min_filtered_documents]
-    cs_embeddings = cosine_similarity(embeddings, embeddings)
-
+    min_scores = {}
+    for x in relevant_documents:
+        group = x.get("score_group")
+        min_scores[group] = min(x["similarity_score"], min_scores.get(group, x["similarity_score"]))
+    min_filtered_documents = [x for x in relevant_documents
+                              if x["similarity_score"] < min_scores[x.get("score_group")] + rag_settings.rag_score_margin]
+
+    embeddings = [x.get("embedding") if x.get("embedding") is not None else embedding.embed_query(x["content"])
+                  for x in min_filtered_documents]
     # When doing cosine similarity, the closer the value to 1, the more similar are the documents. Value of 1 means documents are the same
-    similar_documents = []
-    for document_index, cs_similarities in enumerate(cs_embeddings):
-        documents_above_threshold = [i for i, v in enumerate(list(cs_similarities)) if v > rag_settings.rag_similarity_score_threshold]
-        if len(documents_above_threshold) > 1:
-            similar_documents.append(documents_above_threshold)
-
-    similar_documents.sort()
-    similar_documents_list = list(k for k, _ in itertools.groupby(similar_documents))
+    similar = _cosine_similarity_matrix(embeddings) > rag_settings.rag_similarity_score_threshold
 
     # When comparing similarity scores from rag lookup, the lower the score, the more relevant is the document to the original query.
-    skip_documents = []
-    for document_group in similar_documents_list:
-        most_relevant_document = None
-        for document_index in document_group:
-            if most_relevant_document is None:
-                most_relevant_document = document_index
-                continue
-            if min_filtered_documents[document_index]["similarity_score"] < min_filtered_documents[most_relevant_document]["similarity_score"]:
-                skip_documents.append(most_relevant_document)
-                most_relevant_document = document_index
-            else:
-                skip_documents.append(document_index)
-
-    relevant_documents = [v for i, v in enumerate(min_filtered_documents) if i not in skip_documents]
+    # Every document's group of similar documents keeps its most relevant member (first one on ties), the rest are skipped.
+    scores = np.array([x["similarity_score"] for x in min_filtered_documents], dtype=np.float64)
+    group_scores = np.where(similar, scores[np.newaxis, :], np.inf)
+    most_relevant = np.argmin(group_scores, axis=1)
+    skip = similar.copy()
+    skip[np.arange(len(min_filtered_documents)), most_relevant] = False
+    skip_documents = skip.any(axis=0)
+
+    relevant_documents = [v for i, v in enumerate(min_filtered_documents) if not skip_documents[i]]
 
     return relevant_documents
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Optional
 from threading import Lock
 
 
@@ -6,6 +6,8 @@ class RoomState:
     def __init__(self, room_id):
         self.room_id: str = room_id
         self.failed: bool = False
+        # Id of the oldest message of the prompt history window, see PromptBuilder
+        self.prompt_window_start: Optional[int] = None
 
     def start(self):
         self.failed = False
@@ -18,10 +18,12 @@ if os_type is None:
     sys.exit(f"System not recognized. Got: {os_type}, expected {os_dict.keys()}")
 os.environ["XPDF_PATH"] = os.path.join(os.getcwd(), "bin", os_type, "pdftopng")
 
-os.chdir(TEST_DIR)
+# Worker processes of the tests import this module again, they must not run the tests themselves
+if __name__ == "__main__":
+    os.chdir(TEST_DIR)
 
-loader = unittest.TestLoader()
-suite = loader.discover(start_dir=TEST_DIR)
+    loader = unittest.TestLoader()
+    suite = loader.discover(start_dir=TEST_DIR)
 
-runner = unittest.TextTestRunner(verbosity=2)
-runner.run(suite)
\ No newline at end of file
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
\ No newline at end of file
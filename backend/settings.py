@@ -2,7 +2,7 @@ import copy
 import json
 import os.path
 import shutil
-from typing import List, Optional
+from typing import Dict, List, Optional, Union
 
 from logger import logger
 from utils import is_valid_host, from_posix_path
@@ -24,6 +24,12 @@ DOC_SOURCES = "doc_sources"
 RESTORE_DEFAULT = "restore_default"
 RAG_SETTINGS = "rag_settings"
 GENERATION_GUARD = "generation_guard"
+KB_SERVICE = "kb_service"
+PDF_RENDERING = "pdf_rendering"
+OCR_SETTINGS = "ocr_settings"
+EMBEDDING_SETTINGS = "embedding_settings"
+LLM_CONVERSION = "llm_conversion"
+PROMPT_SETTINGS = "prompt_settings"
 
 class Settings:
     def __init__(self, defaults='defaults.conf', active='current.conf'):
@@ -202,6 +208,19 @@ class Settings:
         self.initialize_defaults()
         self.save()
 
+class RetrievalCacheSettings:
+    def __init__(self, cache_settings: Optional[dict] = None):
+        if cache_settings is None:
+            cache_settings = {}
+        self.enabled = bool(cache_settings.get("enabled", True))
+        self.max_entries = max(1, int(cache_settings.get("max_entries", 256)))
+        self.ttl_s = float(cache_settings.get("ttl_s", 600.0))
+        # Cosine similarity of query embeddings above which a cached lookup is reused, None turns the tier off.
+        # When on, every miss embeds the query one extra time, as the lookups embed it again with their own models.
+        similarity_threshold = cache_settings.get("similarity_threshold")
+        self.similarity_threshold = None if similarity_threshold is None else float(similarity_threshold)
+
+
 class RAGSettings:
     def __init__(self, rag_settings):
         self.rag_document_count = rag_settings["rag_document_count"]
@@ -210,7 +229,221 @@ class RAGSettings:
         self.rag_similarity_score_threshold = rag_settings["rag_similarity_score_threshold"]
         self.rag_score_margin = rag_settings["rag_score_margin"]
         self.rag_cosine_distance_irrelevance_threshold = rag_settings["rag_cosine_distance_irrelevance_threshold"]
+        # Fuses BM25 results of the chunk texts with the vector results
+        self.rag_hybrid_search = bool(rag_settings.get("rag_hybrid_search", True))
+        # BM25 candidates per lookup, defaults to rag_document_count
+        self.rag_lexical_document_count = rag_settings.get("rag_lexical_document_count")
+        self.rag_rrf_k = int(rag_settings.get("rag_rrf_k", 60))
+        # Knowledge bases searched together that do not answer in time are left out of the chat turn
+        self.rag_kb_timeout_s = float(rag_settings.get("rag_kb_timeout_s", 10.0))
+        self.cache = RetrievalCacheSettings(rag_settings.get("cache"))
+
+    def retrieval_signature(self) -> tuple:
+        # Everything that changes the reranked sources of a query
+        return (self.rag_document_count, self.rag_similarity_score_threshold, self.rag_score_margin,
+                self.rag_cosine_distance_irrelevance_threshold, self.rag_hybrid_search,
+                self.rag_lexical_document_count, self.rag_rrf_k)
+
+    @staticmethod
+    def from_settings(settings: Settings):
+        return RAGSettings(settings[RAG_SETTINGS])
+
+class PromptSettings:
+    def __init__(self, prompt_settings: Optional[dict] = None):
+        if prompt_settings is None:
+            prompt_settings = {}
+        # Tokens of the model context, response_tokens of them are kept free for the answer
+        self.context_tokens = max(512, int(prompt_settings.get("context_tokens", 8192)))
+        self.response_tokens = max(0, int(prompt_settings.get("response_tokens", 1024)))
+        # Context size per model, overrides context_tokens
+        self.model_context_tokens: Dict[str, int] = {k: int(v) for k, v in
+                                                     prompt_settings.get("model_context_tokens", {}).items()}
+        # Token estimate of models without a tokenizer at hand, corrected by the prompt sizes runners report
+        self.chars_per_token = max(0.5, float(prompt_settings.get("chars_per_token", 4.0)))
+        # Sources already in a later turn are not repeated
+        self.dedupe_rag_sources = bool(prompt_settings.get("dedupe_rag_sources", True))
+        # Questions of turns left out of the window are listed in the system message, up to summary_tokens
+        self.summarize_dropped = bool(prompt_settings.get("summarize_dropped", True))
+        self.summary_tokens = max(0, int(prompt_settings.get("summary_tokens", 256)))
+        # When history no longer fits, the window moves on by this share of the budget at once, so the
+        # history prefix stays the same for the next turns and the server can reuse its prompt cache
+        self.window_slack = min(0.9, max(0.0, float(prompt_settings.get("window_slack", 0.25))))
+
+    def prompt_budget(self, model: str) -> int:
+        return max(0, self.model_context_tokens.get(model, self.context_tokens) - self.response_tokens)
 
     @staticmethod
     def from_settings(settings: Settings):
-        return RAGSettings(settings[RAG_SETTINGS])
\ No newline at end of file
+        return PromptSettings(settings[PROMPT_SETTINGS])
+
+class KBServiceSettings:
+    WORKER_TYPES = ["thread", "process"]
+    PIPELINE_STAGE_DEFAULTS = {
+        # The entry queue is bounded by max_in_flight only, failed conversions loop back to it
+        "prepare": {"workers": 1, "queue_size": 0},
+        "render": {"workers": 2, "queue_size": 2},
+        "ocr": {"workers": 2, "queue_size": 2},
+        "transcribe": {"workers": 1, "queue_size": 4},
+        "chunk": {"workers": 1, "queue_size": 4},
+        "embed": {"workers": 1, "queue_size": 4},
+        "store": {"workers": 1, "queue_size": 4},
+    }
+
+    def __init__(self, kb_service_settings: Optional[dict] = None):
+        if kb_service_settings is None:
+            kb_service_settings = {}
+        self.workers = max(1, int(kb_service_settings.get("workers", 1)))
+        self.worker_type = kb_service_settings.get("worker_type", "thread")
+        if self.worker_type not in KBServiceSettings.WORKER_TYPES:
+            logger.warning(f"Unknown kb_service worker type {self.worker_type}, using \"thread\" instead.")
+            self.worker_type = "thread"
+        pipeline_settings = kb_service_settings.get("pipeline", {})
+        self.pipeline_enabled = bool(pipeline_settings.get("enabled", False))
+        # Documents admitted into the pipeline at once, stage queues apply backpressure within that limit
+        self.pipeline_max_in_flight = max(1, int(pipeline_settings.get("max_in_flight", 8)))
+        # Pages of one document rendered or OCRed ahead of the stage that reads them
+        self.pipeline_page_buffer = max(1, int(pipeline_settings.get("page_buffer", 4)))
+        self.pipeline_stages = {}
+        stage_settings = pipeline_settings.get("stages", {})
+        for stage, defaults in KBServiceSettings.PIPELINE_STAGE_DEFAULTS.items():
+            config = {**defaults, **stage_settings.get(stage, {})}
+            self.pipeline_stages[stage] = {
+                "workers": max(1, int(config["workers"])),
+                "queue_size": max(0, int(config["queue_size"])),
+            }
+
+    @staticmethod
+    def from_settings(settings: Settings):
+        return KBServiceSettings(settings[KB_SERVICE])
+
+class WatchSettings:
+    def __init__(self, watch_settings: Optional[dict] = None):
+        if watch_settings is None:
+            watch_settings = {}
+        # Processes documents changed in local doc sources without a full run
+        self.enabled = bool(watch_settings.get("enabled", False))
+        self.force_polling = bool(watch_settings.get("force_polling", False))
+        self.poll_interval_ms = max(50, int(watch_settings.get("poll_interval_ms", 1000)))
+        # Events closer together than debounce_ms are delivered at once
+        self.debounce_ms = max(0, int(watch_settings.get("debounce_ms", 500)))
+        # A changed document is processed once it has not changed for quiet_ms
+        self.quiet_ms = max(100, int(watch_settings.get("quiet_ms", 2000)))
+
+    def __eq__(self, other):
+        return isinstance(other, WatchSettings) and vars(self) == vars(other)
+
+    @staticmethod
+    def from_settings(settings: Settings):
+        kb_service_settings = settings[KB_SERVICE]
+        return WatchSettings(None if kb_service_settings is None else kb_service_settings.get("watch"))
+
+class PDFRenderSettings:
+    def __init__(self, pdf_render_settings: Optional[dict] = None):
+        if pdf_render_settings is None:
+            pdf_render_settings = {}
+        self.dpi = max(1, int(pdf_render_settings.get("dpi", 300)))
+        # Parallel page range renders, 1 renders the whole document in one call
+        self.workers = max(1, int(pdf_render_settings.get("workers", 1)))
+        # 0 spreads pages evenly over the workers
+        self.pages_per_range = max(0, int(pdf_render_settings.get("pages_per_range", 0)))
+        # PDF pages with enough extractable text skip rendering and image conversion
+        text_layer_settings = pdf_render_settings.get("text_layer", {})
+        self.text_layer_enabled = bool(text_layer_settings.get("enabled", True))
+        self.text_layer_min_chars = max(0, int(text_layer_settings.get("min_chars", 200)))
+        self.text_layer_min_quality = float(text_layer_settings.get("min_quality", 0.7))
+
+    @staticmethod
+    def from_settings(settings: Settings):
+        return PDFRenderSettings(settings[PDF_RENDERING])
+
+class OcrSettings:
+    def __init__(self, ocr_settings: Optional[dict] = None):
+        if ocr_settings is None:
+            ocr_settings = {}
+        # Pages per tesseract run, language data is loaded once per run
+        self.batch_size = max(1, int(ocr_settings.get("batch_size", 8)))
+        # Concurrent tesseract processes per language set
+        self.max_processes = max(1, int(ocr_settings.get("max_processes", 2)))
+
+    @staticmethod
+    def from_settings(settings: Settings):
+        return OcrSettings(settings[OCR_SETTINGS])
+
+class EmbeddingSettings:
+    def __init__(self, embedding_settings: Optional[dict] = None):
+        if embedding_settings is None:
+            embedding_settings = {}
+        # Texts per request to the embedding model
+        self.batch_size = max(1, int(embedding_settings.get("batch_size", 32)))
+        # Vectors are cached on disk by embedding config and text hash
+        self.cache = bool(embedding_settings.get("cache", True))
+
+    @staticmethod
+    def from_settings(settings: Settings):
+        return EmbeddingSettings(settings[EMBEDDING_SETTINGS])
+
+class LlmConversionSettings:
+    def __init__(self, llm_conversion: Optional[dict] = None):
+        if llm_conversion is None:
+            llm_conversion = {}
+        # Pages per llm / ocr_llm batch and completion requests of one batch running at once
+        self.batch_size = max(1, int(llm_conversion.get("batch_size", 4)))
+        self.concurrency = max(1, int(llm_conversion.get("concurrency", 2)))
+
+    @staticmethod
+    def from_settings(settings: Settings):
+        return LlmConversionSettings(settings[LLM_CONVERSION])
+
+class HttpSettings:
+    def __init__(self, http_settings: Optional[dict] = None):
+        if http_settings is None:
+            http_settings = {}
+        # Hosts kept in the pool and open connections per host, requests wait for a free connection
+        self.pool_connections = max(1, int(http_settings.get("pool_connections", 4)))
+        self.pool_maxsize = max(1, int(http_settings.get("pool_maxsize", 8)))
+        self.connect_timeout_s = float(http_settings.get("connect_timeout_s", 10))
+        # Time allowed between received bytes, not for the whole response
+        self.read_timeout_s = float(http_settings.get("read_timeout_s", 600))
+        # Failed connections are retried, requests that reached the host are not
+        self.retries = max(0, int(http_settings.get("retries", 2)))
+        self.backoff_factor = float(http_settings.get("backoff_factor", 0.5))
+
+    @staticmethod
+    def from_runner_config(config: dict):
+        return HttpSettings(config.get("http"))
+
+class KeepAliveSettings:
+    def __init__(self, keep_alive_settings: Optional[dict] = None):
+        if keep_alive_settings is None:
+            keep_alive_settings = {}
+        # How long Ollama keeps a model loaded after a request, "10m", seconds, or -1 for always.
+        # None leaves the server default
+        self.default: Optional[Union[str, int]] = keep_alive_settings.get("default")
+        self.models: Dict[str, Union[str, int]] = dict(keep_alive_settings.get("models", {}))
+
+    def for_model(self, model: str) -> Optional[Union[str, int]]:
+        return self.models.get(model, self.default)
+
+    @staticmethod
+    def from_runner_config(config: dict):
+        return KeepAliveSettings(config.get("keep_alive"))
+
+class ModelResidencySettings:
+    def __init__(self, residency_settings: Optional[dict] = None):
+        if residency_settings is None:
+            residency_settings = {}
+        # Combined size of loaded models, least recently used ones are unloaded to stay under it. 0 - no limit
+        self.memory_budget_gb = max(0.0, float(residency_settings.get("memory_budget_gb", 0)))
+        self.max_models = max(1, int(residency_settings.get("max_models", 2)))
+        # Never unloaded
+        self.pinned: List[str] = list(residency_settings.get("pinned", []))
+        # Loaded in the background when the runner is created
+        self.preload: List[str] = list(residency_settings.get("preload", []))
+
+    @property
+    def memory_budget_bytes(self) -> int:
+        return int(self.memory_budget_gb * 1024 ** 3)
+
+    @staticmethod
+    def from_runner_config(config: dict):
+        return ModelResidencySettings(config.get("residency"))
@@ -27,7 +27,8 @@ class MockKnowledgeBase(KnowledgeBase):
     def clear(self):
         pass
 
-    def rag_lookup(self, embedding_source: Callable[[dict], Embeddings], query: str, document_count: int):
+    def rag_lookup(self, embedding_source: Callable[[dict], Embeddings], query: str, document_count: int,
+                   include_embeddings: bool = False, rag_settings=None):
         pass
 
     def store_convertor_result(self, embedding_source: Callable[[dict], Embeddings], convertor_result: ConvertorResult):
@@ -0,0 +1,76 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from cache_index import CacheIndex, get_cache_index, drop_cache_index
+from convertors.document_file import DocumentFile
+from kb.chroma import ChromaKnowledgeBase
+
+
+class CacheIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _committed_count(self, db_file: str) -> int:
+        with sqlite3.connect(db_file) as connection:
+            return connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def test_batched_commits(self):
+        db_file = os.path.join(self.temp_dir.name, "index.sqlite3")
+        index = CacheIndex(db_file, commit_every=3, commit_interval_s=3600)
+        index.put("ns", "a", {"value": 1})
+        index.put("ns", "b", {"value": 2})
+        # Visible through the index before the batch is committed
+        self.assertEqual({"value": 2}, index.get("ns", "b"))
+        self.assertEqual(0, self._committed_count(db_file))
+        index.put("ns", "c", {"value": 3})
+        self.assertEqual(3, self._committed_count(db_file))
+        index.put("ns", "d", {"value": 4})
+        index.flush()
+        self.assertEqual(4, self._committed_count(db_file))
+        self.assertIsNone(index.get("other", "a"))
+        index.delete_namespace("ns")
+        self.assertEqual(0, index.count("ns"))
+        index.close()
+
+    def test_json_migration(self):
+        db_file = os.path.join(self.temp_dir.name, "migrated.sqlite3")
+        json_file = os.path.join(self.temp_dir.name, "migrated.json")
+        with open(json_file, "w") as fh:
+            json.dump({"source/a.pdf": {"last_checked": "2025-01-01T00:00:00+00:00"}}, fh)
+        index = get_cache_index(db_file, {"checked": json_file})
+        self.assertEqual({"last_checked": "2025-01-01T00:00:00+00:00"}, index.get("checked", "source/a.pdf"))
+        self.assertFalse(os.path.exists(json_file))
+        self.assertTrue(os.path.exists(json_file + ".migrated"))
+        self.assertIs(index, get_cache_index(db_file))
+        drop_cache_index(db_file)
+        self.assertFalse(os.path.exists(db_file))
+
+    def test_kb_check_cache(self):
+        base_path = os.path.join(self.temp_dir.name, "kb")
+        os.makedirs(base_path)
+        with open(os.path.join(base_path, "kb_check_cache.json"), "w") as fh:
+            json.dump({"doc_source/documents/geese.pdf": {"last_checked": "2025-01-01T00:00:00+00:00"}}, fh)
+        with open(os.path.join("knowledge_bases", "chroma", "test", "config.json"), "r") as fh:
+            kb_dict = json.load(fh)
+        kb = ChromaKnowledgeBase(kb_dict, base_path, None)
+        documents_root = os.path.join(os.getcwd(), "documents")
+        geese = DocumentFile.create("doc_source", documents_root, "documents/geese.pdf")
+        ducks = DocumentFile.create("doc_source", documents_root, "documents/ducks.pdf")
+        self.assertTrue(kb.is_checked(geese))
+        self.assertFalse(kb.is_checked(ducks))
+        kb.update_checked(ducks)
+        self.assertTrue(kb.is_checked(ducks))
+        kb.clear_cache()
+        self.assertFalse(os.path.exists(kb.cache_file))
+        self.assertFalse(kb.is_checked(ducks))
+        kb.clear_cache()
+
+
+if __name__ == '__main__':
+    unittest.main()
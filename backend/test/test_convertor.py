@@ -1,6 +1,12 @@
+import base64
+import multiprocessing
 import os
+import pickle
 import shutil
+import threading
+import time
 import unittest
+from convertors.conversion_manifest import get_conversion_manifest
 from convertors.convertor_result import ConvertorResult
 from convertors.convertor import Convertor
 from convertors.llm_contexts import DocumentContext
@@ -10,9 +16,50 @@ from convertors.ocr_with_llm_convertor import OcrLlmConvertor
 from convertors.llm_convertor import LlmConvertor
 from convertors.convertor import DocumentFile
 import json
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch
 
+from kb.knowledge_base import KnowledgeBase
+from pdf_to_png import page_image_name
+from settings import PDFRenderSettings, LlmConversionSettings
+from llm_runners.llm_runner import SuperRunner
 from llm_runners.ollama_runner import OllamaRunner
-from test.mock_classes import MockKnowledgeBase
+from test.mock_classes import MockKnowledgeBase, MockLLMRunner
+from test.test_ollama_runner import FakeOllamaHandler
+
+
+class TranscribingLLMRunner(MockLLMRunner):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def run_text_completion_simple(self, model, messages, options=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        text = base64.b64decode(messages[-1]["images"][0]).decode("utf-8")
+        # Later pages finish first
+        time.sleep(0.02 * (5 - int(text.split()[-1])))
+        with self.lock:
+            self.running -= 1
+        return f"transcribed {text}"
+
+
+def fake_pdf_pages(pdf_path, output_folder, dpi, workers, pages_per_range, pages):
+    os.makedirs(output_folder, exist_ok=True)
+    for page in [1, 2, 3]:
+        image_path = os.path.join(output_folder, page_image_name(page))
+        with open(image_path, "w") as fh:
+            fh.write(f"page {page}")
+        yield image_path
+
+
+def convert_in_worker(convertor: Convertor, document: DocumentFile, context: DocumentContext):
+    # Runs in a spawned worker process, rendering is faked as the test machine may lack the PDF renderer
+    with patch("convertors.document_file.iter_pdf_pages", side_effect=fake_pdf_pages):
+        return convertor.convert(document, context)
 
 
 class ConvertorTest(unittest.TestCase):
@@ -99,5 +146,162 @@ class ConvertorTest(unittest.TestCase):
         converter_result = convertor.get_or_init_conversion(document)
         self.assertEqual(len(converter_result.pages), 3)
 
+    def test_get_or_init_conversion_manifest(self):
+        processed_path = "processed/ducks.pdf_f06b0e20587b9f30a7274843eded4de2ae437a1de1dd44b8d0646831f8acee97"
+        shutil.copytree(
+            "mock_data/existing_document/ducks.pdf_f06b0e20587b9f30a7274843eded4de2ae437a1de1dd44b8d0646831f8acee97",
+            processed_path
+        )
+        document = DocumentFile.create("doc_source_name", os.path.join(os.getcwd(), "documents"), "documents/ducks.pdf")
+        convertor = RawConvertor()
+        # metadata.json is imported and its pages hashed once
+        first_result = convertor.get_or_init_conversion(document)
+        self.assertEqual(3, len(first_result.pages))
+        manifest = get_conversion_manifest()
+        self.assertEqual([processed_path], manifest.find_by_hash(document.file_hash))
+        self.assertEqual(3, len(manifest.get_pages(processed_path, "raw", None)))
+        with patch("convertors.conversion_manifest.hash_files") as hash_files:
+            second_result = convertor.get_or_init_conversion(document)
+            self.assertTrue(KnowledgeBase.validate_document_source(second_result))
+            hash_files.assert_not_called()
+        self.assertEqual(sorted(first_result.pages), second_result.pages)
+        self.assertEqual(first_result.result_hash, second_result.result_hash)
+        # Altered pages are rehashed and no longer match
+        with open(second_result.pages[0], "a") as fh:
+            fh.write("altered")
+        self.assertEqual(0, len(convertor.get_or_init_conversion(document).pages))
+        self.assertFalse(KnowledgeBase.validate_document_source(second_result))
+
+    def test_text_layer_pages_skip_rendering(self):
+        document = DocumentFile.create("doc_source_name", os.path.join(os.getcwd(), "documents"), "documents/ducks.pdf")
+        rendered_pages = []
+        converted_images = []
+
+        def fake_pages(pdf_path, output_folder, dpi, workers, pages_per_range, pages):
+            rendered_pages.extend(pages)
+            for page in pages:
+                yield os.path.join(output_folder, page_image_name(page))
+
+        def fake_images_to_text(image_paths, context):
+            converted_images.extend(os.path.basename(x) for x in image_paths)
+            return ["scanned text" for _ in image_paths]
+
+        convertor = OcrConvertor()
+        context = DocumentContext(MockKnowledgeBase.create("new_kb", [], [], {"model": "test_embedding"}),
+                                  PDFRenderSettings({"text_layer": {"min_chars": 200}}))
+        with patch("convertors.document_file.iter_pdf_pages", side_effect=fake_pages), \
+                patch.object(convertor, "images_to_text", side_effect=fake_images_to_text):
+            result = convertor.convert(document, context)
+        self.assertIsInstance(result, ConvertorResult)
+        self.assertEqual([1], rendered_pages)
+        self.assertEqual([page_image_name(1)], converted_images)
+        self.assertEqual(["page-000001.txt", "page-000002.txt", "page-000003.txt"],
+                         sorted(os.path.basename(x) for x in result.pages))
+        with open(os.path.join(result.output_path, "page-000002.txt")) as fh:
+            self.assertIn("duck", fh.read().lower())
+
+    def test_llm_batches_keep_page_order(self):
+        document = DocumentFile.create("doc_source_name", os.path.join(os.getcwd(), "documents"), "documents/ducks.pdf")
+
+        def fake_pages(pdf_path, output_folder, dpi, workers, pages_per_range, pages):
+            os.makedirs(output_folder, exist_ok=True)
+            for page in [1, 2, 3]:
+                image_path = os.path.join(output_folder, page_image_name(page))
+                with open(image_path, "w") as fh:
+                    fh.write(f"page {page}")
+                yield image_path
+
+        llm_runner = TranscribingLLMRunner()
+        convertor = LlmConvertor(llm_runner, "vision_model")
+        context = DocumentContext(MockKnowledgeBase.create("new_kb", [], [], {"model": "test_embedding"}),
+                                  PDFRenderSettings({"text_layer": {"enabled": False}}),
+                                  llm_conversion=LlmConversionSettings({"batch_size": 3, "concurrency": 3}))
+        with patch("convertors.document_file.iter_pdf_pages", side_effect=fake_pages):
+            result = convertor.convert(document, context)
+        self.assertIsInstance(result, ConvertorResult)
+        self.assertEqual(3, llm_runner.max_running)
+        for page in [1, 2, 3]:
+            with open(os.path.join(result.output_path, f"page-00000{page}.txt")) as fh:
+                self.assertEqual(f"transcribed page {page}", fh.read())
+
+    def test_llm_convertor_in_worker_process(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOllamaHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            llm_runner = SuperRunner([OllamaRunner(f"http://127.0.0.1:{server.server_address[1]}")])
+            document = DocumentFile.create("doc_source_name", os.path.join(os.getcwd(), "documents"),
+                                           "documents/ducks.pdf")
+            context = DocumentContext(MockKnowledgeBase.create("new_kb", [], [], {"model": "test_embedding"}),
+                                      PDFRenderSettings({"text_layer": {"enabled": False}}))
+            for convertor in [LlmConvertor(llm_runner, "chat_model"), OcrLlmConvertor(llm_runner, "chat_model")]:
+                # kb_service submits the bound convert method to its process pool
+                pickle.dumps(convertor.convert)
+            convertor = LlmConvertor(llm_runner, "chat_model")
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                result = pool.submit(convert_in_worker, convertor, document, context).result(timeout=120)
+            self.assertIsInstance(result, ConvertorResult)
+            self.assertEqual(3, len(result.pages))
+            for page in result.pages:
+                with open(page) as fh:
+                    self.assertEqual("Ducks eat bread.", fh.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_llm_batch_failed_page(self):
+        llm_runner = TranscribingLLMRunner()
+        messages_batch = [[{"role": "user", "images": [base64.b64encode(x.encode("utf-8")).decode("utf-8")]}]
+                          for x in ["page 1", "broken", "page 3"]]
+        results = llm_runner.run_text_completion_batch("vision_model", messages_batch, concurrency=2)
+        self.assertEqual(["transcribed page 1", None, "transcribed page 3"], results)
+
+    def test_resume_interrupted_conversion(self):
+        document = DocumentFile.create("doc_source_name", os.path.join(os.getcwd(), "documents"), "documents/ducks.pdf")
+        rendered_pages = []
+        converted_images = []
+        failing_pages = {"page-000002.png"}
+
+        def fake_pages(pdf_path, output_folder, dpi, workers, pages_per_range, pages):
+            os.makedirs(output_folder, exist_ok=True)
+            for page in pages if pages is not None else [1, 2, 3]:
+                rendered_pages.append(page)
+                image_path = os.path.join(output_folder, page_image_name(page))
+                open(image_path, "w").close()
+                yield image_path
+
+        def fake_images_to_text(image_paths, context):
+            converted_images.extend(os.path.basename(x) for x in image_paths)
+            return [None if os.path.basename(x) in failing_pages else f"text of {os.path.basename(x)}"
+                    for x in image_paths]
+
+        convertor = OcrConvertor()
+        context = DocumentContext(MockKnowledgeBase.create("new_kb", [], [], {"model": "test_embedding"}),
+                                  PDFRenderSettings({"text_layer": {"enabled": False}}))
+        with patch("convertors.document_file.iter_pdf_pages", side_effect=fake_pages), \
+                patch.object(convertor, "images_to_text", side_effect=fake_images_to_text), \
+                patch.object(convertor, "batch_size", return_value=1):
+            self.assertIsNone(convertor.convert(document, context))
+            self.assertEqual(0, len(document.get_or_init_metadata()["conversions"]))
+            self.assertEqual(["page-000001.txt"], list(convertor.load_progress(document).keys()))
+
+            failing_pages.clear()
+            rendered_pages.clear()
+            converted_images.clear()
+            result = convertor.convert(document, context)
+            self.assertIsInstance(result, ConvertorResult)
+            self.assertEqual([2, 3], rendered_pages)
+            self.assertEqual(3, len(result.pages))
+            self.assertEqual(1, len(document.get_or_init_metadata()["conversions"]))
+
+            # A changed page file is converted again, the other pages are kept
+            with open(os.path.join(result.output_path, "page-000003.txt"), "w") as fh:
+                fh.write("edited")
+            rendered_pages.clear()
+            result = convertor.convert(document, context)
+            self.assertEqual([3], rendered_pages)
+            self.assertEqual(1, len(result.document_metadata["conversions"]))
+            self.assertEqual(result.result_hash, convertor.get_or_init_conversion(document).result_hash)
+
+
 if __name__ == '__main__':
     unittest.main()
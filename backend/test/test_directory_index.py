@@ -0,0 +1,73 @@
+import glob
+import os
+import tempfile
+import unittest
+
+from doc_sources.directory_index import DirectoryIndex
+
+
+class DirectoryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = self.temp_dir.name
+        for path in ["a.pdf", "b.md", ".hidden.pdf", "sub/c.pdf", "sub/d.txt", "sub/deep/e.pdf", "sub/.h/f.pdf",
+                     "x/y/z/w.pdf"]:
+            self._write(path)
+        os.makedirs(os.path.join(self.root, "sub", "empty"))
+        self._age_folders()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, path: str):
+        full_path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        open(full_path, "w").close()
+
+    def _age_folders(self):
+        # Folders changed within the last seconds are always scanned again
+        for directory, _, _ in os.walk(self.root):
+            os.utime(directory, (1700000000, 1700000000))
+
+    def _glob(self, pattern: str) -> set:
+        paths = set()
+        for path in glob.glob(os.path.join(self.root, pattern), recursive=True):
+            relative_path = os.path.relpath(path, self.root)
+            if relative_path != ".":
+                paths.add((relative_path.replace(os.sep, "/"), os.path.isdir(path)))
+        return paths
+
+    def test_same_as_glob(self):
+        index = DirectoryIndex(self.root)
+        for pattern in ["*", "**", "**/*.pdf", "sub/*", "sub/**", "sub/**/*.pdf", "*/*.pdf", "**/deep/*",
+                        "x/**/w.pdf", "**/**", "[a-b]*", "?.md", ".*", "sub/.*", "*/", "missing/*", "sub/deep",
+                        "sub/d.txt", "x/*/z"]:
+            self.assertEqual(self._glob(pattern), set(index.glob(pattern)), pattern)
+        self.assertEqual("dir", index.file_type("sub/deep"))
+        self.assertEqual("file", index.file_type("sub/deep/e.pdf"))
+        self.assertIsNone(index.file_type("sub/missing.pdf"))
+        self.assertEqual([], index.glob("../*"))
+
+    def test_incremental_refresh(self):
+        index = DirectoryIndex(self.root, refresh_interval_s=0)
+        self.assertEqual(4, len(index.glob("**/*.pdf")))
+        scans = index.scans
+        # Only folders whose modification time changed are read again
+        self.assertEqual(4, len(index.glob("**/*.pdf")))
+        self.assertEqual(scans, index.scans)
+        self._write("sub/deep/new.pdf")
+        self.assertIn(("sub/deep/new.pdf", False), index.glob("**/*.pdf"))
+        self.assertEqual(scans + 1, index.scans)
+        os.remove(os.path.join(self.root, "sub", "c.pdf"))
+        self.assertNotIn(("sub/c.pdf", False), index.glob("sub/*"))
+
+    def test_refresh_interval(self):
+        index = DirectoryIndex(self.root, refresh_interval_s=3600)
+        self.assertEqual([("sub/c.pdf", False)], index.glob("sub/*.pdf"))
+        self._write("sub/later.pdf")
+        # Answered from memory until the interval passed
+        self.assertNotIn(("sub/later.pdf", False), index.glob("sub/*.pdf"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -37,9 +37,25 @@ class DocSourceTest(unittest.TestCase):
         document = doc_source.get('test_name/geese.pdf')
         self.assertTrue(document.file_name == 'geese.pdf')
         doc_source.update_cache(document)
-        with open(os.path.join(cache_dir, "test_name.json")) as fh:
-            hash_cache = json.load(fh)
-            self.assertEqual(document.file_hash, hash_cache[document.get_document_path()]["hash"])
+        self.assertEqual(document.file_hash, doc_source.get_cached_hash(document.get_document_path())["hash"])
+        cached_document = doc_source.get('test_name/geese.pdf')
+        self.assertEqual(document.file_hash, cached_document._file_hash)
+        self.assertFalse(cached_document.has_changed)
+
+    def test_local_doc_source_cache_migration(self):
+        cache_dir = os.path.join(".cache", "doc_hash_cache_migration")
+        document = LocalFileSystemSource("test_name", "documents", cache_hashes=False).get('test_name/geese.pdf')
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, "test_name.json"), "w") as fh:
+            json.dump({document.get_document_path(): {"hash": "legacyhash",
+                                                      "last_modified": document.last_modified.isoformat(),
+                                                      "file_size": document.file_size}}, fh)
+        doc_source = LocalFileSystemSource("test_name", "documents", cache_hashes=True, cache_dir=cache_dir)
+        self.assertEqual("legacyhash", doc_source.get('test_name/geese.pdf').file_hash)
+        self.assertFalse(os.path.exists(os.path.join(cache_dir, "test_name.json")))
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, "test_name.json.migrated")))
+        doc_source.clear_cache()
+        self.assertIsNone(doc_source.get_cached_hash(document.get_document_path()))
 
     def test_super_doc_source(self):
         super_doc_source = SuperDocSource(
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import time
+import unittest
+
+from doc_sources.doc_source import SuperDocSource
+from doc_sources.doc_watcher import ChangeJournal, DocSourceWatch
+from doc_sources.local_file_system import LocalFileSystemSource
+from settings import WatchSettings
+from utils import selection_matches
+
+
+class DocWatcherTest(unittest.TestCase):
+    def test_journal_coalesces_bursts(self):
+        journal = ChangeJournal(quiet_s=0.2)
+        for _ in range(5):
+            journal.record("docs/a.pdf")
+        journal.record("docs/b.pdf")
+        self.assertEqual([], journal.drain())
+        self.assertEqual(2, journal.pending())
+        time.sleep(0.25)
+        self.assertEqual(["docs/a.pdf", "docs/b.pdf"], journal.drain())
+        self.assertEqual([], journal.drain())
+        journal.record("docs/c.pdf")
+        self.assertEqual(["docs/c.pdf"], journal.drain(force=True))
+
+    def test_polling_watch(self):
+        changes = []
+        with tempfile.TemporaryDirectory() as root_path:
+            with open(os.path.join(root_path, "existing.md"), "w") as fh:
+                fh.write("existing")
+            settings = WatchSettings({"enabled": True, "force_polling": True, "poll_interval_ms": 50,
+                                      "quiet_ms": 200})
+            watch = DocSourceWatch({"docs": root_path}, settings, lambda paths: changes.append(paths) or True)
+            watch.start()
+            try:
+                time.sleep(0.1)
+                os.makedirs(os.path.join(root_path, "sub"))
+                # Several writes of one file are processed once
+                for text in ["a", "ab", "abc"]:
+                    with open(os.path.join(root_path, "sub", "new.md"), "w") as fh:
+                        fh.write(text)
+                    time.sleep(0.06)
+                deadline = time.monotonic() + 5
+                while len(changes) == 0 and time.monotonic() < deadline:
+                    time.sleep(0.05)
+            finally:
+                watch.stop()
+        self.assertEqual([["docs/sub/new.md"]], changes)
+        self.assertEqual("polling", watch.stats()["watchers"][0]["mode"])
+        self.assertEqual(1, watch.stats()["dispatched"])
+
+    def test_watch_roots(self):
+        super_doc_source = SuperDocSource("super", [LocalFileSystemSource("test_name", "documents")])
+        self.assertEqual({"super/test_name": "documents"}, super_doc_source.watch_roots())
+
+    def test_selection_matches(self):
+        self.assertTrue(selection_matches("test_name/geese.pdf", ["**/*.pdf"]))
+        self.assertTrue(selection_matches("test_name/first/second/geese.pdf", ["test_name/**/*.pdf"]))
+        self.assertFalse(selection_matches("test_name/frogs.md", ["**/*.pdf"]))
+        self.assertTrue(selection_matches("test_name/first/ducks.pdf", ["test_name/first"]))
+        self.assertFalse(selection_matches("test_name/first/second/geese.pdf", ["test_name/first"]))
+        self.assertTrue(selection_matches("test_name/frogs.md", ["test_name/frogs.md"]))
+        self.assertFalse(selection_matches("test_name/first/ducks.pdf", ["test_name/*"]))
+        self.assertTrue(selection_matches("test_name/geese.pdf", ["test_name/[!d]*.pdf"]))
+        self.assertFalse(selection_matches("test_name/ducks.pdf", ["test_name/[!d]*.pdf"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -67,6 +67,19 @@ class DocumentFileTest(unittest.TestCase):
         document.raw_dump()
         self.assertEqual(len(os.listdir(os.path.join(document.processed_path, "raw"))), 3)
 
+    def test_extract_text_layer(self):
+        document = PDFDocumentFile('test_doc_source_name', 'documents', 'documents/ducks.pdf')
+        text_layer = document.extract_text_layer(min_chars=200, min_quality=0.7)
+        self.assertEqual([1, 2, 3], sorted(text_layer.keys()))
+        # First page only holds a short prompt line
+        self.assertIsNone(text_layer[1])
+        self.assertIsNotNone(text_layer[2])
+        self.assertIsNotNone(text_layer[3])
+        text_layer = document.extract_text_layer(min_chars=0, min_quality=1.1)
+        self.assertTrue(all(x is None for x in text_layer.values()))
+        document = TextDocumentFile('test_doc_source_name', 'documents', 'documents/frogs.md')
+        self.assertEqual({}, document.extract_text_layer(min_chars=0, min_quality=0.0))
+
     def test_convert_document_to_images(self):
         document = PDFDocumentFile('test_doc_source_name', 'documents', 'documents/ducks.pdf')
         document.convert_document_to_images()
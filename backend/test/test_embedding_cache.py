@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from kb.embedding_cache import CachedEmbeddings, EmbeddingCache, embedding_key
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.batches: List[List[str]] = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.batches.append(texts)
+        return [[float(len(x)), 0.5, -1.25] for x in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [float(len(text)), 0.0, 0.0]
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = EmbeddingCache(os.path.join(self.folder, "embeddings.sqlite3"))
+        self.model = embedding_key({"model": "test_embedding"})
+
+    def tearDown(self):
+        self.cache.connection.close()
+        shutil.rmtree(self.folder)
+
+    def test_batches_and_deduplicates(self):
+        inner = CountingEmbeddings()
+        embeddings = CachedEmbeddings(inner, self.model, batch_size=2, cache=self.cache)
+        vectors = embeddings.embed_documents(["a", "bb", "a", "ccc", "dddd"])
+        self.assertEqual([[1.0, 0.5, -1.25], [2.0, 0.5, -1.25], [1.0, 0.5, -1.25], [3.0, 0.5, -1.25],
+                          [4.0, 0.5, -1.25]], vectors)
+        self.assertEqual([["a", "bb"], ["ccc", "dddd"]], inner.batches)
+        self.assertEqual(4, self.cache.count(self.model))
+
+    def test_cache_shared_by_model(self):
+        CachedEmbeddings(CountingEmbeddings(), self.model, cache=self.cache).embed_documents(["a", "bb"])
+        inner = CountingEmbeddings()
+        vectors = CachedEmbeddings(inner, self.model, cache=self.cache).embed_documents(["bb", "a", "new"])
+        self.assertEqual([["new"]], inner.batches)
+        self.assertEqual([2.0, 0.5, -1.25], vectors[0])
+        other = CountingEmbeddings()
+        CachedEmbeddings(other, embedding_key({"model": "other_embedding"}), cache=self.cache).embed_documents(["a"])
+        self.assertEqual([["a"]], other.batches)
+
+    def test_without_cache(self):
+        inner = CountingEmbeddings()
+        embeddings = CachedEmbeddings(inner, self.model, batch_size=10, cache=None)
+        embeddings.embed_documents(["a", "b"])
+        embeddings.embed_documents(["a", "b"])
+        self.assertEqual(2, len(inner.batches))
+        self.assertEqual([1.0, 0.0, 0.0], embeddings.embed_query("q"))
+
+
+if __name__ == '__main__':
+    unittest.main()
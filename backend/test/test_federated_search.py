@@ -0,0 +1,173 @@
+import threading
+import time
+import unittest
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from convertors.llm_contexts import ChatContext
+from kb.federated_search import federated_rag_lookup, is_stalled
+from kb.retrieval_cache import RetrievalCache
+from settings import RAGSettings
+from reranker import rerank
+from test.mock_classes import MockKnowledgeBase, MockLLMRunner, mock_embeddings_source
+
+
+class FakeLookupKnowledgeBase(MockKnowledgeBase):
+    def __init__(self, name: str, model: str, results: list, delay_event: threading.Event = None,
+                 error: Exception = None):
+        super().__init__({"name": name, "selection": [], "convertors": [], "embedding": {"model": model}})
+        self.results = results
+        self.delay_event = delay_event
+        self.error = error
+
+    def rag_lookup(self, embedding_source, query, document_count, include_embeddings=False, rag_settings=None):
+        if self.delay_event is not None:
+            self.delay_event.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.results[:document_count]
+
+
+class TopicEmbeddings(Embeddings):
+    # Every text is its own direction, so no two sources are near duplicates
+    def __init__(self, texts: list):
+        self.texts = texts
+
+    def embed_documents(self, texts):
+        return [self.embed_query(x) for x in texts]
+
+    def embed_query(self, text):
+        return [1.0 if x == text else 0.0 for x in self.texts]
+
+
+class TopicLLMRunner(MockLLMRunner):
+    def __init__(self, texts: list):
+        self.texts = texts
+
+    def get_embedding(self, embedding_config):
+        return TopicEmbeddings(self.texts)
+
+
+def _result(text: str, distance: float, vector: list) -> tuple:
+    return Document(page_content=text, metadata={}, id=text), distance, vector
+
+
+class FederatedSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.rag_settings = RAGSettings({"rag_document_count": 5, "rag_char_chunk_size": 1000,
+                                         "rag_char_overlap": 200, "rag_similarity_score_threshold": 0.8,
+                                         "rag_score_margin": 0.2, "rag_cosine_distance_irrelevance_threshold": 1.0,
+                                         "rag_kb_timeout_s": 0.5})
+
+    def test_same_embedding_merged_by_distance(self):
+        first = FakeLookupKnowledgeBase("first", "bge-m3", [_result("a", 0.1, [1.0]), _result("b", 0.5, [2.0])])
+        second = FakeLookupKnowledgeBase("second", "bge-m3", [_result("c", 0.3, [3.0])])
+        candidates, report = federated_rag_lookup([first, second], mock_embeddings_source, "query", 5,
+                                                  self.rag_settings, include_embeddings=True)
+        self.assertEqual(["a", "c", "b"], [x[0].id for x in candidates])
+        self.assertEqual([0.1, 0.3, 0.5], [x[1] for x in candidates])
+        self.assertEqual([1.0], candidates[0][2])
+        self.assertEqual("second", candidates[1][0].metadata["knowledge_base"])
+        # Results of the knowledge bases are not changed
+        self.assertEqual({}, first.results[0][0].metadata)
+        self.assertEqual(["ok", "ok"], [x["status"] for x in report])
+
+    def test_different_embeddings_merged_by_rank(self):
+        first = FakeLookupKnowledgeBase("first", "bge-m3", [_result("a", 0.6, [1.0]), _result("b", 1.3, [2.0])])
+        second = FakeLookupKnowledgeBase("second", "nomic", [_result("c", 0.2, [3.0, 1.0]),
+                                                              _result("d", 0.4, [4.0, 1.0]),
+                                                              _result("e", 0.3, [5.0, 1.0])])
+        candidates, _ = federated_rag_lookup([first, second], mock_embeddings_source, "query", 5,
+                                             self.rag_settings, include_embeddings=True)
+        self.assertEqual(["c", "a", "e", "b", "d"], [x[0].id for x in candidates])
+        # Distances are kept, so the irrelevance threshold still drops "b" and a single result is not made perfect
+        self.assertEqual({"a": 0.6, "b": 1.3, "c": 0.2, "d": 0.4, "e": 0.3}, {x[0].id: x[1] for x in candidates})
+        # Vectors of different models can not be compared when reranking
+        self.assertTrue(all(x[2] is None for x in candidates))
+
+    def test_different_embeddings_reranked_per_model(self):
+        # nomic distances run higher than bge-m3 ones, a shared score margin would drop all of them
+        first = FakeLookupKnowledgeBase("first", "bge-m3", [_result("a", 0.3, [1.0]), _result("b", 0.35, [2.0])])
+        second = FakeLookupKnowledgeBase("second", "nomic", [_result("c", 0.6, [3.0, 1.0]),
+                                                              _result("d", 0.7, [4.0, 1.0]),
+                                                              _result("e", 0.85, [5.0, 1.0])])
+        candidates, _ = federated_rag_lookup([first, second], mock_embeddings_source, "query", 5,
+                                             self.rag_settings, include_embeddings=True)
+        sources = [{"id": x[0].id, "similarity_score": x[1], "content": x[0].id, "embedding": None,
+                    "score_group": x[0].metadata["knowledge_base"]} for x in candidates]
+        reranked = rerank(sources, TopicEmbeddings(["a", "b", "c", "d", "e"]), self.rag_settings)
+        # The margin still applies within every model
+        self.assertEqual({"a", "b", "c", "d"}, set(x["id"] for x in reranked))
+
+        runner = TopicLLMRunner(["a", "b", "c", "d", "e"])
+        context = ChatContext("model", "prompt", None, kbs=[first, second])
+        retrieved, complete = runner.retrieve_rag_sources(context, "query", self.rag_settings)
+        self.assertTrue(complete)
+        self.assertEqual({"first", "second"}, set(x["metadata"]["knowledge_base"] for x in retrieved))
+        self.assertTrue(all("score_group" not in x and "embedding" not in x for x in retrieved))
+
+    def test_partial_lookup_not_cached(self):
+        working = FakeLookupKnowledgeBase("working", "bge-m3", [_result("a", 0.1, [1.0])])
+        failing = FakeLookupKnowledgeBase("failing", "bge-m3", [], error=RuntimeError("store is down"))
+        runner = TopicLLMRunner(["a"])
+        context = ChatContext("model", "prompt", None, kbs=[working, failing])
+        cache = RetrievalCache()
+        for _ in range(2):
+            retrieved = cache.get_or_retrieve(context.kbs, "query", self.rag_settings,
+                                              lambda: runner.retrieve_rag_sources(context, "query", self.rag_settings))
+            self.assertEqual(["a"], [x["id"] for x in retrieved])
+        # Without the failed knowledge base the result is not kept for other rooms
+        self.assertEqual(0, cache.stats()["entries"])
+        self.assertEqual(2, cache.stats()["misses"])
+
+    def test_slow_and_failing_knowledge_bases_left_out(self):
+        release = threading.Event()
+        fast = FakeLookupKnowledgeBase("fast", "bge-m3", [_result("a", 0.1, None)])
+        slow = FakeLookupKnowledgeBase("slow", "bge-m3", [_result("b", 0.2, None)], delay_event=release)
+        failing = FakeLookupKnowledgeBase("failing", "bge-m3", [], error=RuntimeError("store is down"))
+        try:
+            candidates, report = federated_rag_lookup([fast, slow, failing], mock_embeddings_source, "query", 5,
+                                                      self.rag_settings)
+        finally:
+            release.set()
+        self.assertEqual(["a"], [x[0].id for x in candidates])
+        self.assertEqual({"fast": "ok", "slow": "timeout", "failing": "error"},
+                         {x["knowledge_base"]: x["status"] for x in report})
+
+    def test_timed_out_knowledge_base_skipped_until_finished(self):
+        release = threading.Event()
+        fast = FakeLookupKnowledgeBase("fast_kb", "bge-m3", [_result("a", 0.1, None)])
+        slow = FakeLookupKnowledgeBase("stalled_kb", "bge-m3", [_result("b", 0.2, None)], delay_event=release)
+        try:
+            _, report = federated_rag_lookup([fast, slow], mock_embeddings_source, "query", 5, self.rag_settings)
+            self.assertEqual("timeout", report[1]["status"])
+            started = time.perf_counter()
+            candidates, report = federated_rag_lookup([fast, slow], mock_embeddings_source, "query", 5,
+                                                      self.rag_settings)
+            # The stalled knowledge base is not waited on again
+            self.assertLess(time.perf_counter() - started, self.rag_settings.rag_kb_timeout_s)
+            self.assertEqual(["a"], [x[0].id for x in candidates])
+            self.assertEqual({"fast_kb": "ok", "stalled_kb": "busy"},
+                             {x["knowledge_base"]: x["status"] for x in report})
+        finally:
+            release.set()
+        for _ in range(50):
+            if not is_stalled(slow):
+                break
+            time.sleep(0.05)
+        candidates, _ = federated_rag_lookup([fast, slow], mock_embeddings_source, "query", 5, self.rag_settings)
+        self.assertEqual(["a", "b"], [x[0].id for x in candidates])
+
+    def test_chat_context(self):
+        kb = FakeLookupKnowledgeBase("first", "bge-m3", [])
+        self.assertEqual([kb], ChatContext("model", "prompt", kb).kbs)
+        self.assertEqual([], ChatContext("model", "prompt", None).kbs)
+        other = FakeLookupKnowledgeBase("second", "bge-m3", [])
+        context = ChatContext("model", "prompt", None, kbs=[other, None, kb])
+        self.assertIs(other, context.kb)
+        self.assertEqual([other, kb], context.kbs)
+
+
+if __name__ == '__main__':
+    unittest.main()
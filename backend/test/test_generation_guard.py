@@ -1,8 +1,39 @@
+import random
 import unittest
 from generation_guard import GenerationGuard
 from settings import GENERATION_GUARD
 import itertools
 
+
+class ReferenceGenerationGuard:
+    # Whole-buffer scan the incremental guard has to agree with
+    def __init__(self, safe_token_threshold, max_repeats, window_size, token_check_interval):
+        self.safe_token_threshold = safe_token_threshold
+        self.max_repeats = max_repeats
+        self.window_size = window_size
+        self.token_check_interval = token_check_interval
+        self.current_chunk_count = 0
+        self.check_token_buffer = []
+
+    def accumulate_tokens(self, token):
+        self.current_chunk_count += 1
+        if self.current_chunk_count > self.safe_token_threshold >= 0:
+            self.check_token_buffer.append(token)
+
+    def is_infinite_generation(self):
+        if len(self.check_token_buffer) < self.window_size * self.max_repeats \
+                or self.max_repeats < 0 \
+                or self.window_size < 0 \
+                or self.current_chunk_count % self.token_check_interval != 0:
+            return False
+        sequence_counts = {}
+        for i in range(len(self.check_token_buffer) - self.window_size + 1):
+            seq = tuple(self.check_token_buffer[i:i + self.window_size])
+            sequence_counts[seq] = sequence_counts.get(seq, 0) + 1
+            if sequence_counts[seq] >= self.max_repeats:
+                return True
+        return False
+
 class RerankerTest(unittest.TestCase):
     def test_from_settings(self):
         settings = {
@@ -42,6 +73,39 @@ class RerankerTest(unittest.TestCase):
                 self.assertTrue(False)
                 break
 
+    def test_same_answers_as_full_scan(self):
+        rng = random.Random(7)
+        for _ in range(200):
+            parameters = {
+                "safe_token_threshold": rng.choice([-1, 0, 5, 40]),
+                "max_repeats": rng.choice([-1, 2, 3, 5]),
+                "window_size": rng.choice([-1, 1, 3, 6]),
+                "token_check_interval": rng.choice([1, 3, 10]),
+            }
+            guard = GenerationGuard.from_settings(parameters)
+            reference = ReferenceGenerationGuard(**parameters)
+            vocabulary = [f"t{x}" for x in range(rng.choice([2, 5, 50]))]
+            pattern = [rng.choice(vocabulary) for _ in range(rng.randint(1, 8))]
+            for position in range(rng.randint(0, 300)):
+                # Random text that sometimes falls into a loop
+                token = pattern[position % len(pattern)] if rng.random() < 0.6 else rng.choice(vocabulary)
+                guard.accumulate_tokens(token)
+                reference.accumulate_tokens(token)
+                self.assertEqual(reference.is_infinite_generation(), guard.is_infinite_generation(), parameters)
+
+    def test_buffer_cleared_on_think_content_switch(self):
+        guard = GenerationGuard(safe_token_threshold=0, max_repeats=3, window_size=2, token_check_interval=1)
+        for token in ["a", "b", "a", "b", "a"]:
+            guard.accumulate_tokens(token)
+        self.assertEqual(["b", "a"], guard.check_token_buffer)
+        guard.think_content_switch("thinking", "")
+        self.assertEqual([], guard.check_token_buffer)
+        for token in ["a", "b", "a", "b", "a"]:
+            guard.accumulate_tokens(token)
+            self.assertFalse(guard.is_infinite_generation())
+        guard.accumulate_tokens("b")
+        self.assertTrue(guard.is_infinite_generation())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import hashing
+from hashing import FAST_ALGORITHM, fast_algorithm, hash_file, hash_files
+from utils import combine_hashes, compute_folder_hash
+
+
+class HashingTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.files = []
+        for i, size in enumerate([0, 100, 3 * 1024 * 1024 + 7]):
+            file_path = os.path.join(self.temp_dir.name, f"page-{i:06}.txt")
+            with open(file_path, "wb") as fh:
+                fh.write(os.urandom(size))
+            self.files.append(file_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _sha256(self, file_path: str) -> str:
+        with open(file_path, "rb") as fh:
+            return hashlib.sha256(fh.read()).hexdigest()
+
+    def test_hash_file(self):
+        for file_path in self.files:
+            self.assertEqual(self._sha256(file_path), hash_file(file_path))
+        # Memory-mapped reads give the same hash
+        with patch.object(hashing, "MMAP_THRESHOLD", 1):
+            self.assertEqual(self._sha256(self.files[2]), hash_file(self.files[2]))
+        self.assertEqual(hash_file(self.files[1], fast_algorithm()), hash_file(self.files[1], FAST_ALGORITHM))
+        self.assertEqual(hashlib.blake2b(b"").hexdigest(), hash_file(self.files[0], "blake2b"))
+
+    def test_hash_files(self):
+        missing = os.path.join(self.temp_dir.name, "missing.txt")
+        hashes = hash_files(self.files + [missing], workers=4)
+        self.assertEqual(self.files + [missing], list(hashes.keys()))
+        self.assertEqual([self._sha256(x) for x in self.files], [hashes[x] for x in self.files])
+        self.assertIsNone(hashes[missing])
+        self.assertEqual(hashes, hash_files(self.files + [missing], workers=1))
+
+    def test_folder_hash_unchanged(self):
+        # Folder hashes stored in metadata and knowledge bases keep their SHA-256 values
+        expected = combine_hashes([self._sha256(x) for x in sorted(self.files)], extra_string_list=["model"])
+        self.assertEqual(expected, compute_folder_hash(self.temp_dir.name, extra_string_list=["model"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
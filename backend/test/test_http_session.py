@@ -0,0 +1,67 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_runners.http_session import HttpSession
+from settings import HttpSettings
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b'{"models": []}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api/tags"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_reused(self):
+        session = HttpSession(HttpSettings({"pool_maxsize": 2, "connect_timeout_s": 2, "read_timeout_s": 5}))
+        for _ in range(5):
+            self.assertEqual({"models": []}, session.get(self.url).json())
+        with session.stream("GET", self.url) as response:
+            self.assertEqual(200, response.status_code)
+        session.close()
+        stats = session.stats.to_dict()
+        self.assertEqual(6, stats["requests"])
+        self.assertEqual(1, stats["new_connections"])
+        self.assertEqual(5, stats["reused_requests"])
+        self.assertEqual(0, stats["errors"])
+
+    def test_failed_connection_recorded(self):
+        session = HttpSession(HttpSettings({"retries": 1, "backoff_factor": 0, "connect_timeout_s": 1}))
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(Exception):
+            session.get(self.url)
+        stats = session.stats.to_dict()
+        self.assertEqual(1, stats["errors"])
+        # First attempt and one retry
+        self.assertEqual(2, stats["new_connections"])
+
+    def test_settings_from_runner_config(self):
+        settings = HttpSettings.from_runner_config({"type": "ollama", "http": {"retries": 5, "read_timeout_s": 30}})
+        self.assertEqual(5, settings.retries)
+        self.assertEqual((10.0, 30.0), HttpSession(settings).timeout)
+        self.assertEqual(8, HttpSettings.from_runner_config({"type": "ollama"}).pool_maxsize)
+
+
+if __name__ == '__main__':
+    unittest.main()
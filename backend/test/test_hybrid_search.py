@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from kb.hybrid_search import LexicalIndex, lookup_stats, query_terms, reciprocal_rank_fusion, record_lookup
+
+
+class HybridSearchTest(unittest.TestCase):
+    def test_lexical_index(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = LexicalIndex(os.path.join(temp_dir, "lexical_index.sqlite3"))
+            index.add([("a", "Invoice INV-2024-0012 for bird food"), ("b", "Ducks and geese"),
+                       ("c", "Part code AX-77 for duck feeders")])
+            self.assertEqual(["a"], [x[0] for x in index.search("inv-2024-0012", 5)])
+            self.assertEqual(["c", "b"], [x[0] for x in index.search("ax-77 ducks", 5)])
+            # Quotes and FTS5 operators are searched as plain terms
+            self.assertEqual([], index.search('"NOT" OR (*)', 5))
+            index.add([("b", "Storks")])
+            self.assertEqual(3, index.count())
+            self.assertEqual([], index.search("ducks", 5))
+            self.assertEqual(["b"], [x[0] for x in index.search("storks", 5)])
+            index.add([("d", "Pelicans")], replace=False)
+            self.assertEqual(4, index.count())
+            self.assertFalse(index.is_complete())
+            index.set_complete()
+            self.assertTrue(index.is_complete())
+            index.close()
+
+    def test_rows_mapped_for_older_index(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_file = os.path.join(temp_dir, "lexical_index.sqlite3")
+            index = LexicalIndex(db_file)
+            index.add([("a", "Ducks"), ("b", "Geese")])
+            with index.connection:
+                index.connection.execute("DELETE FROM chunk_rows")
+                index.connection.execute("DELETE FROM state WHERE key = 'rows_mapped'")
+            index.close()
+            index = LexicalIndex(db_file)
+            index.add([("a", "Storks")])
+            self.assertEqual(2, index.count())
+            self.assertEqual([], index.search("ducks", 5))
+            index.close()
+
+    def test_reciprocal_rank_fusion(self):
+        fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "d"]], k=60)
+        self.assertEqual(["c", "a", "b", "d"], [x[0] for x in fused])
+        self.assertAlmostEqual(1 / 63 + 1 / 61, fused[0][1])
+
+    def test_query_terms(self):
+        self.assertEqual(["inv", "2024", "0012", "für"], query_terms("INV-2024/0012 für inv"))
+
+    def test_lookup_stats(self):
+        lookups = lookup_stats()["lookups"]
+        record_lookup({"embed": 0.01, "vector": 0.02, "total": 0.03}, True)
+        stats = lookup_stats()
+        self.assertEqual(lookups + 1, stats["lookups"])
+        self.assertEqual(30.0, stats["last_ms"]["total"])
+
+
+if __name__ == '__main__':
+    unittest.main()
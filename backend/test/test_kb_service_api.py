@@ -86,6 +86,16 @@ class KBServiceAPITest(unittest.TestCase):
         )
         self.assertEqual({'not_processed_documents': [], 'processed_documents': []}, response)
 
+    def test_kb_status_paged(self):
+        response = json.loads(
+            http.request('GET', f"http://{HOST}:{PORT}/api/kb/mock1/status?offset=0&limit=10").data.decode('utf-8')
+        )
+        self.assertEqual({"total": 0, "counts": {"processed": 0, "partial": 0, "not_processed": 0, "unknown": 0},
+                          "offset": 0, "limit": 10, "documents": []}, response)
+        lines = http.request('GET', f"http://{HOST}:{PORT}/api/kb/mock1/status/stream").data.decode('utf-8').splitlines()
+        self.assertEqual([{"counts": {"processed": 0, "partial": 0, "not_processed": 0, "unknown": 0}, "total": 0}],
+                         [json.loads(x) for x in lines])
+
     def test_kb_put(self):
         kb_config = {
             "name": "new_kb",
@@ -147,6 +157,13 @@ class KBServiceAPITest(unittest.TestCase):
         ]
         self.assertEqual(expected, response)
 
+    def test_doc_path_paged(self):
+        response = json.loads(
+            http.request('GET', f"http://{HOST}:{PORT}/api/doc/**?offset=2&limit=2").data.decode('utf-8')
+        )
+        self.assertEqual(7, response["total"])
+        self.assertEqual(['test_name/frogs.md', 'test_name/geese.pdf'], [x["path"] for x in response["items"]])
+
     def test_doc_sources(self):
         response = json.loads(
             http.request('GET', f"http://{HOST}:{PORT}/api/doc_sources").data.decode('utf-8')
@@ -4,13 +4,16 @@ import unittest
 
 from chromadb import PersistentClient
 from langchain_core.documents import Document
+from langchain_core.embeddings import FakeEmbeddings
 import os
 import sys
 
 from convertors.convertor_result import ConvertorResult
 from convertors.document_file import DocumentFile
 from kb.knowledge_base import KnowledgeBase
+from kb import chroma
 from kb.chroma import ChromaKnowledgeBase
+from kb.hybrid_search import drop_lexical_index
 from llm_runners.ollama_runner import OllamaRunner
 from settings import RAGSettings
 from test.mock_classes import MockChroma, mock_embeddings_source
@@ -115,6 +118,75 @@ class KnowledgeBaseTest(unittest.TestCase):
         relevant_documents = kb.rag_lookup(mock_embeddings_source, "lookup some rag", 5)
         self.assertEqual(len(relevant_documents), 5)
 
+    def test_chroma_rag_lookup_with_embeddings(self):
+        kb, _ = self._makeChroma()
+        kb.embedding_settings.cache = False
+        embedding_source = lambda embedding_config: FakeEmbeddings(size=4)
+        chunks = [Document(page_content=f"doc_{x}", metadata={"chunk_number": x}) for x in range(1, 4)]
+        vectors = [[1.0, 0.0, 0.0, float(x)] for x in range(1, 4)]
+        kb.store_chunks(embedding_source, chunks, vectors)
+        relevant_documents = kb.rag_lookup(embedding_source, "lookup some rag", 2, include_embeddings=True)
+        self.assertEqual(2, len(relevant_documents))
+        for document, score, vector in relevant_documents:
+            self.assertIsInstance(score, float)
+            self.assertEqual(vectors[document.metadata["chunk_number"] - 1], [float(x) for x in vector])
+
+    def test_chroma_hybrid_lookup(self):
+        class QueryEmbeddings(FakeEmbeddings):
+            def embed_query(self, text):
+                return [1.0, 0.0, 0.0, 0.0]
+
+        with open("knowledge_bases/chroma/test/config.json", "r") as fh:
+            kb_dict = json.load(fh)
+        kb = ChromaKnowledgeBase(kb_dict, os.path.join("temp", "hybrid_kb"), self.chroma_client)
+        kb.embedding_settings.cache = False
+        embedding_source = lambda embedding_config: QueryEmbeddings(size=4)
+        chunks = [Document(page_content="Geese migrate south", metadata={"chunk_number": 1}, id="geese"),
+                  Document(page_content="Ducks migrate too", metadata={"chunk_number": 2}, id="ducks"),
+                  Document(page_content="Invoice INV-2024-0012 for bird food", metadata={"chunk_number": 3},
+                           id="invoice")]
+        kb.store_chunks(embedding_source, chunks, [[1.0, 0.0, 0.0, 0.0], [0.9, 0.1, 0.0, 0.0], [0.0, 0.0, 0.0, 1.0]])
+        rag_settings = RAGSettings({"rag_document_count": 2, "rag_char_chunk_size": 1000, "rag_char_overlap": 200,
+                                    "rag_similarity_score_threshold": 0.8, "rag_score_margin": 0.2,
+                                    "rag_cosine_distance_irrelevance_threshold": 1.0})
+        vector_only = kb.rag_lookup(embedding_source, "inv-2024-0012", 2, include_embeddings=True)
+        self.assertEqual(["geese", "ducks"], [x[0].id for x in vector_only])
+        hybrid = kb.rag_lookup(embedding_source, "inv-2024-0012", 2, include_embeddings=True,
+                               rag_settings=rag_settings)
+        self.assertEqual(["geese", "invoice"], [x[0].id for x in hybrid])
+        # Chunks found by their terms only keep their vector distance
+        self.assertAlmostEqual(2.0, hybrid[1][1])
+        self.assertEqual([0.0, 0.0, 0.0, 1.0], [float(x) for x in hybrid[1][2]])
+
+        # Chunks stored before the lexical index existed are indexed in the background, the lookup does not wait
+        drop_lexical_index(kb.lexical_index_file)
+        hybrid = kb.rag_lookup(embedding_source, "inv-2024-0012", 2, include_embeddings=True,
+                               rag_settings=rag_settings)
+        self.assertEqual(2, len(hybrid))
+        chroma._lexical_backfills[kb.lexical_index_file].join(10)
+        hybrid = kb.rag_lookup(embedding_source, "inv-2024-0012", 2, include_embeddings=True,
+                               rag_settings=rag_settings)
+        self.assertEqual(["geese", "invoice"], [x[0].id for x in hybrid])
+        kb.clear()
+
+    def test_chroma_handle_reused(self):
+        kb, _ = self._makeChroma()
+        calls = []
+
+        def counting_source(embedding_config):
+            calls.append(embedding_config)
+            return mock_embeddings_source(embedding_config)
+
+        first = kb._make_chroma(counting_source)
+        kb.rag_lookup(counting_source, "lookup some rag", 5)
+        # A reloaded knowledge base shares the handle
+        reloaded, _ = self._makeChroma()
+        self.assertIs(first, reloaded._make_chroma(counting_source))
+        self.assertEqual(1, len(calls))
+        kb.clear()
+        self.assertIsNot(first, kb._make_chroma(counting_source))
+        self.assertEqual(2, len(calls))
+
     def test_chroma_add_metadata_document(self):
         document_list = [Document(f"doc_{x}") for x in range(1, 5 + 1)]
         for page_number, document in enumerate(document_list, 1):
@@ -0,0 +1,275 @@
+import os
+import shutil
+import threading
+import unittest
+from unittest.mock import patch
+from typing import Callable, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings, FakeEmbeddings
+
+from config import settings
+from convertors.convertor import Convertor
+from convertors.convertor_result import ConvertorResult
+from convertors.document_image_convertor import DocumentImageConvertor
+from convertors.llm_contexts import DocumentContext
+from doc_sources.local_file_system import LocalFileSystemSource
+from kb.knowledge_base import KnowledgeBase
+from knowledge_base_service import KnowledgeBaseService
+from pdf_to_png import page_image_name
+from settings import KB_SERVICE, PDF_RENDERING, RAG_SETTINGS, RAGSettings
+from test.mock_classes import MockKBStore, MockKnowledgeBase, MockLLMRunner
+
+
+class RecordingKnowledgeBase(MockKnowledgeBase):
+    stored: List[str] = []
+    threads: set = set()
+    lock = threading.Lock()
+    on_store: Callable[[], None] = None
+
+    def store_convertor_result(self, embedding_source: Callable[[dict], Embeddings], convertor_result: ConvertorResult,
+                               rag_settings: RAGSettings = None):
+        with RecordingKnowledgeBase.lock:
+            RecordingKnowledgeBase.stored.append(convertor_result.document_path)
+            RecordingKnowledgeBase.threads.add(threading.current_thread().name)
+        if RecordingKnowledgeBase.on_store is not None:
+            RecordingKnowledgeBase.on_store()
+
+
+class ChunkingKnowledgeBase(RecordingKnowledgeBase):
+    embeddings: List[List[float]] = []
+
+    def prepare_chunks(self, embedding_source: Callable[[dict], Embeddings], convertor_result: ConvertorResult,
+                       rag_settings: RAGSettings) -> Optional[List[Document]]:
+        return [Document(page_content=convertor_result.document_path,
+                         metadata={"document_path": convertor_result.document_path})]
+
+    def store_chunks(self, embedding_source: Callable[[dict], Embeddings], chunks: List[Document],
+                     embeddings: List[List[float]]):
+        with RecordingKnowledgeBase.lock:
+            RecordingKnowledgeBase.stored += [x.metadata["document_path"] for x in chunks]
+            RecordingKnowledgeBase.threads.add(threading.current_thread().name)
+            ChunkingKnowledgeBase.embeddings += embeddings
+
+
+class RecordingKBStore(MockKBStore):
+    def __init__(self, kb_class=RecordingKnowledgeBase):
+        super().__init__()
+        self.kb_class = kb_class
+
+    def list(self):
+        return [self.kb_class(v) for v in self.kbs.values()]
+
+
+class EmbeddingLLMRunner(MockLLMRunner):
+    def get_embedding(self, embedding_config) -> Optional[Embeddings]:
+        return FakeEmbeddings(size=4)
+
+
+class StreamingOcrLlmConvertor(DocumentImageConvertor):
+    events: List[tuple] = []
+    first_page_transcribed = threading.Event()
+
+    def __init__(self):
+        super().__init__("streaming_ocr_llm", "test_model")
+
+    def image_to_text(self, input_data, context: DocumentContext):
+        raise AssertionError("Pages are read by the OCR stage of the pipeline")
+
+    def has_ocr_step(self) -> bool:
+        return True
+
+    def ocr_images(self, image_paths: List[str], context: DocumentContext) -> List[Optional[str]]:
+        StreamingOcrLlmConvertor.events += [("ocr", threading.current_thread().name) for _ in image_paths]
+        return [f"ocr {os.path.basename(x)}" for x in image_paths]
+
+    def texts_to_text(self, input_texts: List[str], context: DocumentContext) -> List[Optional[str]]:
+        StreamingOcrLlmConvertor.events += [("llm", threading.current_thread().name) for _ in input_texts]
+        StreamingOcrLlmConvertor.first_page_transcribed.set()
+        return [x + " proofread" for x in input_texts]
+
+
+def streamed_pdf_pages(pdf_path, output_folder, dpi, workers, pages_per_range, pages):
+    for page in [1, 2, 3]:
+        if page == 3:
+            # Rendering is not finished before the first page went all the way through
+            StreamingOcrLlmConvertor.events.append(
+                ("rendered_ahead", StreamingOcrLlmConvertor.first_page_transcribed.wait(5)))
+        image_path = os.path.join(output_folder, page_image_name(page))
+        with open(image_path, "w") as fh:
+            fh.write(f"page {page}")
+        StreamingOcrLlmConvertor.events.append(("render", threading.current_thread().name))
+        yield image_path
+
+
+class KnowledgeBaseServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.cleanup()
+        self.original_settings = {key: settings.settings.get(key) for key in [KB_SERVICE, RAG_SETTINGS,
+                                                                                PDF_RENDERING]}
+        settings.settings[RAG_SETTINGS] = {
+            "rag_document_count": 20,
+            "rag_char_chunk_size": 1000,
+            "rag_char_overlap": 200,
+            "rag_similarity_score_threshold": 0.8,
+            "rag_score_margin": 0.2,
+            "rag_cosine_distance_irrelevance_threshold": 1.0
+        }
+        RecordingKnowledgeBase.stored = []
+        RecordingKnowledgeBase.threads = set()
+        RecordingKnowledgeBase.on_store = None
+        ChunkingKnowledgeBase.embeddings = []
+
+    def tearDown(self):
+        for key, value in self.original_settings.items():
+            settings.settings[key] = value
+        self.cleanup()
+
+    @staticmethod
+    def cleanup():
+        if os.path.basename(os.path.normpath(os.getcwd())) == "test":
+            for path in [".cache", "processed"]:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+
+    def _make_service(self, workers: int, pipeline: dict = None, kb_class=RecordingKnowledgeBase) -> KnowledgeBaseService:
+        settings.settings[KB_SERVICE] = {"workers": workers, "worker_type": "thread"}
+        if pipeline is not None:
+            settings.settings[KB_SERVICE]["pipeline"] = pipeline
+        kb_store = RecordingKBStore(kb_class)
+        kb_store.upsert({"name": "parallel_kb", "selection": ["**/*.pdf", "**/*.md"],
+                         "convertors": [{"conversion": "raw"}], "embedding": {"model": "test_embedding"}})
+        doc_source = LocalFileSystemSource("test_name", "documents", cache_hashes=True,
+                                           cache_dir=os.path.join(".cache", "doc_hash_cache"))
+        return KnowledgeBaseService(kb_store, doc_source, EmbeddingLLMRunner())
+
+    def test_parallel_run(self):
+        service = self._make_service(workers=3)
+        service.active = True
+        service._run()
+        status = service.service_status()
+        self.assertEqual({"status": "done", "error": False}, status)
+        expected = ['test_name/ducks.pdf', 'test_name/frogs.md', 'test_name/geese.pdf', 'test_name/same_ducks.pdf',
+                    'test_name/storks.pdf', 'test_name/water_birds.pdf']
+        self.assertEqual(expected, sorted([x.split(os.sep, 1)[0] + "/" + os.path.basename(x)
+                                           for x in RecordingKnowledgeBase.stored]))
+        self.assertTrue(all(x.startswith("kb_worker") for x in RecordingKnowledgeBase.threads))
+
+    def test_changed_documents_run(self):
+        service = self._make_service(workers=2)
+        service.active = True
+        # Paths outside the selection are skipped
+        service._run(["test_name/geese.pdf", "test_name/file.unsupported"])
+        self.assertEqual({"status": "done", "error": False}, service.service_status())
+        self.assertEqual(["geese.pdf"], [os.path.basename(x) for x in RecordingKnowledgeBase.stored])
+        # Deleted documents are dropped before a run is started
+        self.assertTrue(service._on_documents_changed(["test_name/deleted.pdf", "test_name/first"]))
+        self.assertEqual(["geese.pdf"], [os.path.basename(x) for x in RecordingKnowledgeBase.stored])
+
+    def test_kb_status_from_coverage(self):
+        service = self._make_service(workers=2)
+        expected = ['test_name/ducks.pdf', 'test_name/frogs.md', 'test_name/geese.pdf', 'test_name/same_ducks.pdf',
+                    'test_name/storks.pdf', 'test_name/water_birds.pdf']
+        self.assertEqual({"processed_documents": [], "not_processed_documents": expected},
+                         service.kb_status("parallel_kb"))
+        service.active = True
+        service._run()
+        # Answered from the coverage index, the vector store is not asked again
+        with patch.object(MockKnowledgeBase, "has_full_document", side_effect=AssertionError("queried")):
+            self.assertEqual({"processed_documents": expected, "not_processed_documents": []},
+                             service.kb_status("parallel_kb"))
+            kb = service.kb_store.get("parallel_kb")
+            kb.set_coverage(service.doc_source.cached_file_hash("test_name/geese.pdf"),
+                            KnowledgeBase.COVERAGE_PARTIAL)
+            page = service.kb_status("parallel_kb", offset=1, limit=2)
+            self.assertEqual({"processed": 5, "partial": 1, "not_processed": 0, "unknown": 0}, page["counts"])
+            self.assertEqual(6, page["total"])
+            self.assertEqual([{"path": "test_name/frogs.md", "status": "processed"},
+                              {"path": "test_name/geese.pdf", "status": "partial"}], page["documents"])
+            partial = service.kb_status("parallel_kb", status="partial")
+            self.assertEqual(["test_name/geese.pdf"], [x["path"] for x in partial["documents"]])
+            self.assertEqual(6, len(list(service.iter_kb_status("parallel_kb"))))
+            # A document changed since the run is not reported under the status of its old contents
+            storks_path = os.path.join("documents", "storks.pdf")
+            storks_stat = os.stat(storks_path)
+            try:
+                os.utime(storks_path, ns=(storks_stat.st_atime_ns, storks_stat.st_mtime_ns + 1_000_000_000))
+                page = service.kb_status("parallel_kb", status="unknown")
+                self.assertEqual(["test_name/storks.pdf"], [x["path"] for x in page["documents"]])
+                self.assertEqual({"processed": 4, "partial": 1, "not_processed": 0, "unknown": 1}, page["counts"])
+            finally:
+                os.utime(storks_path, ns=(storks_stat.st_atime_ns, storks_stat.st_mtime_ns))
+        self.assertIsNone(service.kb_status("missing_kb"))
+
+    def test_cancelled_run(self):
+        service = self._make_service(workers=2)
+        RecordingKnowledgeBase.on_store = service.stop
+        service.active = True
+        service._run()
+        status = service.service_status()
+        self.assertEqual("cancelled", status["status"])
+        self.assertNotIn("workers", status)
+        self.assertLess(len(RecordingKnowledgeBase.stored), 6)
+
+    def test_pipeline_run(self):
+        service = self._make_service(workers=1, pipeline={"enabled": True, "max_in_flight": 3,
+                                                          "stages": {"transcribe": {"workers": 2, "queue_size": 1}}})
+        statuses = []
+        RecordingKnowledgeBase.on_store = lambda: statuses.append(service.service_status())
+        service.active = True
+        service._run()
+        self.assertEqual({"status": "done", "error": False}, service.service_status())
+        expected = ['test_name/ducks.pdf', 'test_name/frogs.md', 'test_name/geese.pdf', 'test_name/same_ducks.pdf',
+                    'test_name/storks.pdf', 'test_name/water_birds.pdf']
+        self.assertEqual(expected, sorted([x.split(os.sep, 1)[0] + "/" + os.path.basename(x)
+                                           for x in RecordingKnowledgeBase.stored]))
+        self.assertTrue(all(x.startswith("kb_store") for x in RecordingKnowledgeBase.threads))
+        stages = statuses[0]["stages"]
+        self.assertEqual(["prepare", "render", "ocr", "transcribe", "chunk", "embed", "store"],
+                         [x["stage"] for x in stages])
+        self.assertEqual(2, stages[3]["workers"])
+        self.assertEqual(1, stages[3]["queue_size"])
+        self.assertTrue(all("queue_depth" in x and "items_per_min" in x for x in stages))
+
+    def test_pipeline_embeds_chunks(self):
+        service = self._make_service(workers=1, pipeline={"enabled": True}, kb_class=ChunkingKnowledgeBase)
+        service.active = True
+        service._run()
+        self.assertEqual({"status": "done", "error": False}, service.service_status())
+        self.assertEqual(6, len(RecordingKnowledgeBase.stored))
+        self.assertEqual(6, len(ChunkingKnowledgeBase.embeddings))
+        self.assertTrue(all(len(x) == 4 for x in ChunkingKnowledgeBase.embeddings))
+
+    def test_pipeline_streams_pages_through_ocr_and_llm_stages(self):
+        service = self._make_service(workers=1, pipeline={"enabled": True, "page_buffer": 1})
+        settings.settings[PDF_RENDERING] = {"text_layer": {"enabled": False}}
+        StreamingOcrLlmConvertor.events = []
+        StreamingOcrLlmConvertor.first_page_transcribed.clear()
+        service.active = True
+        with patch.object(Convertor, "from_config", return_value=StreamingOcrLlmConvertor()), \
+                patch("convertors.document_file.iter_pdf_pages", side_effect=streamed_pdf_pages):
+            service._run(["test_name/ducks.pdf"])
+        self.assertEqual({"status": "done", "error": False}, service.service_status())
+        self.assertEqual(["ducks.pdf"], [os.path.basename(x) for x in RecordingKnowledgeBase.stored])
+        events = StreamingOcrLlmConvertor.events
+        self.assertIn(("rendered_ahead", True), events)
+        threads = {step: set(x[1].rsplit("_", 1)[0] for x in events if x[0] == step)
+                   for step in ["render", "ocr", "llm"]}
+        self.assertEqual({"render": {"kb_render"}, "ocr": {"kb_ocr"}, "llm": {"kb_transcribe"}}, threads)
+        output_path = StreamingOcrLlmConvertor().get_output_path(service.doc_source.get("test_name/ducks.pdf"))
+        with open(os.path.join(output_path, page_image_name(3).replace(".png", ".txt"))) as fh:
+            self.assertEqual(f"ocr {page_image_name(3)} proofread", fh.read())
+
+    def test_cancelled_pipeline_run(self):
+        service = self._make_service(workers=1, pipeline={"enabled": True, "max_in_flight": 2})
+        RecordingKnowledgeBase.on_store = service.stop
+        service.active = True
+        service._run()
+        status = service.service_status()
+        self.assertEqual("cancelled", status["status"])
+        self.assertNotIn("stages", status)
+        self.assertLess(len(RecordingKnowledgeBase.stored), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
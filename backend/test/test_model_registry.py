@@ -0,0 +1,117 @@
+import gc
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+
+from llm_runners.llm_runner import SuperRunner
+from llm_runners.model_registry import ModelRegistry
+from llm_runners.ollama_runner import OllamaRunner
+from test.mock_classes import MockLLMRunner
+
+
+class CountingLLMRunner(MockLLMRunner):
+    def __init__(self, models):
+        self.models = models
+        self.installed_checks = 0
+        self.simple_runs = 0
+
+    def is_model_installed(self, model) -> bool:
+        self.installed_checks += 1
+        return model in self.models
+
+    def run_text_completion_simple(self, model, messages, options=None):
+        self.simple_runs += 1
+        return f"{model} says hi"
+
+    def supports_thinking(self, model):
+        return model in self.models
+
+
+def ollama_response(content: dict):
+    response = MagicMock()
+    response.content = json.dumps(content).encode("utf-8")
+    return response
+
+
+class ModelRegistryTest(unittest.TestCase):
+    def test_ttl_and_invalidation(self):
+        registry = ModelRegistry(ttl_s=60)
+        loads = []
+        loader = lambda: loads.append(1) or len(loads)
+        self.assertEqual(1, registry.get("host", "tags", loader))
+        self.assertEqual(1, registry.get("host", "tags", loader))
+        registry.invalidate("other_host")
+        self.assertEqual(1, registry.get("host", "tags", loader))
+        registry.invalidate("host")
+        self.assertEqual(2, registry.get("host", "tags", loader))
+        expired = ModelRegistry(ttl_s=0)
+        expired.get("host", "tags", loader)
+        self.assertEqual(4, expired.get("host", "tags", loader))
+
+    def test_loader_errors_are_not_cached(self):
+        registry = ModelRegistry(ttl_s=60)
+
+        def failing_loader():
+            raise ConnectionError("down")
+
+        with self.assertRaises(ConnectionError):
+            registry.get("host", "tags", failing_loader)
+        self.assertEqual("up", registry.get("host", "tags", lambda: "up"))
+
+    def test_none_not_cached(self):
+        registry = ModelRegistry(ttl_s=60)
+        self.assertIsNone(registry.get("host", "route", lambda: None, cache_none=False))
+        self.assertEqual("found", registry.get("host", "route", lambda: "found", cache_none=False))
+
+    def test_ollama_tags_cached_until_pull(self):
+        runner = OllamaRunner("http://ollama:11434/", ModelRegistry(ttl_s=60))
+        tags = ollama_response({"models": [{"model": "llama3:8b"}]})
+        with patch.object(runner.http, "get", return_value=tags) as get, \
+                patch.object(runner.http, "post",
+                             return_value=ollama_response({"capabilities": ["completion", "thinking"]})) as post:
+            runner.check_model_installed("llama3:8b")
+            self.assertTrue(runner.is_model_installed("llama3:8b"))
+            self.assertTrue(runner.supports_thinking("llama3:8b"))
+            self.assertEqual(["llama3:8b"], runner.list_chat_models())
+            self.assertEqual(1, get.call_count)
+            self.assertEqual(1, post.call_count)
+            post.return_value = ollama_response({"status": "success"})
+            self.assertTrue(runner.pull_model("qwen3:8b"))
+            runner.is_model_installed("qwen3:8b")
+            self.assertEqual(2, get.call_count)
+
+    def test_super_runner_routes(self):
+        first = CountingLLMRunner(["model_a"])
+        second = CountingLLMRunner(["model_b"])
+        super_runner = SuperRunner([first, second], ModelRegistry(ttl_s=60))
+        for _ in range(3):
+            self.assertTrue(super_runner.is_model_installed("model_b"))
+            self.assertEqual("model_b says hi", super_runner.run_text_completion_simple("model_b", []))
+            self.assertTrue(super_runner.supports_thinking("model_b"))
+        self.assertEqual(1, first.installed_checks)
+        self.assertEqual(1, second.installed_checks)
+        self.assertEqual(3, second.simple_runs)
+        self.assertFalse(super_runner.is_model_installed("model_c"))
+        second.models.append("model_c")
+        self.assertTrue(super_runner.pull_model("model_c"))
+        self.assertTrue(super_runner.is_model_installed("model_c"))
+        # A model pulled outside this runner is found without waiting for the TTL
+        self.assertFalse(super_runner.is_model_installed("model_e"))
+        first.models.append("model_e")
+        self.assertTrue(super_runner.is_model_installed("model_e"))
+
+    def test_super_runner_routes_dropped_with_runner(self):
+        registry = ModelRegistry(ttl_s=60)
+        super_runner = SuperRunner([CountingLLMRunner(["model_a"])], registry)
+        super_runner.is_model_installed("model_a")
+        self.assertEqual(1, registry.stats()["entries"])
+        super_runner.close()
+        self.assertEqual(0, registry.stats()["entries"])
+        super_runner.is_model_installed("model_a")
+        del super_runner
+        gc.collect()
+        self.assertEqual(0, registry.stats()["entries"])
+
+
+if __name__ == '__main__':
+    unittest.main()
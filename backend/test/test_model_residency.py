@@ -0,0 +1,81 @@
+import threading
+import time
+import unittest
+
+from llm_runners.model_residency import ModelResidencyManager
+from settings import ModelResidencySettings
+
+GB = 1024 ** 3
+
+
+class ModelResidencyTest(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+
+    def loader(self, name):
+        def _load():
+            self.loaded.append(name)
+            return f"{name}_weights"
+        return _load
+
+    def test_loaded_once(self):
+        manager = ModelResidencyManager()
+        for _ in range(3):
+            with manager.use("model_a", self.loader("model_a")) as value:
+                self.assertEqual("model_a_weights", value)
+        self.assertEqual(["model_a"], self.loaded)
+        stats = manager.stats()
+        self.assertEqual(1, stats["loads"])
+        self.assertEqual(2, stats["hits"])
+        self.assertEqual(3, stats["models"][0]["uses"])
+
+    def test_lru_eviction_by_count(self):
+        manager = ModelResidencyManager(ModelResidencySettings({"max_models": 2}))
+        manager.get("model_a", self.loader("model_a"))
+        manager.get("model_b", self.loader("model_b"))
+        manager.get("model_a", self.loader("model_a"))
+        manager.get("model_c", self.loader("model_c"))
+        self.assertTrue(manager.is_resident("model_a"))
+        self.assertFalse(manager.is_resident("model_b"))
+        self.assertEqual(1, manager.stats()["evictions"])
+
+    def test_memory_budget_pinned_and_in_use(self):
+        manager = ModelResidencyManager(ModelResidencySettings(
+            {"memory_budget_gb": 10, "max_models": 5, "pinned": ["model_a"]}))
+        manager.get("model_a", self.loader("model_a"), size_hint=4 * GB)
+        with manager.use("model_b", self.loader("model_b"), size_hint=4 * GB):
+            # Nothing can be unloaded, pinned and in use models stay
+            manager.get("model_c", self.loader("model_c"), size_hint=4 * GB)
+            self.assertTrue(manager.is_resident("model_b"))
+        manager.get("model_d", self.loader("model_d"), size_hint=4 * GB)
+        self.assertTrue(manager.is_resident("model_a"))
+        self.assertFalse(manager.is_resident("model_b"))
+        self.assertFalse(manager.is_resident("model_c"))
+        self.assertEqual(8.0, manager.stats()["used_gb"])
+
+    def test_concurrent_requests_load_once(self):
+        manager = ModelResidencyManager()
+
+        def slow_loader():
+            time.sleep(0.05)
+            self.loaded.append("model_a")
+            return "model_a_weights"
+
+        threads = [threading.Thread(target=manager.get, args=("model_a", slow_loader)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(["model_a"], self.loaded)
+
+    def test_preload_and_evict(self):
+        manager = ModelResidencyManager()
+        manager.preload("model_a", self.loader("model_a"), size_of=lambda value: 2 * GB).join()
+        self.assertTrue(manager.is_resident("model_a"))
+        self.assertEqual(2.0, manager.stats()["used_gb"])
+        self.assertTrue(manager.evict("model_a"))
+        self.assertFalse(manager.evict("model_a"))
+
+
+if __name__ == '__main__':
+    unittest.main()
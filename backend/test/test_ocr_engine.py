@@ -0,0 +1,71 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+from convertors.ocr_engine import TesseractEngine, get_tesseract_engine, ocr_stats
+
+# Stands in for tesseract: prints "<languages>:<image name>" per page followed by the page separator and logs every run
+FAKE_TESSERACT = """#!{python}
+import os
+import sys
+languages, source = sys.argv[2], sys.argv[3]
+with open(os.path.join(os.path.dirname(sys.argv[0]), "runs.log"), "a") as fh:
+    fh.write(source + "\\n")
+if source.endswith(".txt"):
+    with open(source) as fh:
+        images = [x for x in fh.read().split("\\n") if x != ""]
+else:
+    images = [source]
+for image in images:
+    if "broken" in image:
+        sys.exit(1)
+    sys.stdout.write(languages + ":" + os.path.basename(image) + "\\f")
+"""
+
+
+class OcrEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.tesseract_path = os.path.join(self.folder, "tesseract")
+        with open(self.tesseract_path, "w") as fh:
+            fh.write(FAKE_TESSERACT.format(python=sys.executable))
+        os.chmod(self.tesseract_path, os.stat(self.tesseract_path).st_mode | stat.S_IEXEC)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def runs(self):
+        with open(os.path.join(self.folder, "runs.log")) as fh:
+            return fh.read().split("\n")[:-1]
+
+    def test_batch_runs_once(self):
+        engine = TesseractEngine(self.tesseract_path, ["eng", "lav"])
+        texts = engine.images_to_text(["a.png", "b.png", "c.png"])
+        self.assertEqual(["eng+lav:a.png\f", "eng+lav:b.png\f", "eng+lav:c.png\f"], texts)
+        self.assertEqual(1, len(self.runs()))
+        self.assertEqual("eng+lav:d.png\f", engine.image_to_text("d.png"))
+        stats = engine.stats.to_dict()
+        self.assertEqual(4, stats["pages"])
+        self.assertEqual(2, stats["batches"])
+        self.assertIsNotNone(stats["avg_page_s"])
+
+    def test_failed_batch_falls_back_to_pages(self):
+        engine = TesseractEngine(self.tesseract_path, ["eng"])
+        texts = engine.images_to_text(["a.png", "broken.png"])
+        self.assertEqual(["eng:a.png\f", None], texts)
+        self.assertEqual(3, len(self.runs()))
+        self.assertEqual(1, engine.stats.to_dict()["failed_pages"])
+
+    def test_engine_per_language_set(self):
+        engine = get_tesseract_engine(["eng"], self.tesseract_path)
+        self.assertIs(engine, get_tesseract_engine(["eng"], self.tesseract_path))
+        self.assertIsNot(engine, get_tesseract_engine(["eng", "lav"], self.tesseract_path))
+        engine.image_to_text("a.png")
+        self.assertIn({"engine": "tesseract", "languages": ["eng"], **engine.stats.to_dict()}, ocr_stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_runners.ollama_runner import OllamaRunner
+from llm_runners.model_registry import ModelRegistry
+from settings import KeepAliveSettings
+
+DONE_MESSAGE = {
+    "done": True, "total_duration": 3_000_000_000, "load_duration": 1_000_000_000,
+    "prompt_eval_count": 400, "prompt_eval_duration": 500_000_000,
+    "eval_count": 60, "eval_duration": 1_500_000_000,
+}
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def _send(self, body: bytes):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send(json.dumps({"models": [{"model": "chat_model"}]}).encode("utf-8"))
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        FakeOllamaHandler.requests.append((self.path, payload))
+        if self.path == "/api/chat" and not payload.get("stream", True):
+            self._send(json.dumps({"message": {"content": "Ducks eat bread."}, **DONE_MESSAGE}).encode("utf-8"))
+        elif self.path == "/api/chat":
+            lines = [{"message": {"content": x}, "done": False} for x in ["Ducks ", "eat ", "bread."]]
+            self._send("\n".join(json.dumps(x) for x in lines + [DONE_MESSAGE]).encode("utf-8"))
+        else:
+            self._send(json.dumps({"model": payload["model"], "response": "", "done": True}).encode("utf-8"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OllamaRunnerTest(unittest.TestCase):
+    def setUp(self):
+        FakeOllamaHandler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOllamaHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.runner = OllamaRunner(
+            f"http://127.0.0.1:{self.server.server_address[1]}", registry=ModelRegistry(),
+            keep_alive_settings=KeepAliveSettings({"default": "30m", "models": {"pinned_model": -1}})
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive_and_timings(self):
+        messages = [{"role": "system", "content": "system"}, {"role": "user", "content": "What do ducks eat?"}]
+        text, failed = self.runner.run_text_completion_streaming("chat_model", messages, lambda: False, None, None)
+        self.assertEqual("Ducks eat bread.", text)
+        self.assertFalse(failed)
+        path, payload = FakeOllamaHandler.requests[-1]
+        self.assertEqual("/api/chat", path)
+        self.assertEqual("30m", payload["keep_alive"])
+
+        stats = self.runner.generation_stats()[0]["models"]["chat_model"]
+        self.assertEqual(1, stats["requests"])
+        self.assertEqual(1, stats["loads"])
+        self.assertEqual(800.0, stats["prompt_tokens_per_s"])
+        self.assertEqual(40.0, stats["eval_tokens_per_s"])
+        self.assertEqual({"prompt_tokens": 400, "prompt_ms": 500.0, "eval_tokens": 60, "eval_ms": 1500.0,
+                          "load_ms": 1000.0, "total_ms": 3000.0}, stats["last"])
+
+    def test_warm_up(self):
+        self.assertTrue(self.runner.warm_up("pinned_model"))
+        path, payload = FakeOllamaHandler.requests[-1]
+        self.assertEqual("/api/generate", path)
+        self.assertEqual({"model": "pinned_model", "prompt": "", "stream": False, "keep_alive": -1}, payload)
+
+    def test_keep_alive_not_set(self):
+        self.assertIsNone(KeepAliveSettings().for_model("chat_model"))
+        runner = OllamaRunner(self.runner.host, registry=ModelRegistry())
+        runner.warm_up("chat_model")
+        self.assertNotIn("keep_alive", FakeOllamaHandler.requests[-1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
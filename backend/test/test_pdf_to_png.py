@@ -0,0 +1,88 @@
+import os
+import shutil
+import threading
+import unittest
+from unittest.mock import patch
+
+import pdf_to_png
+from pdf_to_png import get_page_count, iter_pdf_pages, page_image_name, split_page_list, split_page_ranges
+
+
+class PdfToPngTest(unittest.TestCase):
+    OUTPUT = "temp_images"
+
+    def setUp(self):
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
+
+    def cleanup(self):
+        if os.path.exists(self.OUTPUT) and os.path.basename(os.path.normpath(os.getcwd())) == "test":
+            shutil.rmtree(self.OUTPUT)
+
+    def test_split_page_ranges(self):
+        self.assertEqual([(1, 4), (5, 8), (9, 10)], split_page_ranges(10, 4))
+        self.assertEqual([(1, 1), (2, 2)], split_page_ranges(2, 0))
+        self.assertEqual([], split_page_ranges(0, 4))
+
+    def test_split_page_list(self):
+        self.assertEqual([(1, 2), (4, 4), (6, 7), (8, 8)], split_page_list([8, 1, 2, 4, 6, 7], 2))
+        self.assertEqual([], split_page_list([], 2))
+
+    def test_page_image_name(self):
+        self.assertEqual("page-000012.png", page_image_name(12))
+
+    def test_get_page_count(self):
+        self.assertEqual(3, get_page_count("documents/ducks.pdf"))
+        self.assertIsNone(get_page_count("documents/missing.pdf"))
+
+    def test_iter_pdf_pages_in_order(self):
+        rendered = []
+        lock = threading.Lock()
+
+        def fake_render(pdf_path, output, first_page, last_page, dpi):
+            with lock:
+                rendered.append((first_page, last_page, dpi))
+            paths = []
+            for page in range(first_page, last_page + 1):
+                path = os.path.join(output, page_image_name(page))
+                open(path, "w").close()
+                paths.append(path)
+            return paths
+
+        with patch.object(pdf_to_png, "render_page_range", side_effect=fake_render):
+            pages = list(iter_pdf_pages("documents/ducks.pdf", self.OUTPUT, dpi=150, workers=2, pages_per_range=1))
+        self.assertEqual([page_image_name(x) for x in [1, 2, 3]], [os.path.basename(x) for x in pages])
+        self.assertEqual([(1, 1, 150), (2, 2, 150), (3, 3, 150)], sorted(rendered))
+
+    def test_iter_pdf_pages_selected_pages(self):
+        with patch.object(pdf_to_png, "render_page_range",
+                          side_effect=lambda pdf_path, output, first, last, dpi: [str(x) for x in range(first, last + 1)]):
+            self.assertEqual(["1", "3"], list(iter_pdf_pages("documents/ducks.pdf", self.OUTPUT, pages=[3, 1])))
+            self.assertEqual([], list(iter_pdf_pages("documents/ducks.pdf", self.OUTPUT, pages=[])))
+
+    def test_iter_pdf_pages_failed_range(self):
+        with patch.object(pdf_to_png, "render_page_range", return_value=None):
+            with self.assertRaises(RuntimeError):
+                list(iter_pdf_pages("documents/ducks.pdf", self.OUTPUT, workers=2))
+
+    def test_render_page_range_renames_pages(self):
+        def fake_xpdf(pdf_path, output, first_page, last_page, dpi):
+            os.makedirs(output, exist_ok=True)
+            paths = []
+            for page in range(first_page, last_page + 1):
+                path = os.path.join(output, f"prefix-{page}.png")
+                open(path, "w").close()
+                paths.append(path)
+            return paths
+
+        with patch.object(pdf_to_png, "xpdf_convert", side_effect=fake_xpdf), \
+                patch.object(pdf_to_png, "get_xpdf_path", return_value="pdftopng"):
+            paths = pdf_to_png.render_page_range("documents/ducks.pdf", self.OUTPUT, 9, 10)
+        self.assertEqual([page_image_name(9), page_image_name(10)], [os.path.basename(x) for x in paths])
+        self.assertEqual(sorted([page_image_name(9), page_image_name(10)]), sorted(os.listdir(self.OUTPUT)))
+
+
+if __name__ == '__main__':
+    unittest.main()
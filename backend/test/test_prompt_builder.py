@@ -0,0 +1,146 @@
+import json
+import unittest
+
+from domain import RoomMessage, MessageProgress
+from prompt_builder import PromptBuilder, TokenEstimator, NO_RAG_CONTEXT_TEXT, rag_context, SUMMARY_TEXT
+from settings import PromptSettings
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def source(source_id: str, content: str) -> dict:
+    return {"id": source_id, "similarity_score": 0.1, "metadata": {}, "content": content}
+
+
+def turn(question: str, answer: str, sources=None):
+    rag_sources = None if sources is None else json.dumps(sources)
+    return [RoomMessage(role="user", content=question, rag_sources=rag_sources),
+            RoomMessage(role="assistant", content=answer, rag_sources=rag_sources)]
+
+
+class PromptBuilderTest(unittest.TestCase):
+    def test_everything_fits(self):
+        history = [RoomMessage(role="system", content="stored system")] + turn("first question", "first answer")
+        prompt = PromptBuilder(count_words, 1000).build("system", history, "second question", None)
+        self.assertEqual([
+            {"role": "system", "content": "system"},
+            {"role": "user", "content": "first question"},
+            {"role": "assistant", "content": "first answer"},
+            {"role": "user", "content": "second question"},
+        ], prompt.messages)
+        self.assertEqual(0, prompt.token_usage["dropped_messages"])
+        self.assertEqual(prompt.token_usage["total"], sum(count_words(x["content"]) + 4 for x in prompt.messages))
+
+    def test_no_rag_sources(self):
+        prompt = PromptBuilder(count_words, 1000).build("system", [], "question", [])
+        self.assertEqual("question" + NO_RAG_CONTEXT_TEXT, prompt.messages[-1]["content"])
+        self.assertEqual([], prompt.rag_sources)
+
+    def test_history_window(self):
+        history = []
+        for number in range(10):
+            history += turn(f"question {number} " + "word " * 20, f"answer {number} " + "word " * 20)
+        settings = PromptSettings({"summarize_dropped": False})
+        prompt = PromptBuilder(count_words, 150, settings).build("system", history, "last question", None)
+        usage = prompt.token_usage
+        self.assertLessEqual(usage["total"], 150)
+        self.assertEqual(4, usage["history_messages"])
+        self.assertEqual(16, usage["dropped_messages"])
+        # Newest turns are kept and the window starts with a question
+        self.assertEqual("user", prompt.messages[1]["role"])
+        self.assertTrue(prompt.messages[1]["content"].startswith("question 8"))
+        self.assertEqual("system", prompt.messages[0]["content"])
+
+    def test_summary_of_dropped_turns(self):
+        history = []
+        for number in range(10):
+            history += turn(f"question {number} " + "word " * 20, f"answer {number} " + "word " * 20)
+        settings = PromptSettings({"summary_tokens": 60})
+        prompt = PromptBuilder(count_words, 200, settings).build("system", history, "last question", None)
+        system = prompt.messages[0]["content"]
+        self.assertTrue(system.startswith("system" + SUMMARY_TEXT))
+        # Questions still in the window are not summarized, the latest left out one is
+        self.assertTrue(prompt.messages[1]["content"].startswith("question 9"))
+        self.assertIn("- question 8", system)
+        self.assertNotIn("question 9", system)
+        self.assertLessEqual(prompt.token_usage["total"], 200)
+        self.assertGreater(prompt.token_usage["summary"], 0)
+
+    def test_rag_sources_deduplicated(self):
+        duck, goose, stork = source("1", "ducks eat bread"), source("2", "geese honk"), source("3", "storks fly")
+        history = turn("about ducks", "ducks answer", [duck, goose]) + turn("about geese", "geese answer", [goose])
+        prompt = PromptBuilder(count_words, 1000).build("system", history, "about storks", [stork, duck])
+        self.assertEqual([
+            {"role": "system", "content": "system"},
+            {"role": "user", "content": "about ducks" + rag_context([duck, goose])},
+            {"role": "assistant", "content": "ducks answer"},
+            {"role": "user", "content": "about geese"},
+            {"role": "assistant", "content": "geese answer"},
+            {"role": "user", "content": "about storks" + rag_context([stork])},
+        ], prompt.messages)
+        # Sources of this turn are all saved with the message
+        self.assertEqual([stork, duck], prompt.rag_sources)
+        self.assertEqual(2, prompt.token_usage["sources_deduplicated"])
+
+        settings = PromptSettings({"dedupe_rag_sources": False})
+        prompt = PromptBuilder(count_words, 1000, settings).build("system", history, "about storks", [stork, duck])
+        self.assertEqual("about geese" + rag_context([goose]), prompt.messages[3]["content"])
+        self.assertEqual("about storks" + rag_context([stork, duck]), prompt.messages[-1]["content"])
+
+    def test_window_prefix_stable(self):
+        settings = PromptSettings({"summarize_dropped": False, "window_slack": 0.5})
+        history = []
+        window_start = None
+        previous = None
+        slides = 0
+        for number in range(20):
+            prompt = PromptBuilder(count_words, 200, settings).build("system", history, f"question {number}", None,
+                                                                      window_start)
+            self.assertLessEqual(prompt.token_usage["total"], 200)
+            if previous is not None:
+                if prompt.window_start == window_start:
+                    # Everything sent before the new question goes out again unchanged
+                    self.assertEqual(previous.messages[:-1], prompt.messages[:len(previous.messages) - 1])
+                    self.assertEqual(previous.messages[-1], prompt.messages[len(previous.messages) - 1])
+                else:
+                    slides += 1
+            window_start = prompt.window_start
+            previous = prompt
+            history += turn(f"question {number}", "answer " + "word " * 20)
+            for message_id, message in enumerate(history):
+                message.id = message_id
+        self.assertGreater(slides, 0)
+        self.assertLess(slides, 8)
+
+    def test_rag_sources_trimmed_to_budget(self):
+        sources = [source(str(x), "word " * 30) for x in range(5)]
+        prompt = PromptBuilder(count_words, 100).build("system", [], "question", sources)
+        self.assertEqual(sources[:2], prompt.rag_sources)
+        self.assertEqual(3, prompt.token_usage["rag_sources_left_out"])
+        self.assertLessEqual(prompt.token_usage["total"], 100)
+
+    def test_prompt_budget(self):
+        settings = PromptSettings({"context_tokens": 4096, "response_tokens": 1000,
+                                   "model_context_tokens": {"big": 32768}})
+        self.assertEqual(3096, settings.prompt_budget("small"))
+        self.assertEqual(31768, settings.prompt_budget("big"))
+
+    def test_token_estimator(self):
+        estimator = TokenEstimator()
+        self.assertEqual(3, estimator.count("model", "a" * 10))
+        estimator.calibrate("model", 200, 100)
+        self.assertEqual(5, estimator.count("model", "a" * 10))
+        estimator.calibrate("model", 400, 100)
+        self.assertAlmostEqual(2.6, estimator.ratio("model"))
+        self.assertEqual(3, estimator.count("other", "a" * 10))
+
+    def test_message_progress_token_usage(self):
+        progress = MessageProgress("started", 0, 0, 0, token_usage={"total": 10})
+        self.assertEqual({"total": 10}, progress.as_dict()["token_usage"])
+        self.assertNotEqual(MessageProgress("started", 0, 0, 0), progress)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,9 @@
+import itertools
 import unittest
+
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+
 from reranker import rerank
 from langchain_ollama import OllamaEmbeddings
 
@@ -63,5 +68,74 @@ class RerankerTest(unittest.TestCase):
         )
         result = rerank(documents, embedding=OllamaEmbeddings(model="bge-m3"), rag_settings=rag_settings)
         self.assertEqual(0, len(result))
+    @staticmethod
+    def _rag_settings():
+        return RAGSettings(
+            {
+                "rag_document_count": 20,
+                "rag_char_chunk_size": 1000,
+                "rag_char_overlap": 200,
+                "rag_similarity_score_threshold": 0.8,
+                "rag_score_margin": 0.2,
+                "rag_cosine_distance_irrelevance_threshold": 1.0
+            }
+        )
+
+    @staticmethod
+    def _reference_rerank(documents, rag_settings):
+        # Grouping as done before stored vectors were reused
+        relevant_documents = [x for x in documents if x["similarity_score"] < rag_settings.rag_cosine_distance_irrelevance_threshold]
+        if len(relevant_documents) == 0:
+            return relevant_documents
+        min_score = min([x["similarity_score"] for x in relevant_documents])
+        min_filtered_documents = [x for x in relevant_documents if x["similarity_score"] < min_score + rag_settings.rag_score_margin]
+        cs_embeddings = cosine_similarity([x["embedding"] for x in min_filtered_documents])
+        similar_documents = []
+        for cs_similarities in cs_embeddings:
+            documents_above_threshold = [i for i, v in enumerate(list(cs_similarities)) if v > rag_settings.rag_similarity_score_threshold]
+            if len(documents_above_threshold) > 1:
+                similar_documents.append(documents_above_threshold)
+        similar_documents.sort()
+        skip_documents = []
+        for document_group in list(k for k, _ in itertools.groupby(similar_documents)):
+            most_relevant_document = None
+            for document_index in document_group:
+                if most_relevant_document is None:
+                    most_relevant_document = document_index
+                    continue
+                if min_filtered_documents[document_index]["similarity_score"] < min_filtered_documents[most_relevant_document]["similarity_score"]:
+                    skip_documents.append(most_relevant_document)
+                    most_relevant_document = document_index
+                else:
+                    skip_documents.append(document_index)
+        return [v for i, v in enumerate(min_filtered_documents) if i not in skip_documents]
+
+    def test_reranker_stored_embeddings(self):
+        documents = [
+            {"similarity_score": 0.45, "content": "duck paddled", "embedding": [1.0, 0.0, 0.1]},
+            {"similarity_score": 0.44, "content": "duck paddled gently", "embedding": [1.0, 0.05, 0.1]},
+            {"similarity_score": 0.47, "content": "ducks gathered", "embedding": [0.0, 1.0, 0.0]},
+            {"similarity_score": 0.51, "content": "ducklings followed", "embedding": [0.0, 0.0, 1.0]},
+            {"similarity_score": 0.90, "content": "wetlands at dawn", "embedding": [0.5, 0.5, 0.5]},
+        ]
+        # No embedding model needed when every document has its vector
+        result = rerank(documents, embedding=None, rag_settings=self._rag_settings())
+        self.assertEqual(["duck paddled gently", "ducks gathered", "ducklings followed"], [x["content"] for x in result])
+
+    def test_reranker_matches_reference(self):
+        rng = np.random.default_rng(42)
+        rag_settings = self._rag_settings()
+        for _ in range(50):
+            centers = rng.normal(size=(4, 8))
+            documents = []
+            for document_number in range(int(rng.integers(1, 25))):
+                vector = centers[rng.integers(0, 4)] + rng.normal(scale=0.3, size=8)
+                score = float(np.round(rng.uniform(0.3, 0.6), 2))
+                documents.append({"similarity_score": score, "content": str(document_number),
+                                  "embedding": vector.tolist()})
+            self.assertEqual([x["content"] for x in self._reference_rerank(documents, rag_settings)],
+                             [x["content"] for x in rerank(documents, None, rag_settings)])
+
+
 if __name__ == '__main__':
     unittest.main()
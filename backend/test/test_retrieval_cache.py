@@ -0,0 +1,117 @@
+import time
+import unittest
+
+from kb import retrieval_cache
+from kb.retrieval_cache import RetrievalCache, bump_kb_version, normalize_query
+from settings import RAGSettings
+from test.mock_classes import MockKnowledgeBase
+
+RAG_SETTINGS = {
+    "rag_document_count": 5,
+    "rag_char_chunk_size": 1000,
+    "rag_char_overlap": 100,
+    "rag_similarity_score_threshold": 0.0,
+    "rag_score_margin": 0.5,
+    "rag_cosine_distance_irrelevance_threshold": 1.0,
+}
+
+
+class Retriever:
+    def __init__(self, cacheable: bool = True):
+        self.calls = 0
+        self.cacheable = cacheable
+
+    def __call__(self):
+        self.calls += 1
+        return [{"id": str(self.calls), "content": "ducks"}], self.cacheable
+
+
+class RetrievalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.kb = MockKnowledgeBase.create("cache_test_kb", [], [], {})
+        self.rag_settings = RAGSettings(RAG_SETTINGS)
+
+    def test_normalize_query(self):
+        self.assertEqual("what do ducks eat", normalize_query("  What   do ducks\teat?? "))
+
+    def test_exact_hit(self):
+        cache = RetrievalCache()
+        retrieve = Retriever()
+        first = cache.get_or_retrieve([self.kb], "What do ducks eat?", self.rag_settings, retrieve)
+        second = cache.get_or_retrieve([self.kb], "what do  ducks eat", self.rag_settings, retrieve)
+        self.assertEqual(1, retrieve.calls)
+        self.assertEqual(first, second)
+        # Callers get their own copy
+        second[0]["content"] = "geese"
+        self.assertEqual("ducks", cache.get_or_retrieve([self.kb], "what do ducks eat", self.rag_settings,
+                                                         retrieve)[0]["content"])
+        stats = cache.stats()
+        self.assertEqual(2, stats["hits"])
+        self.assertEqual(1, stats["misses"])
+        self.assertAlmostEqual(0.667, stats["hit_rate"])
+
+    def test_settings_change_misses(self):
+        cache = RetrievalCache()
+        retrieve = Retriever()
+        cache.get_or_retrieve([self.kb], "ducks", self.rag_settings, retrieve)
+        other_settings = RAGSettings({**RAG_SETTINGS, "rag_document_count": 10})
+        cache.get_or_retrieve([self.kb], "ducks", other_settings, retrieve)
+        self.assertEqual(2, retrieve.calls)
+
+    def test_version_bump_invalidates(self):
+        cache = RetrievalCache()
+        retrieval_cache._cache, saved_cache = cache, retrieval_cache._cache
+        try:
+            retrieve = Retriever()
+            cache.get_or_retrieve([self.kb], "ducks", self.rag_settings, retrieve)
+            bump_kb_version(self.kb.content_key())
+            self.assertEqual(0, cache.stats()["entries"])
+            self.assertEqual(1, cache.stats()["invalidations"])
+            self.assertEqual("2", cache.get_or_retrieve([self.kb], "ducks", self.rag_settings, retrieve)[0]["id"])
+        finally:
+            retrieval_cache._cache = saved_cache
+
+    def test_lru_and_ttl_eviction(self):
+        cache = RetrievalCache(max_entries=2)
+        retrieve = Retriever()
+        for query in ["ducks", "geese", "ducks", "storks"]:
+            cache.get_or_retrieve([self.kb], query, self.rag_settings, retrieve)
+        # "geese" was the least recently used one
+        self.assertEqual(3, retrieve.calls)
+        cache.get_or_retrieve([self.kb], "geese", self.rag_settings, retrieve)
+        self.assertEqual(4, retrieve.calls)
+        self.assertEqual(2, cache.stats()["evictions"])
+
+        cache = RetrievalCache(ttl_s=0.05)
+        cache.get_or_retrieve([self.kb], "ducks", self.rag_settings, retrieve)
+        time.sleep(0.1)
+        cache.get_or_retrieve([self.kb], "ducks", self.rag_settings, retrieve)
+        self.assertEqual(6, retrieve.calls)
+
+    def test_near_duplicate(self):
+        vectors = {"what do ducks eat": [1.0, 0.0], "what food do ducks eat": [0.99, 0.05],
+                   "where do storks live": [0.0, 1.0]}
+        cache = RetrievalCache(similarity_threshold=0.95)
+        retrieve = Retriever()
+        for query in vectors:
+            cache.get_or_retrieve([self.kb], query, self.rag_settings, retrieve,
+                                  embed_query=lambda: vectors[query])
+        self.assertEqual(2, retrieve.calls)
+        self.assertEqual(1, cache.stats()["near_hits"])
+
+        # Without a threshold the query is never embedded
+        cache = RetrievalCache()
+        cache.get_or_retrieve([self.kb], "ducks", self.rag_settings, retrieve,
+                              embed_query=lambda: self.fail("embedded"))
+
+    def test_partial_result_not_cached(self):
+        cache = RetrievalCache()
+        retrieve = Retriever(cacheable=False)
+        self.assertEqual("1", cache.get_or_retrieve([self.kb], "ducks", self.rag_settings, retrieve)[0]["id"])
+        self.assertEqual("2", cache.get_or_retrieve([self.kb], "ducks", self.rag_settings, retrieve)[0]["id"])
+        self.assertEqual(0, cache.stats()["entries"])
+        self.assertEqual(2, cache.stats()["misses"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import threading
+import unittest
+
+import flask_app
+from test.mock_classes import MockLLMRunner
+
+
+class BlockingWarmUpRunner(MockLLMRunner):
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.warm_ups = []
+
+    def is_model_installed(self, model) -> bool:
+        return model == "chat_model"
+
+    def warm_up(self, model: str) -> bool:
+        self.warm_ups.append(model)
+        self.started.set()
+        return self.release.wait(5)
+
+
+class WarmUpRouteTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = BlockingWarmUpRunner()
+        self.saved_runner = getattr(flask_app, "super_runner", None)
+        flask_app.super_runner = self.runner
+        self.client = flask_app.app.test_client()
+
+    def tearDown(self):
+        self.runner.release.set()
+        for thread in list(flask_app.warm_up_threads.values()):
+            thread.join(5)
+        flask_app.warm_up_threads.clear()
+        flask_app.super_runner = self.saved_runner
+
+    def test_one_warm_up_per_model(self):
+        self.assertEqual(405, self.client.get("/api/room/1/warm_up?model=chat_model").status_code)
+        for _ in range(3):
+            response = self.client.post("/api/room/1/warm_up?model=chat_model")
+            self.assertEqual({"model": "chat_model", "status": "warming up"}, response.get_json())
+        self.assertTrue(self.runner.started.wait(5))
+        self.assertEqual(["chat_model"], self.runner.warm_ups)
+        self.assertEqual(404, self.client.post("/api/room/1/warm_up?model=other_model").status_code)
+
+        self.runner.release.set()
+        flask_app.warm_up_threads["chat_model"].join(5)
+        self.client.post("/api/room/1/warm_up?model=chat_model")
+        flask_app.warm_up_threads["chat_model"].join(5)
+        self.assertEqual(["chat_model", "chat_model"], self.runner.warm_ups)
+
+
+if __name__ == '__main__':
+    unittest.main()
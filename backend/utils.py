@@ -5,6 +5,8 @@ from typing import List
 import re
 import ipaddress
 
+from hashing import hash_file, hash_files
+
 def utc_now():
     return datetime.datetime.now(datetime.UTC)
 
@@ -15,20 +17,9 @@ def clean_name(text):
 
 def compute_file_hash(file_path, algorithm='sha256'):
     """Compute the hash of a file using the specified algorithm."""
-    hash_func = hashlib.new(algorithm)
-
-    with open(file_path, 'rb') as file:
-        while chunk := file.read(8192):  # Read the file in chunks of 8192 bytes
-            hash_func.update(chunk)
-
-    return hash_func.hexdigest()
+    return hash_file(file_path, algorithm)
 
 def compute_folder_hash(folder_path, algorithm='sha256', extra_string_list: List[str] = None):
-    if extra_string_list is None:
-        extra_string_list = []
-    extra_string_list = [x for x in extra_string_list if x is not None]
-    hash_func = hashlib.new(algorithm)
-    hashes = []
     if not os.path.exists(folder_path):
         return None
     files = os.listdir(folder_path)
@@ -36,14 +27,67 @@ def compute_folder_hash(folder_path, algorithm='sha256', extra_string_list: List
         return None
     files = [x for x in files if not os.path.isdir(os.path.join(folder_path, x))]
     files.sort()
-    for file in files:
-        hashes.append(compute_file_hash(os.path.join(folder_path, file)))
-    hashes = hashes + extra_string_list
-    hash_func.update(''.join(hashes).encode())
+    file_hashes = hash_files([os.path.join(folder_path, file) for file in files])
+    hashes = list(file_hashes.values())
+    if None in hashes:
+        return None
+    return combine_hashes(hashes, algorithm, extra_string_list)
+
 
+def combine_hashes(hashes: List[str], algorithm='sha256', extra_string_list: List[str] = None):
+    # Folder hash from the hashes of its files, sorted by file name
+    if extra_string_list is None:
+        extra_string_list = []
+    extra_string_list = [x for x in extra_string_list if x is not None]
+    hash_func = hashlib.new(algorithm)
+    hash_func.update(''.join(hashes + extra_string_list).encode())
     return hash_func.hexdigest()
 
 
+def _glob_regex(pattern: str) -> str:
+    # Same meaning as glob.glob(recursive=True): "**" spans folders, "*" and "?" stay within one
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            characters = pattern[i + 1:end].replace("\\", "\\\\")
+            regex += "[" + ("^" + characters[1:] if characters.startswith("!") else characters) + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+def selection_matches(path: str, selection: List[str]) -> bool:
+    """
+    True if the document path would be listed by one of the selection patterns of a knowledge base.
+    Patterns without wildcards select a file or the files directly inside a folder.
+    """
+    path = to_posix_path(path)
+    for pattern in selection:
+        pattern = to_posix_path(pattern).rstrip("/")
+        if not any(x in pattern for x in ["*", "?", "["]):
+            if path == pattern or path.rsplit("/", 1)[0] == pattern:
+                return True
+        elif re.fullmatch(_glob_regex(pattern), path):
+            return True
+    return False
+
+
 def is_valid_host(value: str) -> bool:
     if value is None or not isinstance(value, str):
         return False
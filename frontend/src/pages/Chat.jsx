@@ -134,6 +134,15 @@ function Chat({ roomId }) {
   // effective knowledge base
   const kb = _kb ?? lastKnowledgeBase ?? roomDefaults?.knowledge_base ?? "None";
 
+  // load the model of the room while the user types
+  useEffect(() => {
+    if (model) {
+      fetch(`/api/room/${roomId}/warm_up?model=${encodeURIComponent(model)}`, {
+        method: "POST",
+      });
+    }
+  }, [roomId, model]);
+
   const generating = ["started", "generating"].includes(progress.status);
   const inputDisabled = model === null || generating;
 
@@ -274,6 +283,15 @@ function ProgressInfo({ progress }) {
       }
       return msg;
     } else if (progress.status === "started") {
+      if (progress.token_usage) {
+        return (
+          "Processing history ... Prompt: " +
+          progress.token_usage.total +
+          " of " +
+          progress.token_usage.budget +
+          " tokens"
+        );
+      }
       return "Processing history ...";
     } else if (progress.status === "error") {
       return "An error occurred. Error: " + progress.message;
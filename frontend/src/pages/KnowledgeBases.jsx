@@ -167,9 +167,20 @@ function KBService() {
     if (result.convertor !== undefined) {
       status += ` - Convertor \"${result.convertor}\"`;
     }
+    if (result.doc_done !== undefined && result.doc_total !== undefined) {
+      status += ` - Documents done [${result.doc_done}/${result.doc_total}]`;
+    }
     return status;
   }
 
+  function workerStr(worker) {
+    return `${worker.worker}: ${statusStr({ ...worker, status: "" }).replace(/^ - /, "")}`;
+  }
+
+  function stageStr(stage) {
+    return `${stage.stage}: queue ${stage.queue_depth}${stage.queue_size > 0 ? `/${stage.queue_size}` : ""}, busy ${stage.in_progress}/${stage.workers}, done ${stage.processed} (${stage.items_per_min}/min)`;
+  }
+
   return (
     <section
       className={styles["kb_service-container"]}
@@ -194,6 +205,14 @@ function KBService() {
       </div>
       <div className={styles["status__container"]}>
         {status.status && statusStr(status)}
+        {status.workers &&
+          status.workers.map((worker) => (
+            <div key={worker.worker}>{workerStr(worker)}</div>
+          ))}
+        {status.stages &&
+          status.stages.map((stage) => (
+            <div key={stage.stage}>{stageStr(stage)}</div>
+          ))}
       </div>
     </section>
   );
@@ -0,0 +1,68 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from generation_guard import GenerationGuard
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tokens', type=int, help='How many tokens to stream through the guard.', default=32000)
+parser.add_argument('--window-size', type=int, help='Guard window size.', default=50)
+parser.add_argument('--max-repeats', type=int, help='Guard max repeats.', default=5)
+parser.add_argument('--check-interval', type=int, help='Guard token check interval.', default=100)
+args = parser.parse_args()
+
+
+class FullScanGenerationGuard:
+    # Previous implementation, rescans the whole buffer on every check
+    def __init__(self, max_repeats, window_size, token_check_interval):
+        self.max_repeats = max_repeats
+        self.window_size = window_size
+        self.token_check_interval = token_check_interval
+        self.current_chunk_count = 0
+        self.check_token_buffer = []
+
+    def accumulate_tokens(self, token):
+        self.current_chunk_count += 1
+        self.check_token_buffer.append(token)
+
+    def is_infinite_generation(self):
+        if len(self.check_token_buffer) < self.window_size * self.max_repeats \
+                or self.current_chunk_count % self.token_check_interval != 0:
+            return False
+        sequence_counts = {}
+        for i in range(len(self.check_token_buffer) - self.window_size + 1):
+            seq = tuple(self.check_token_buffer[i:i + self.window_size])
+            sequence_counts[seq] = sequence_counts.get(seq, 0) + 1
+            if sequence_counts[seq] >= self.max_repeats:
+                return True
+        return False
+
+
+def benchmark(guard, tokens):
+    started = time.perf_counter()
+    detected = None
+    for position, token in enumerate(tokens, 1):
+        guard.accumulate_tokens(token)
+        if guard.is_infinite_generation():
+            detected = position
+            break
+    return time.perf_counter() - started, detected
+
+
+rng = random.Random(42)
+# Text without loops, the worst case as every check has to look at everything
+tokens = [f"token{rng.randrange(5000)}" for _ in range(args.tokens)]
+
+full_scan_s, full_scan_detected = benchmark(
+    FullScanGenerationGuard(args.max_repeats, args.window_size, args.check_interval), tokens)
+incremental_s, incremental_detected = benchmark(
+    GenerationGuard(safe_token_threshold=0, max_repeats=args.max_repeats, window_size=args.window_size,
+                    token_check_interval=args.check_interval), tokens)
+
+print(f"{args.tokens} tokens, window {args.window_size}, max repeats {args.max_repeats}, check every {args.check_interval}")
+print(f"Full scan:   {full_scan_s:.3f}s, loop detected at: {full_scan_detected}")
+print(f"Incremental: {incremental_s:.3f}s, loop detected at: {incremental_detected}")
+print(f"Speedup: {full_scan_s / incremental_s:.1f}x")
@@ -0,0 +1,68 @@
+import argparse
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from hashing import FAST_ALGORITHM, fast_algorithm, hash_files
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--documents', type=int, help='How many large documents to generate.', default=20)
+parser.add_argument('--document-size-mb', type=float, help='Size of a large document.', default=20)
+parser.add_argument('--pages', type=int, help='How many small page files to generate.', default=2000)
+parser.add_argument('--page-size-kb', type=float, help='Size of a page file.', default=4)
+parser.add_argument('--workers', type=int, help='Hashing threads.', default=os.cpu_count() or 1)
+args = parser.parse_args()
+
+
+def previous_compute_file_hash(file_path, algorithm='sha256'):
+    # Previous implementation, 8 KiB chunks on one thread
+    hash_func = hashlib.new(algorithm)
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(8192):
+            hash_func.update(chunk)
+    return hash_func.hexdigest()
+
+
+def write_corpus(folder, count, size):
+    os.makedirs(folder)
+    rng = random.Random(42)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f"file-{i:06}.bin")
+        with open(path, "wb") as fh:
+            fh.write(rng.randbytes(size))
+        paths.append(path)
+    return paths
+
+
+def benchmark(name, hash_all, paths):
+    # Files were just written, so reads come from the page cache and only hashing is measured
+    started = time.perf_counter()
+    hashes = hash_all(paths)
+    elapsed = time.perf_counter() - started
+    size_mb = sum(os.path.getsize(x) for x in paths) / 1024 / 1024
+    print(f"  {name:<28} {elapsed:.3f}s, {size_mb / elapsed:.0f} MB/s")
+    return elapsed, hashes
+
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    corpora = {
+        "documents": write_corpus(os.path.join(temp_dir, "documents"), args.documents,
+                                  int(args.document_size_mb * 1024 * 1024)),
+        "pages": write_corpus(os.path.join(temp_dir, "pages"), args.pages, int(args.page_size_kb * 1024)),
+    }
+    print(f"Fast hash: {fast_algorithm()}, workers: {args.workers}")
+    for corpus, paths in corpora.items():
+        print(f"{corpus}: {len(paths)} files")
+        previous_s, previous = benchmark("8 KiB reads, one thread", lambda x: [previous_compute_file_hash(y) for y in x],
+                                         paths)
+        single_s, single = benchmark("sha256, one thread", lambda x: hash_files(x, workers=1), paths)
+        pool_s, pool = benchmark("sha256, thread pool", lambda x: hash_files(x, workers=args.workers), paths)
+        fast_s, _ = benchmark(f"{fast_algorithm()}, thread pool",
+                              lambda x: hash_files(x, FAST_ALGORITHM, workers=args.workers), paths)
+        assert previous == list(single.values()) == list(pool.values())
+        print(f"  Speedup sha256: {previous_s / pool_s:.1f}x, fast hash: {previous_s / fast_s:.1f}x")